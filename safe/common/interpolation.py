@@ -100,7 +100,7 @@ def validate_inputs(
         y = validate_coordinate_vector(y, 'y')
 
     try:
-        z = numpy.array(z)
+        z = numpy.asarray(z)
     except Exception, e:
         msg = (
             'Input vector z could not be converted to a numpy array: '
@@ -30,8 +30,14 @@ LOGGER = logging.getLogger('InaSAFE')
 # pylint: disable=W0105
 
 
+# Number of interpolation points processed at a time. This bounds the
+# size of the temporary arrays used by interpolate2d.
+DEFAULT_CHUNK_SIZE = 2 ** 18
+
+
 # noinspection PyArgumentEqualDefault,PyTypeChecker
-def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
+def interpolate2d(x, y, z, points, mode='linear', bounds_error=False,
+                  dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
     """Fundamental 2D interpolation routine
 
     :param x: 1D array of x-coordinates of the mesh on which to interpolate
@@ -62,6 +68,14 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
           is returned for those values
     :type bounds_error: bool
 
+    :param dtype: Numpy data type of the returned array, e.g. numpy.float32
+        to halve the memory used by the result. Default is double precision.
+    :type dtype: numpy.dtype
+
+    :param chunk_size: Maximal number of points interpolated at a time.
+        This bounds the memory used for temporary arrays.
+    :type chunk_size: int
+
     :returns: 1D array with same length as points with interpolated values
 
     :raises: Exception, BoundsError (see note about bounds_error)
@@ -71,6 +85,10 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
         but need not be equidistantly spaced. No such assumption regarding
         ordering of points is made.
 
+        If x and y are equidistantly spaced (as is the case for all
+        rasters) the cells containing each point are computed directly
+        from the grid spacing rather than by searching the axes.
+
         z is assumed to have dimension M x N, where M = len(x) and N = len(y).
         In other words it is assumed that the x values follow the first
         (vertical) axis downwards and y values the second (horizontal) axis
@@ -89,21 +107,127 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
         x=x, y=y, z=z, points=points, bounds_error=bounds_error)
     #pylint: enable=W0632
 
+    if dtype is None:
+        dtype = numpy.float
+
+    if chunk_size < 1:
+        msg = 'Argument chunk_size must be positive. I got %s' % chunk_size
+        raise InaSAFEError(msg)
+
     # Identify elements that are outside interpolation domain or NaN
     outside = (xi < x[0]) + (eta < y[0]) + (xi > x[-1]) + (eta > y[-1])
     outside += numpy.isnan(xi) + numpy.isnan(eta)
 
-    inside = -outside
-    xi = xi[inside]
-    eta = eta[inside]
+    # Result is NaN for values outside
+    r = numpy.empty(len(xi), dtype=dtype)
+    r[outside] = numpy.nan
+
+    # Populate result with interpolated values for points inside domain
+    x_spacing = regular_spacing(x)
+    y_spacing = regular_spacing(y)
+    inside = numpy.flatnonzero(numpy.logical_not(outside))
+    for start in xrange(0, len(inside), chunk_size):
+        indices = inside[start:start + chunk_size]
+        r[indices] = _interpolate_cells(x, y, z,
+                                        xi[indices], eta[indices],
+                                        mode, x_spacing, y_spacing)
+
+    return r
+
+
+def regular_spacing(x, rtol=1.0e-6):
+    """Determine whether coordinates are equidistantly spaced
+
+    :param x: 1D array of monotonically increasing coordinates
+    :type x: numpy.ndarray
+
+    :param rtol: Relative tolerance of the spacing
+    :type rtol: float
+
+    :returns: Spacing between consecutive coordinates or None if they
+        are not equidistant.
+    """
+
+    if len(x) < 2:
+        return None
+
+    x = numpy.asarray(x, dtype=numpy.float)
+    spacing = (x[-1] - x[0]) / (len(x) - 1)
+    if not spacing > 0:
+        return None
+
+    if not numpy.allclose(numpy.diff(x), spacing, rtol=rtol, atol=0):
+        return None
+
+    return spacing
+
+
+def _upper_neighbours(x, xi, spacing):
+    """Find upper neighbours of interpolation points along one axis
+
+    Input:
+        x: 1D array of monotonically increasing coordinates
+        xi: 1D array of coordinates within [x[0], x[-1]]
+        spacing: Spacing of x if equidistant, None otherwise
+
+    Output:
+        idx: Indices as returned by numpy.searchsorted(x, xi, side='left')
+
+    If the spacing is known the index is computed directly from it and
+    corrected where rounding made it differ from searchsorted.
+    """
+
+    if spacing is None:
+        return numpy.searchsorted(x, xi, side='left')
+
+    n = len(x)
+    idx = numpy.ceil((xi - x[0]) / spacing).astype(numpy.int)
+    numpy.clip(idx, 0, n - 1, out=idx)
+
+    # Each step moves any misplaced index one position closer to its
+    # correct value, so this loop terminates after a single pass for
+    # regular grids.
+    while True:
+        too_low = x[idx] < xi
+        too_high = (idx > 0) * (x[idx - 1] >= xi)
+        if not (too_low.any() or too_high.any()):
+            break
+
+        idx[too_low] += 1
+        idx[too_high] -= 1
+
+    return idx
+
+
+def _interpolate_cells(x, y, z, xi, eta, mode, x_spacing, y_spacing):
+    """Interpolate points known to be inside the mesh
+
+    Input:
+        x, y, z: Mesh as passed to interpolate2d
+        xi, eta: 1D arrays of point coordinates inside the mesh
+        mode: Either 'linear' or 'constant'
+        x_spacing, y_spacing: Spacing of x and y as returned by
+            regular_spacing
+
+    Output:
+        1D array of interpolated values for each point
+    """
 
     # Find upper neighbours for each interpolation point
-    idx = numpy.searchsorted(x, xi, side='left')
-    idy = numpy.searchsorted(y, eta, side='left')
+    idx = _upper_neighbours(x, xi, x_spacing)
+    idy = _upper_neighbours(y, eta, y_spacing)
+
+    # Points on the first grid line belong to the first cell. Index 0
+    # would otherwise wrap around and pick up values from the opposite
+    # edge of the grid.
+    if len(x) > 1:
+        numpy.maximum(idx, 1, out=idx)
+    if len(y) > 1:
+        numpy.maximum(idy, 1, out=idy)
 
     # Internal check (index == 0 is OK)
     if len(idx) > 0 or len(idy) > 0:
-        if (max(idx) >= len(x)) or (max(idy) >= len(y)):
+        if (idx.max() >= len(x)) or (idy.max() >= len(y)):
             msg = (
                 'Interpolation point outside domain. '
                 'This should never happen. '
@@ -164,16 +288,11 @@ def interpolate2d(x, y, z, points, mode='linear', bounds_error=False):
             if not mz <= mZ:
                 raise InaSAFEError(msg)
 
-    # Populate result with interpolated values for points inside domain
-    # and NaN for values outside
-    r = numpy.zeros(len(points))
-    r[inside] = z
-    r[outside] = numpy.nan
-
-    return r
+    return z
 
 
-def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False):
+def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False,
+                       dtype=None, chunk_size=DEFAULT_CHUNK_SIZE):
     """2D interpolation of raster data
 
     It is assumed that data is organised in matrix z as latitudes from
@@ -213,6 +332,12 @@ def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False):
           is returned for those values
     :type bounds_error: bool
 
+    :param dtype: Numpy data type of the returned array (see interpolate2d)
+    :type dtype: numpy.dtype
+
+    :param chunk_size: Maximal number of points interpolated at a time
+    :type chunk_size: int
+
     :returns: 1D array with same length as points with interpolated values
 
     :raises: Exception, BoundsError (see note about bounds_error)
@@ -227,7 +352,8 @@ def interpolate_raster(x, y, z, points, mode='linear', bounds_error=False):
     z = z.transpose()
 
     # Call underlying interpolation routine and return
-    res = interpolate2d(x, y, z, points, mode=mode, bounds_error=bounds_error)
+    res = interpolate2d(x, y, z, points, mode=mode, bounds_error=bounds_error,
+                        dtype=dtype, chunk_size=chunk_size)
     return res
 
 
@@ -22,28 +22,150 @@ __copyright__ += 'Disaster Reduction'
 
 
 import logging
+import multiprocessing
+import multiprocessing.sharedctypes
 import numpy
-from random import uniform, seed as seed_function
 
 from safe.common.numerics import ensure_numeric
-from safe.common.numerics import grid_to_points, geotransform_to_axes
+from safe.common.numerics import geotransform_to_axes
 from safe.common.exceptions import (
     PolygonInputError, InaSAFEError, PointsInputError)
 
 LOGGER = logging.getLogger('InaSAFE')
 
 
+class PreparedPolygon(object):
+    """Polygon with cached structures for repeated clipping.
+
+    Bounding box, vertex array, edge arrays and segments are computed
+    when needed and then reused by all polygon functions in this module.
+    Prepare a polygon once if the same polygon is used for many calls,
+    e.g. in aggregation loops or when clipping many lines.
+
+    Args:
+        * outer_ring: list or Nx2 array of polygon vertices
+        * inner_rings: (optional) list of polygons representing holes
+        * check_input: Allows faster execution if set to False
+
+    Raises:
+        PolygonInputError if rings are not valid arrays of vertices
+
+    Note:
+        All functions in this module accepting a polygon also accept a
+        PreparedPolygon. Holes are honoured by in_and_outside_polygon,
+        inside_polygon, outside_polygon and clip_grid_by_polygons.
+        The remaining functions only use the outer ring.
+
+        Functions given plain polygons prepare them for the duration of
+        the call. The rings of a PreparedPolygon must not be modified
+        while it is in use.
+    """
+
+    def __init__(self, outer_ring, inner_rings=None, check_input=True):
+        if check_input:
+            try:
+                outer_ring = ensure_numeric(outer_ring, numpy.float)
+            except Exception, e:
+                msg = ('Polygon could not be converted to numeric array: %s'
+                       % str(e))
+                raise PolygonInputError(msg)
+
+            msg = 'Polygon array must be a 2d array of vertices'
+            if len(outer_ring.shape) != 2:
+                raise PolygonInputError(msg)
+
+            msg = 'Polygon array must have two columns'
+            if outer_ring.shape[1] != 2:
+                raise PolygonInputError(msg)
+
+        self.outer_ring = numpy.ascontiguousarray(outer_ring)
+
+        if inner_rings is None:
+            inner_rings = []
+        self.inner_rings = [prepare_polygon(ring) for ring in inner_rings]
+
+        # Bounding box following format used in this module
+        self.bbox = [min(self.outer_ring[:, 0]),
+                     max(self.outer_ring[:, 0]),
+                     min(self.outer_ring[:, 1]),
+                     max(self.outer_ring[:, 1])]
+
+        # Structures computed on demand
+        self._edges = None
+        self._segments = None
+        self._slab_indices = {}
+
+    def __len__(self):
+        """Number of vertices in outer ring
+        """
+        return self.outer_ring.shape[0]
+
+    def __repr__(self):
+        return ('PreparedPolygon(%i vertices, %i inner rings)'
+                % (len(self), len(self.inner_rings)))
+
+    def get_edges(self):
+        """Get edges of outer ring as px_i, py_i, px_j, py_j arrays
+        """
+
+        if self._edges is None:
+            self._edges = _polygon_edges(self.outer_ring)
+        return self._edges
+
+    def get_segments(self):
+        """Get segments of outer ring as returned by polygon2segments
+        """
+
+        if self._segments is None:
+            self._segments = polygon2segments(self.outer_ring)
+        return self._segments
+
+    def get_slab_index(self, rtol=0.0, atol=0.0, number_of_slabs=None):
+        """Get edges of outer ring sorted into slabs as made by _slab_index
+        """
+
+        key = (rtol, atol, number_of_slabs)
+        if key not in self._slab_indices:
+            self._slab_indices[key] = _slab_index(self.get_edges(),
+                                                  rtol, atol,
+                                                  number_of_slabs)
+        return self._slab_indices[key]
+
+
+def prepare_polygon(polygon):
+    """Get PreparedPolygon for polygon
+
+    Args:
+        * polygon: Either a PreparedPolygon which is returned as is,
+              a polygon geometry object with outer_ring and inner_rings
+              or a list or Nx2 array of polygon vertices.
+
+    Returns:
+        * PreparedPolygon instance
+    """
+
+    if isinstance(polygon, PreparedPolygon):
+        return polygon
+    elif hasattr(polygon, 'outer_ring'):
+        return PreparedPolygon(polygon.outer_ring, polygon.inner_rings)
+    else:
+        return PreparedPolygon(polygon)
+
+
 def separate_points_by_polygon(
         points, polygon,
         polygon_bbox=None,
         closed=True,
         check_input=True,
-        use_numpy=True):
+        use_numpy=True,
+        algorithm=None,
+        processes=None):
     """Determine whether points are inside or outside a polygon.
 
     Args:
         * points: Tuple of (x, y) coordinates, or list of tuples
-        * polygon: list or Nx2 array of polygon vertices
+        * polygon: list or Nx2 array of polygon vertices or a
+              PreparedPolygon (of which only the outer ring is used)
         * polygon_bbox: (optional) bounding box for polygon
         * closed: (optional) determine whether points on boundary should be
               regarded as belonging to the polygon (closed = True)
@@ -53,6 +175,20 @@ def separate_points_by_polygon(
               the code faster.
         * check_input: Allows faster execution if set to False
         * use_numpy: Use the fast numpy implementation
+        * algorithm: (optional) Name of underlying algorithm. Options are
+              'numpy': Vectorised over points, looping over polygon edges.
+              'slab': Polygon edges are bucketed into horizontal slabs so
+                  each point is only tested against edges in its own slab.
+                  This is much faster for polygons with many vertices.
+              'python': Pure python reference implementation (slow).
+              If None (default) 'numpy' is used unless use_numpy is False.
+        * processes: (optional) Number of worker processes. If larger
+              than 1, candidate points are copied into shared memory
+              and classified in chunks by a pool of processes. This only
+              pays off for very large point sets. Results are identical
+              to those of a single process. Default None (single process).
+              A PointPool can be given instead to reuse its processes
+              over several calls.
 
     Returns:
         * indices_inside_polygon: array of indices of points
@@ -81,6 +217,14 @@ def separate_points_by_polygon(
     http://www.alienryderflex.com/polygon/
     """
 
+    # Use cached structures if polygon has been prepared
+    prepared = None
+    if isinstance(polygon, PreparedPolygon):
+        prepared = polygon
+        polygon = prepared.outer_ring
+        if polygon_bbox is None:
+            polygon_bbox = prepared.bbox
+
     # FIXME (Ole): Make sure bounding box here follows same format as
     #              those returned by layers. Methinks they don't at the moment
     if check_input:
@@ -89,6 +233,11 @@ def separate_points_by_polygon(
         if not (isinstance(closed, bool) or closed is None):
             raise PolygonInputError(msg)
 
+        msg = ('Keyword argument "algorithm" must be one of %s or None. '
+               'I got %s' % (POLYGON_ALGORITHMS.keys(), algorithm))
+        if not (algorithm is None or algorithm in POLYGON_ALGORITHMS):
+            raise PolygonInputError(msg)
+
         try:
             points = ensure_numeric(points, numpy.float)
         except Exception, e:
@@ -164,13 +313,27 @@ def separate_points_by_polygon(
     inside_box = -outside_box
     candidate_points = points[inside_box]
 
-    if use_numpy:
-        func = _separate_points_by_polygon
+    if algorithm is None:
+        if use_numpy:
+            algorithm = 'numpy'
+        else:
+            algorithm = 'python'
+    func = POLYGON_ALGORITHMS[algorithm]
+
+    if isinstance(processes, PointPool):
+        local_indices_inside, local_indices_outside = processes.separate(
+            func, candidate_points, polygon, closed, prepared)
+    elif (processes is not None and processes > 1 and
+            len(candidate_points) > 0):
+        pool = PointPool(processes, len(candidate_points))
+        try:
+            local_indices_inside, local_indices_outside = pool.separate(
+                func, candidate_points, polygon, closed, prepared)
+        finally:
+            pool.close()
     else:
-        func = _separate_points_by_polygon_python
-
-    local_indices_inside, local_indices_outside = func(
-        candidate_points, polygon, closed=closed)
+        local_indices_inside, local_indices_outside = func(
+            candidate_points, polygon, closed=closed, prepared=prepared)
 
     # Map local indices from candidate points to global indices of all points
     indices_outside_box = numpy.where(outside_box)[0]
@@ -187,7 +350,8 @@ def separate_points_by_polygon(
 
 
 def _separate_points_by_polygon(points, polygon,
-                                closed, rtol=0.0, atol=0.0):
+                                closed, rtol=0.0, atol=0.0,
+                                max_pairs=2 ** 20, prepared=None):
     """Underlying algorithm to partition point according to polygon
 
     Input:
@@ -198,6 +362,10 @@ def _separate_points_by_polygon(points, polygon,
        or not (closed = False). Close can also be None.
        rtol, atol: Tolerances for when a point is considered to coincide with
        a line. Default 0.0.
+       max_pairs: Maximal number of (point, edge) pairs evaluated at once
+       when looking for points on the boundary.
+       prepared: Optional PreparedPolygon for polygon. If given, its cached
+       edge structures are used.
 
     Output:
        indices: array of same length as points with indices of points falling
@@ -248,19 +416,27 @@ def _separate_points_by_polygon(points, polygon,
     numpy.seterr(**original_numpy_settings)
 
     if closed is not None:
-        # Find points on polygon boundary
-        for i in range(N):
-            # Loop through polygon edges
-            j = (i + 1) % N
-            edge = [polygon[i, :], polygon[j, :]]
-
-            # Select those that are on the boundary
-            boundary_points = point_on_line(points, edge, rtol, atol)
-
-            if closed:
-                inside[boundary_points] = 1
-            else:
-                inside[boundary_points] = 0
+        # Find points on polygon boundary. Only pairs of points and edges
+        # sharing a horizontal slab need to be tested.
+        if prepared is None:
+            prepared = PreparedPolygon(polygon, check_input=False)
+        on_boundary = numpy.zeros(M, dtype=numpy.bool)
+        edges = prepared.get_edges()
+        slab_index = prepared.get_slab_index(rtol, atol)
+        for a, b, local, k in _slab_pairs(y, slab_index,
+                                          max_pairs=max_pairs):
+            on_edge = _points_on_edges(x[a:b][local], y[a:b][local],
+                                       edges[0][k], edges[1][k],
+                                       edges[2][k], edges[3][k],
+                                       rtol, atol)
+            on_boundary[a:b] += numpy.bincount(local, weights=on_edge,
+                                               minlength=b - a) > 0
+
+        # Select those that are on the boundary
+        if closed:
+            inside[on_boundary] = 1
+        else:
+            inside[on_boundary] = 0
 
     # Record point as either inside or outside
     inside_index = numpy.sum(inside)  # How many points are inside
@@ -275,7 +451,8 @@ def _separate_points_by_polygon(points, polygon,
 
 
 def _separate_points_by_polygon_python(points, polygon,
-                                       closed, rtol=0.0, atol=0.0):
+                                       closed, rtol=0.0, atol=0.0,
+                                       prepared=None):
     """Underlying algorithm to partition point according to polygon
 
     Note:
@@ -291,6 +468,7 @@ def _separate_points_by_polygon_python(points, polygon,
        or not (closed = False)
        rtol, atol: Tolerances for when a point is considered to coincide with
        a line. Default 0.0.
+       prepared: Ignored. Accepted for compatibility with the other kernels.
 
     Output:
        indices: array of same length as points with indices of points falling
@@ -374,6 +552,409 @@ def _separate_points_by_polygon_python(points, polygon,
     return indices[:inside_index], indices[inside_index:]
 
 
+def _separate_points_by_polygon_slab(points, polygon,
+                                     closed, rtol=0.0, atol=0.0,
+                                     number_of_slabs=None,
+                                     max_pairs=2 ** 20, prepared=None):
+    """Underlying algorithm to partition point according to polygon
+
+    Polygon edges are sorted into horizontal slabs bounded by vertex
+    y coordinates so that each point is only tested against the edges whose
+    y-range overlaps its own slab. The crossing and boundary tests are
+    otherwise identical to those in _separate_points_by_polygon.
+
+    Input:
+       points - Mx2 array of point coordinates
+       polygon - Nx2 array of polygon vertices
+       closed - (optional) determine whether points on boundary should be
+       regarded as belonging to the polygon (closed = True)
+       or not (closed = False). Close can also be None.
+       rtol, atol: Tolerances for when a point is considered to coincide with
+       a line. Default 0.0.
+       number_of_slabs: Approximate number of slabs. If None (default) one
+       slab is made for about every four polygon vertices.
+       max_pairs: Maximal number of (point, edge) pairs evaluated at once.
+       This caps the size of temporary arrays.
+       prepared: Optional PreparedPolygon for polygon. If given, its cached
+       edge and slab structures are used.
+
+    Output:
+       indices_inside: array of indices of points inside the polygon
+       indices_outside: array of indices of points outside the polygon
+    """
+
+    M = points.shape[0]
+
+    if M == 0:
+        # If no points return two 0-vectors
+        return numpy.arange(0), numpy.arange(0)
+
+    if prepared is None:
+        prepared = PreparedPolygon(polygon, check_input=False)
+
+    x = points[:, 0]
+    y = points[:, 1]
+    px_i, py_i, px_j, py_j = prepared.get_edges()
+    slab_index = prepared.get_slab_index(rtol, atol,
+                                         number_of_slabs=number_of_slabs)
+
+    # Vector keeping track of which points are inside
+    inside = numpy.zeros(M, dtype=numpy.int)  # All assumed outside initially
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    for a, b, local, k in _slab_pairs(y, slab_index, max_pairs=max_pairs):
+        # Coordinates for all (point, edge) pairs in this chunk
+        xp = x[a:b][local]
+        yp = y[a:b][local]
+        ex_i = px_i[k]
+        ey_i = py_i[k]
+        ex_j = px_j[k]
+        ey_j = py_j[k]
+
+        # Edge crossing formula
+        sigma = (yp - ey_i) / (ey_j - ey_i) * (ex_j - ex_i)
+        seg_i = (ey_i < yp) * (ey_j >= yp)
+        seg_j = (ey_j < yp) * (ey_i >= yp)
+        mask = (ex_i + sigma < xp) * (seg_i + seg_j)
+
+        crossings = numpy.bincount(local, weights=mask, minlength=b - a)
+        inside[a:b] = crossings.astype(numpy.int) % 2
+
+        if closed is not None:
+            # Find points on polygon boundary
+            on_edge = _points_on_edges(xp, yp, ex_i, ey_i, ex_j, ey_j,
+                                       rtol, atol)
+            on_boundary = numpy.bincount(local, weights=on_edge,
+                                         minlength=b - a) > 0
+            if closed:
+                inside[a:b][on_boundary] = 1
+            else:
+                inside[a:b][on_boundary] = 0
+
+    # Restore numpy warnings
+    numpy.seterr(**original_numpy_settings)
+
+    return numpy.where(inside)[0], numpy.where(1 - inside)[0]
+
+
+class PointPool(object):
+    """Pool of worker processes separating points by polygons
+
+    Args:
+        * processes: Number of worker processes
+        * capacity: Maximal number of points classified in one map over
+              the pool. Larger point sets are classified in batches.
+
+    Note:
+        Points are copied into a buffer in shared memory which the workers
+        view as a numpy array, so only chunk limits, the polygon and the
+        resulting indices are passed between processes. The pool is
+        created once and can be used for several polygons, e.g. the outer
+        ring and all holes in in_and_outside_polygon. Call close() when
+        done.
+    """
+
+    def __init__(self, processes, capacity):
+        self.processes = processes
+        self.capacity = max(capacity, 1)
+        self.buffer = multiprocessing.sharedctypes.RawArray(
+            'd', 2 * self.capacity)
+        self.points = numpy.frombuffer(self.buffer,
+                                       dtype=numpy.float).reshape((-1, 2))
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         ({'points': self.buffer},))
+
+    def separate(self, func, points, polygon, closed, prepared):
+        """Separate points by polygon in the worker processes
+
+        Input:
+           func: Underlying point in polygon algorithm from
+               POLYGON_ALGORITHMS
+           points: Mx2 array of points
+           polygon: Nx2 array of polygon vertices
+           closed: See separate_points_by_polygon
+           prepared: PreparedPolygon or None
+
+        Output:
+           Same as underlying algorithm. Indices of points inside and
+           outside are in increasing order.
+        """
+
+        M = points.shape[0]
+        if M == 0:
+            return numpy.arange(0), numpy.arange(0)
+
+        if prepared is None:
+            prepared = PreparedPolygon(polygon, check_input=False)
+
+        inside = numpy.zeros(M, dtype=numpy.bool)
+        for start in range(0, M, self.capacity):
+            # Copy batch of points into shared memory
+            K = min(self.capacity, M - start)
+            self.points[:K] = points[start:start + K]
+
+            # Split points into chunks, a few per process to balance load
+            number_of_chunks = min(K, 4 * self.processes)
+            limits = numpy.linspace(0, K, number_of_chunks + 1)
+            limits = limits.astype(numpy.int)
+            tasks = [(limits[i], limits[i + 1], func, polygon, closed,
+                      prepared) for i in range(number_of_chunks)]
+            results = self.pool.map(_separate_points_chunk, tasks)
+
+            # Merge in order of chunks
+            for (a, _, _, _, _, _), indices in zip(tasks, results):
+                inside[start + a + indices] = True
+
+        return (numpy.where(inside)[0],
+                numpy.where(numpy.logical_not(inside))[0])
+
+    def close(self):
+        """Stop worker processes
+        """
+
+        self.pool.close()
+        self.pool.join()
+
+
+def _separate_points_chunk(task):
+    """Worker separating one chunk of shared points by polygon
+
+    Input:
+       task: Tuple (a, b, func, polygon, closed, prepared) with first and
+       last (exclusive) point index and arguments for func
+
+    Output:
+       Indices relative to a of points inside polygon
+    """
+
+    a, b, func, polygon, closed, prepared = task
+    points = numpy.frombuffer(_WORKER_STATE['points'],
+                              dtype=numpy.float).reshape((-1, 2))
+    inside, _ = func(points[a:b], polygon, closed=closed, prepared=prepared)
+    return inside
+
+
+# State shared with worker processes. It is set in each worker when the
+# pool is created.
+_WORKER_STATE = {}
+
+
+def _init_worker(state):
+    """Initialise worker process with shared state
+    """
+
+    _WORKER_STATE.clear()
+    _WORKER_STATE.update(state)
+
+
+def _map_in_processes(function, items, processes, state):
+    """Apply function to items using a pool of worker processes
+
+    Input:
+       function: Module level function taking one item
+       items: List of items
+       processes: Number of worker processes
+       state: Dictionary available to function as _WORKER_STATE in
+       each worker
+
+    Output:
+       List of results in the same order as items
+    """
+
+    pool = multiprocessing.Pool(processes, _init_worker, (state,))
+    try:
+        results = pool.map(function, items)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return results
+
+
+def _polygon_edges(polygon):
+    """Get polygon edges as four arrays of end point coordinates
+
+    Input:
+       polygon - Nx2 array of polygon vertices
+
+    Output:
+       px_i, py_i, px_j, py_j - coordinates of the N edges going from
+       vertex i to vertex j = (i + 1) % N
+    """
+
+    px_i = polygon[:, 0]
+    py_i = polygon[:, 1]
+    px_j = numpy.roll(px_i, -1)
+    py_j = numpy.roll(py_i, -1)
+
+    return px_i, py_i, px_j, py_j
+
+
+def _slab_index(edges, rtol=0.0, atol=0.0, number_of_slabs=None):
+    """Sort polygon edges into horizontal slabs
+
+    Edges are registered in every slab their y-range overlaps. The y-range
+    is widened by the distance within which point_on_line would consider a
+    point to be on the edge given the tolerances rtol and atol. Hence a
+    point can only be on an edge or be crossed by a horizontal ray through
+    an edge if that edge is registered in the point's slab.
+
+    Input:
+       edges - px_i, py_i, px_j, py_j as returned by _polygon_edges
+       rtol, atol - tolerances as used by point_on_line
+       number_of_slabs - approximate number of slabs. If None (default) one
+       slab is made for about every four polygon vertices.
+
+    Output:
+       boundaries - sorted array of y values separating the slabs.
+       Slab s covers (boundaries[s - 1], boundaries[s]]
+       slab_edges - array of edge indices sorted by slab
+       slab_start - array where slab_edges[slab_start[s]:slab_start[s + 1]]
+       are the edges registered in slab s
+    """
+
+    px_i, py_i, px_j, py_j = edges
+    N = len(px_i)
+
+    # Slab boundaries taken from the sorted vertex y coordinates.
+    if number_of_slabs is None:
+        number_of_slabs = N // 4
+    vertex_y = numpy.unique(py_i)
+    step = max(1, len(vertex_y) // max(1, number_of_slabs))
+    boundaries = vertex_y[step:-1:step]
+    K = len(boundaries) + 1  # Number of slabs
+
+    # Distance from edge within which points may be deemed on the edge.
+    # It is bounded by the edge length as points must be closer to the first
+    # vertex than the length of the edge. A little extra allows for rounding.
+    length = numpy.sqrt((px_j - px_i) ** 2 + (py_j - py_i) ** 2)
+    margin = numpy.zeros(N)
+    nonzero = length > 0
+    margin[nonzero] = numpy.minimum(length[nonzero],
+                                    atol / length[nonzero] +
+                                    rtol * length[nonzero])
+    margin += 1.0e-12 * (numpy.abs(py_i).max() + length)
+
+    # Register each edge in all slabs its widened y-range overlaps
+    s0 = numpy.searchsorted(boundaries,
+                            numpy.minimum(py_i, py_j) - margin, side='left')
+    s1 = numpy.searchsorted(boundaries,
+                            numpy.maximum(py_i, py_j) + margin, side='left')
+    counts = s1 - s0 + 1
+    offsets = numpy.cumsum(counts) - counts
+    slab = (numpy.repeat(s0, counts) + numpy.arange(counts.sum()) -
+            numpy.repeat(offsets, counts))
+    order = numpy.argsort(slab, kind='mergesort')
+    slab_edges = numpy.repeat(numpy.arange(N), counts)[order]
+    slab_start = numpy.searchsorted(slab[order], numpy.arange(K + 1))
+
+    return boundaries, slab_edges, slab_start
+
+
+def _slab_pairs(y, slab_index, max_pairs=2 ** 20, y_max=None):
+    """Generate (point, edge) pairs sharing a horizontal slab
+
+    Input:
+       y - array of M point y coordinates
+       slab_index - boundaries, slab_edges, slab_start as returned
+       by _slab_index
+       max_pairs - maximal number of pairs generated at once
+       y_max - optional array of M upper y values. If given, items are
+       vertical intervals [y, y_max] (e.g. the y-range of line segments)
+       paired with the edges of all slabs they overlap. Each pair is
+       then generated only once.
+
+    Output:
+       Generator of tuples (a, b, local, k) for consecutive chunks of points
+       a:b. Arrays local and k have the same length and contain the local
+       index (relative to a) of the point and the index of the edge
+       for each pair.
+    """
+
+    boundaries, slab_edges, slab_start = slab_index
+    K = len(boundaries) + 1  # Number of slabs
+    M = len(y)
+
+    # Locate slab and range of candidate edges for each point
+    point_slab = numpy.searchsorted(boundaries, y, side='left')
+    point_slab = numpy.clip(point_slab, 0, K - 1)  # NaN goes last
+    if y_max is None:
+        last_slab = point_slab
+    else:
+        # Slabs are consecutive in slab_edges so edges of all slabs
+        # overlapped by an interval form one contiguous run
+        last_slab = numpy.searchsorted(boundaries, y_max, side='left')
+        last_slab = numpy.clip(last_slab, point_slab, K - 1)
+    first_edge = slab_start[point_slab]
+    last_edge = slab_start[last_slab + 1]
+    number_of_edges = last_edge - first_edge
+
+    # Generate chunks of points so that number of pairs fit in max_pairs
+    cumulative_pairs = numpy.cumsum(number_of_edges)
+    a = 0
+    while a < M:
+        done = 0
+        if a > 0:
+            done = cumulative_pairs[a - 1]
+        b = numpy.searchsorted(cumulative_pairs, done + max_pairs,
+                               side='right')
+        b = min(M, max(b, a + 1))
+
+        local = numpy.repeat(numpy.arange(b - a), number_of_edges[a:b])
+        k = slab_edges[_ranges(first_edge[a:b], last_edge[a:b])]
+        if y_max is not None and len(k) > 0:
+            # Remove edges registered in more than one of the slabs
+            n = slab_edges.max() + 1
+            keys = numpy.unique(local * n + k)
+            local = keys // n
+            k = keys % n
+        yield a, b, local, k
+
+        a = b
+
+
+def _points_on_edges(x, y, x0, y0, x1, y1, rtol=1.0e-5, atol=1.0e-8):
+    """Determine if points are on line segments, pairwise
+
+    Input
+        x, y: Arrays of point coordinates
+        x0, y0, x1, y1: Arrays of the same length with the end points of the
+        line segment to test each point against
+
+    Output
+        Boolean array which is True where point k is on segment k
+
+    Note
+        This is the same test as in point_on_line but evaluated elementwise
+        so many points can be tested against many different segments at once.
+    """
+
+    # Vector from beginning of line to point
+    a0 = x - x0
+    a1 = y - y0
+
+    # Vector parallel to line
+    b0 = x1 - x0
+    b1 = y1 - y0
+
+    # Determine if point vector is parallel to line up to a tolerance
+    nominator = abs(a1 * b0 - a0 * b1)
+    denominator = b0 * b0 + b1 * b1
+    is_parallel = nominator <= atol + rtol * denominator
+
+    # Determine if points are within end points
+    len_a = numpy.sqrt(a0 * a0 + a1 * a1)
+    len_b = numpy.sqrt(denominator)
+    cross = a0 * b0 + a1 * b1
+
+    return is_parallel * (cross >= 0) * (len_a <= len_b)
+
+
 def point_on_line(points, line, rtol=1.0e-5, atol=1.0e-8,
                   check_input=True):
     """Determine if a point is on a line segment
@@ -470,25 +1051,42 @@ def point_on_line(points, line, rtol=1.0e-5, atol=1.0e-8,
         return result
 
 
+# Underlying algorithms available to separate_points_by_polygon
+POLYGON_ALGORITHMS = {'numpy': _separate_points_by_polygon,
+                      'slab': _separate_points_by_polygon_slab,
+                      'python': _separate_points_by_polygon_python}
+
+
 def in_and_outside_polygon(
         points, polygon,
         closed=True,
         holes=None,
-        check_input=True):
+        check_input=True,
+        algorithm=None,
+        processes=None):
     """Separate a list of points into two sets inside and outside a polygon
 
     :param points: (tuple, list or array) of coordinates
 
-    :param polygon: list or Nx2 array of polygon vertices
+    :param polygon: list or Nx2 array of polygon vertices or a
+      PreparedPolygon
 
     :param closed: Set to True if points on boundary are considered
       to be 'inside' polygon
 
     :param holes: list of polygons representing holes. Points inside either of
-      these are considered outside polygon
+      these are considered outside polygon. If polygon is a PreparedPolygon
+      and holes is None, its inner rings are used as holes.
 
     :param check_input: Allows faster execution if set to False
 
+    :param algorithm: Optional name of underlying point in polygon algorithm.
+      See separate_points_by_polygon for options.
+
+    :param processes: Optional number of worker processes or PointPool.
+      See separate_points_by_polygon. One pool is used for the polygon
+      and all holes.
+
     Output:
       inside: Indices of points inside the polygon
 
@@ -497,29 +1095,49 @@ def in_and_outside_polygon(
     See separate_points_by_polygon for more documentation
     """
 
-    # Get separation by outer_ring
-    inside, outside = separate_points_by_polygon(points, polygon,
-                                                 closed=closed,
-                                                 check_input=check_input)
-
-    # Take care of holes
-    if holes is not None:
-        msg = ('Argument holes must be a list of polygons, '
-               'I got %s' % holes)
-        if not isinstance(holes, list):
-            raise InaSAFEError(msg)
-
-        for hole in holes:
-            in_hole, out_hole = separate_points_by_polygon(points[inside],
-                                                           hole,
-                                                           closed=not closed,
-                                                           check_input=True)
+    # Use inner rings of prepared polygon unless holes are given
+    if holes is None and isinstance(polygon, PreparedPolygon):
+        if len(polygon.inner_rings) > 0:
+            holes = polygon.inner_rings
 
-            in_hole = inside[in_hole]  # Inside hole
-            inside = inside[out_hole]  # Inside outer_ring but outside hole
+    pool = None
+    if (processes is not None and not isinstance(processes, PointPool) and
+            processes > 1):
+        pool = PointPool(processes, len(points))
+        processes = pool
 
-            # Add holde indices to outside
-            outside = numpy.concatenate((outside, in_hole))
+    try:
+        # Get separation by outer_ring
+        inside, outside = separate_points_by_polygon(
+            points, polygon,
+            closed=closed,
+            check_input=check_input,
+            algorithm=algorithm,
+            processes=processes)
+
+        # Take care of holes
+        if holes is not None:
+            msg = ('Argument holes must be a list of polygons, '
+                   'I got %s' % holes)
+            if not isinstance(holes, list):
+                raise InaSAFEError(msg)
+
+            for hole in holes:
+                in_hole, out_hole = separate_points_by_polygon(
+                    points[inside], hole,
+                    closed=not closed,
+                    check_input=True,
+                    algorithm=algorithm,
+                    processes=processes)
+
+                in_hole = inside[in_hole]  # Inside hole
+                inside = inside[out_hole]  # Inside outer_ring but outside hole
+
+                # Add holde indices to outside
+                outside = numpy.concatenate((outside, in_hole))
+    finally:
+        if pool is not None:
+            pool.close()
 
     return inside, outside
 
@@ -539,7 +1157,7 @@ def is_inside_polygon(point, polygon, closed=True):
 
 
 def inside_polygon(points, polygon, closed=True, holes=None,
-                   check_input=True):
+                   check_input=True, algorithm=None, processes=None):
     """Determine points inside a polygon
 
        Functions inside_polygon and outside_polygon have been defined in
@@ -553,12 +1171,18 @@ def inside_polygon(points, polygon, closed=True, holes=None,
 
        holes: list of polygons representing holes. Points inside either of
        these are not considered inside_polygon
+
+       algorithm: Optional name of underlying point in polygon algorithm
+
+       processes: Optional number of worker processes
     """
 
     indices, _ = in_and_outside_polygon(points, polygon,
                                         closed=closed,
                                         holes=holes,
-                                        check_input=check_input)
+                                        check_input=check_input,
+                                        algorithm=algorithm,
+                                        processes=processes)
 
     # Return indices of points inside polygon
     return indices
@@ -580,7 +1204,8 @@ def is_outside_polygon(point, polygon, closed=True):
 
 
 def outside_polygon(points, polygon, closed=True,
-                    holes=None, check_input=True):
+                    holes=None, check_input=True, algorithm=None,
+                    processes=None):
     """Determine points outside a polygon
 
        Functions inside_polygon and outside_polygon have been defined in
@@ -591,12 +1216,18 @@ def outside_polygon(points, polygon, closed=True,
 
        holes: list of polygons representing holes. Points inside either of
               these are considered outside polygon
+
+       algorithm: Optional name of underlying point in polygon algorithm
+
+       processes: Optional number of worker processes
     """
 
     _, indices = in_and_outside_polygon(points, polygon,
                                         closed=closed,
                                         holes=holes,
-                                        check_input=check_input)
+                                        check_input=check_input,
+                                        algorithm=algorithm,
+                                        processes=processes)
 
     # Return indices of points outside polygon
     return indices
@@ -611,7 +1242,8 @@ def clip_lines_by_polygon(lines, polygon,
        lines: Sequence of polylines: [[p0, p1, ...], [q0, q1, ...], ...]
               where pi and qi are point coordinates (x, y).
 
-       polygon: list or Nx2 array of polygon vertices
+       polygon: list or Nx2 array of polygon vertices or a PreparedPolygon
+       (of which only the outer ring is used)
 
        closed: (optional) determine whether points on boundary should be
        regarded as belonging to the polygon (closed = True)
@@ -634,9 +1266,16 @@ def clip_lines_by_polygon(lines, polygon,
        come from, if one e.g. wants to assign the original attribute values
        to clipped lines.
 
-    This is a wrapper around clip_line_by_polygon
+    All line segments are clipped together using the same method as
+    clip_line_by_polygon.
     """
 
+    # Use cached structures if polygon has been prepared
+    prepared = None
+    if isinstance(polygon, PreparedPolygon):
+        prepared = polygon
+        polygon = prepared.outer_ring
+
     if check_input:
         # Input checks
         msg = 'Keyword argument "closed" must be boolean'
@@ -671,72 +1310,338 @@ def clip_lines_by_polygon(lines, polygon,
         if not polygon.shape[1] == 2:
             raise RuntimeError(msg)
 
-    # Get polygon extents to quickly rule out lines where all segments
-    # are outside and on the same side of its bounding box
-    minpx = min(polygon[:, 0])
-    maxpx = max(polygon[:, 0])
-    minpy = min(polygon[:, 1])
-    maxpy = max(polygon[:, 1])
-    polygon_bbox = [minpx, maxpx, minpy, maxpy]
-
-    # Get polygon_segments
-    polygon_segments = polygon2segments(polygon)
+    if prepared is None:
+        prepared = PreparedPolygon(polygon, check_input=False)
 
     # Call underlying function
-    return _clip_lines_by_polygon(lines,
-                                  polygon,
-                                  polygon_segments,
-                                  polygon_bbox,
-                                  closed=closed)
-
-
-def _clip_lines_by_polygon(lines,
-                           polygon,
-                           polygon_segments,
-                           polygon_bbox,
-                           closed=True):
+    return _clip_lines_by_polygon(lines, prepared, closed=closed)
+
+
+def _clip_lines_by_polygon(lines, prepared, closed=True):
     """Clip multiple lines by polygon
 
     Underlying function.
     - see clip_lines_by_polygon for details
+
+    All line segments are clipped in one vectorised call to
+    _clip_segments_by_polygon and the resulting pieces are joined
+    into lines again. The result is the same as clipping each line with
+    _clip_line_by_polygon.
     """
 
     # Get bounding box
-    minpx = polygon_bbox[0]
-    maxpx = polygon_bbox[1]
-    minpy = polygon_bbox[2]
-    maxpy = polygon_bbox[3]
-
-    inside_line_segments = {}
-    outside_line_segments = {}
-
-    # Loop through lines
+    minpx, maxpx, minpy, maxpy = prepared.bbox
+
+    # Exclude lines that are fully outside polygon bounding box
+    segments, segment_line, line_bboxes = _line_segments(lines)
+    line_is_outside = ((line_bboxes[:, 1] < minpx) +  # Everything to west
+                       (line_bboxes[:, 0] > maxpx) +  # Everything to east
+                       (line_bboxes[:, 3] < minpy) +  # Everything to south
+                       (line_bboxes[:, 2] > maxpy))   # Everything to north
+    selected = numpy.where(numpy.logical_not(line_is_outside[segment_line]))[0]
+
+    # Clip remaining line segments and join pieces into lines again
+    pieces, parent, inside = _clip_segments_by_polygon(segments[selected],
+                                                       prepared,
+                                                       closed=closed)
+    piece_line = segment_line[selected[parent]]
+    outside = numpy.logical_not(inside)
+    inside_line_segments = _join_pieces_by_line(pieces[inside],
+                                                piece_line[inside])
+    outside_line_segments = _join_pieces_by_line(pieces[outside],
+                                                 piece_line[outside])
+
+    # Record clipped line segments for every line
     M = len(lines)
     for k in range(M):
-        line = lines[k]
+        if line_is_outside[k]:
+            inside_line_segments[k] = []
+            outside_line_segments[k] = [lines[k]]
+        else:
+            if k not in inside_line_segments:
+                inside_line_segments[k] = []
+            if k not in outside_line_segments:
+                outside_line_segments[k] = []
+
+    return inside_line_segments, outside_line_segments
 
-        # Exclude lines that are fully outside polygon bounding box
-        if (max(line[:, 0]) < minpx or  # Everything is to the west
-            min(line[:, 0]) > maxpx or  # Everything is to the east
-            max(line[:, 1]) < minpy or  # Everything is to the south
-            min(line[:, 1]) > maxpy):   # Everything is to the north
 
-            inside_line_segments[k] = []
-            outside_line_segments[k] = [line]
-            continue
+def _line_segments(lines):
+    """Flatten lines into one array of line segments
+
+    Input:
+       lines: Sequence of polylines, each an Nx2 array of vertices
+
+    Output:
+       segments: Mx4 array of all line segments with columns x0, y0, x1, y1
+       ordered by line and then along the line
+       segment_line: M array with the index of the line of each segment
+       line_bboxes: Array with bounding box [minx, maxx, miny, maxy] of
+       each line (nan for lines without vertices)
+    """
+
+    N = len(lines)
+    counts = numpy.array([len(line) for line in lines], dtype=numpy.int)
+    line_bboxes = numpy.zeros((N, 4)) * numpy.nan
+    if counts.sum() == 0:
+        return numpy.zeros((0, 4)), numpy.zeros(0, dtype=numpy.int), \
+            line_bboxes
+
+    vertices = numpy.concatenate([ensure_numeric(line, numpy.float)
+                                  for line in lines if len(line) > 0])
+    starts = numpy.cumsum(counts) - counts
+
+    # Bounding box of each line
+    nonempty = counts > 0
+    x = vertices[:, 0]
+    y = vertices[:, 1]
+    line_bboxes[nonempty, 0] = numpy.minimum.reduceat(x, starts[nonempty])
+    line_bboxes[nonempty, 1] = numpy.maximum.reduceat(x, starts[nonempty])
+    line_bboxes[nonempty, 2] = numpy.minimum.reduceat(y, starts[nonempty])
+    line_bboxes[nonempty, 3] = numpy.maximum.reduceat(y, starts[nonempty])
+
+    # Segments go from every vertex but the last of each line to the next
+    first = _ranges(starts, starts + counts - 1)
+    segments = numpy.concatenate((vertices[first], vertices[first + 1]),
+                                 axis=1)
+    segment_line = numpy.repeat(numpy.arange(N), numpy.maximum(counts - 1, 0))
+
+    return segments, segment_line, line_bboxes
+
+
+def _segments_outside_bbox(segments, bbox):
+    """Determine which line segments are outside a bounding box
+
+    Input:
+       segments: Mx4 array of line segments x0, y0, x1, y1
+       bbox: Bounding box [minx, maxx, miny, maxy]
+
+    Output:
+       Boolean array which is True for segments that do not intersect bbox
+
+    This is the same test as the optimisation in _clip_line_by_polygon
+    vectorised over segments.
+    """
+
+    minpx, maxpx, minpy, maxpy = bbox
+    x0 = segments[:, 0]
+    y0 = segments[:, 1]
+    x1 = segments[:, 2]
+    y1 = segments[:, 3]
+
+    # Entire segment to the west, east, south or north
+    outside = ((x0 < minpx) * (x1 < minpx) + (x0 > maxpx) * (x1 > maxpx) +
+               (y0 < minpy) * (y1 < minpy) + (y0 > maxpy) * (y1 > maxpy))
+
+    # Segments with an end point inside the bounding box (as defined
+    # in _clip_line_by_polygon) are not outside
+    near = ((minpx < x0) * (x0 < maxpx) + (minpy < y0) * (y0 < maxpy) +
+            (minpx < x1) * (x1 < maxpx) + (minpy < y1) * (y1 < maxpy))
+
+    # Both end points are outside bounding box, but could be on
+    # either side so need to check if segment intersects polygon
+    # bounding box.
+    idx = numpy.where(numpy.logical_not(outside + near))[0]
+    crosses = numpy.zeros(len(idx), dtype=numpy.bool)
+    corners = numpy.array([[minpx, minpy], [maxpx, minpy],
+                           [maxpx, maxpy], [minpx, maxpy],
+                           [minpx, minpy]])
+    for i in range(4):
+        _, _, mask = _intersection_parameters(x0[idx], y0[idx],
+                                              x1[idx], y1[idx],
+                                              corners[i, 0], corners[i, 1],
+                                              corners[i + 1, 0],
+                                              corners[i + 1, 1])
+        crosses += mask
+    outside[idx] = numpy.logical_not(crosses)
+
+    return outside
+
+
+def _clip_segments_by_polygon(segments, prepared, closed=True,
+                              max_pairs=2 ** 20):
+    """Clip line segments by polygon
+
+    Input:
+       segments: Mx4 array of line segments x0, y0, x1, y1
+       prepared: PreparedPolygon (only the outer ring is used)
+       closed: See clip_line_by_polygon
+       max_pairs: Maximal number of (segment, edge) pairs tested at once
+
+    Output:
+       pieces: Px4 array of pieces x0, y0, x1, y1 obtained by cutting
+       segments where they intersect polygon edges
+       parent: P array with the index of the segment each piece is cut from.
+       Pieces are ordered by parent and then along their parent segment.
+       inside: P boolean array, True for pieces inside polygon
+
+    This is _clip_line_by_polygon vectorised over all segments.
+    Only (segment, edge) pairs which share a horizontal slab of the prepared
+    polygon and have overlapping bounding boxes are intersected.
+    Segments outside the polygon bounding box are not cut.
+    """
 
-        # Call underlying function for one line and one polygon
-        inside, outside = _clip_line_by_polygon(line,
-                                                polygon,
-                                                polygon_segments,
-                                                polygon_bbox,
+    # Segments that need cutting
+    outside_box = _segments_outside_bbox(segments, prepared.bbox)
+    cut = numpy.where(numpy.logical_not(outside_box))[0]
+    uncut = numpy.where(outside_box)[0]
+    x0 = segments[cut, 0]
+    y0 = segments[cut, 1]
+    x1 = segments[cut, 2]
+    y1 = segments[cut, 3]
+
+    # Find all intersection points between segments and polygon edges
+    i, k, u0, _ = _intersect_segments_with_edges(x0, y0, x1, y1,
+                                                 prepared.get_edges(),
+                                                 prepared.get_slab_index(),
+                                                 max_pairs=max_pairs)
+
+    # Points on each segment: End points followed by intersections
+    # in the order of polygon edges
+    number_of_cut = len(cut)
+    point_segment = numpy.concatenate((numpy.arange(number_of_cut),
+                                       numpy.arange(number_of_cut), i))
+    point_order = numpy.concatenate((numpy.zeros(number_of_cut),
+                                     numpy.ones(number_of_cut), 2 + k))
+    x = numpy.concatenate((x0, x1, x0[i] + u0 * (x1[i] - x0[i])))
+    y = numpy.concatenate((y0, y1, y0[i] + u0 * (y1[i] - y0[i])))
+
+    # For each point, compute distance from first end point
+    dx = x - x0[point_segment]
+    dy = y - y0[point_segment]
+    distances = dx * dx + dy * dy
+
+    # Sort points along each segment by distance
+    idx = numpy.lexsort((point_order, distances, point_segment))
+    point_segment = point_segment[idx]
+    distances = distances[idx]
+    x = x[idx]
+    y = y[idx]
+
+    # Remove duplicate points
+    duplicates = numpy.zeros(len(distances), dtype=numpy.bool)
+    duplicates[1:] = ((point_segment[1:] == point_segment[:-1]) *
+                      (distances[1:] == distances[:-1]))
+    keep = numpy.logical_not(duplicates)
+    point_segment = point_segment[keep]
+    x = x[keep]
+    y = y[keep]
+
+    # Consecutive points on the same segment form pieces
+    first = numpy.where(point_segment[1:] == point_segment[:-1])[0]
+    cut_pieces = numpy.zeros((len(first), 4))
+    cut_pieces[:, 0] = x[first]
+    cut_pieces[:, 1] = y[first]
+    cut_pieces[:, 2] = x[first + 1]
+    cut_pieces[:, 3] = y[first + 1]
+
+    # Separate piece midpoints according to polygon
+    # Deliberately ignore boundary as midpoints by definition
+    # are fully inside or fully outside.
+    midpoints = numpy.zeros((len(first), 2))
+    midpoints[:, 0] = (x[first] + x[first + 1]) / 2
+    midpoints[:, 1] = (y[first] + y[first + 1]) / 2
+    cut_inside = numpy.zeros(len(first), dtype=numpy.bool)
+    if len(first) > 0:
+        indices, _ = separate_points_by_polygon(midpoints, prepared,
+                                                check_input=False,
                                                 closed=closed)
+        cut_inside[indices] = True
 
-        # Record clipped line segments from line k
-        inside_line_segments[k] = inside
-        outside_line_segments[k] = outside
+    # Merge with uncut segments which are outside
+    parent = numpy.concatenate((cut[point_segment[first]], uncut))
+    pieces = numpy.concatenate((cut_pieces, segments[uncut]))
+    inside = numpy.concatenate((cut_inside,
+                                numpy.zeros(len(uncut), dtype=numpy.bool)))
+    idx = numpy.argsort(parent, kind='mergesort')
 
-    return inside_line_segments, outside_line_segments
+    return pieces[idx], parent[idx], inside[idx]
+
+
+def _intersect_segments_with_edges(x0, y0, x1, y1, edges, slab_index,
+                                   max_pairs=2 ** 20):
+    """Find all intersections between line segments and indexed edges
+
+    Input:
+       x0, y0, x1, y1: Arrays of K segment end points
+       edges: px_i, py_i, px_j, py_j arrays of E edges as returned by
+       _polygon_edges
+       slab_index: Slab index of edges as returned by _slab_index
+       max_pairs: Maximal number of (segment, edge) pairs tested at once
+
+    Output:
+       i, k: Arrays with indices of intersecting segments and edges,
+       sorted by i and then k
+       u0, u1: Position of each intersection along segment and edge
+
+    Only pairs sharing a slab and having overlapping bounding boxes are
+    intersected using the same formula as intersection().
+    """
+
+    px_i, py_i, px_j, py_j = edges
+    xmin = numpy.minimum(x0, x1)
+    xmax = numpy.maximum(x0, x1)
+    ymin = numpy.minimum(y0, y1)
+    ymax = numpy.maximum(y0, y1)
+
+    segment_indices = [numpy.arange(0)]
+    edge_indices = [numpy.arange(0)]
+    parameters0 = [numpy.zeros(0)]
+    parameters1 = [numpy.zeros(0)]
+    for a, _, local, k in _slab_pairs(ymin, slab_index,
+                                      max_pairs=max_pairs, y_max=ymax):
+        i = a + local
+
+        # Only pairs with overlapping bounding boxes can intersect
+        mask = ((numpy.minimum(px_i[k], px_j[k]) <= xmax[i]) *
+                (numpy.maximum(px_i[k], px_j[k]) >= xmin[i]) *
+                (numpy.minimum(py_i[k], py_j[k]) <= ymax[i]) *
+                (numpy.maximum(py_i[k], py_j[k]) >= ymin[i]))
+        i = i[mask]
+        k = k[mask]
+
+        u0, u1, mask = _intersection_parameters(x0[i], y0[i], x1[i], y1[i],
+                                                px_i[k], py_i[k],
+                                                px_j[k], py_j[k])
+        segment_indices.append(i[mask])
+        edge_indices.append(k[mask])
+        parameters0.append(u0[mask])
+        parameters1.append(u1[mask])
+
+    return (numpy.concatenate(segment_indices),
+            numpy.concatenate(edge_indices),
+            numpy.concatenate(parameters0),
+            numpy.concatenate(parameters1))
+
+
+def _join_pieces_by_line(pieces, piece_line):
+    """Join line segment pieces into lines for each parent line
+
+    Input:
+       pieces: Px4 array of pieces x0, y0, x1, y1 ordered along lines
+       piece_line: P array with index of parent line of each piece (sorted)
+
+    Output:
+       Dictionary of lists of joined lines (as Nx2 arrays) keyed by index of
+       parent line. Only lines with pieces are included.
+    """
+
+    lines = {}
+    if len(piece_line) == 0:
+        return lines
+
+    # Pieces from different parent lines are never joined
+    breaks = piece_line[1:] != piece_line[:-1]
+    joined, first = _join_segment_runs(pieces.reshape((-1, 2, 2)),
+                                       breaks=breaks)
+    for line, k in zip(joined, piece_line[first]):
+        k = int(k)
+        if k in lines:
+            lines[k].append(line)
+        else:
+            lines[k] = [line]
+
+    return lines
 
 
 def clip_line_by_polygon(line, polygon,
@@ -749,7 +1654,8 @@ def clip_line_by_polygon(line, polygon,
        line: Sequence of line nodes: [[x0, y0], [x1, y1], ...] or
         the equivalent Nx2 numpy array
 
-       polygon: list or Nx2 array of polygon vertices
+       polygon: list or Nx2 array of polygon vertices or a PreparedPolygon
+       (of which only the outer ring is used)
 
        closed: (optional) determine whether points on boundary should be
        regarded as belonging to the polygon (closed = True)
@@ -790,6 +1696,14 @@ def clip_line_by_polygon(line, polygon,
        Output line segments are listed as separate lines i.e. not joined
     """
 
+    # Use cached structures if polygon has been prepared
+    prepared = None
+    if isinstance(polygon, PreparedPolygon):
+        prepared = polygon
+        polygon = prepared.outer_ring
+        if polygon_bbox is None:
+            polygon_bbox = prepared.bbox
+
     if check_input:
         # Input checks
         msg = 'Keyword argument "closed" must be boolean'
@@ -841,7 +1755,10 @@ def clip_line_by_polygon(line, polygon,
         maxpy = polygon_bbox[3]
 
     # Convert polygon to segments
-    polygon_segments = polygon2segments(polygon)
+    if prepared is None:
+        polygon_segments = polygon2segments(polygon)
+    else:
+        polygon_segments = prepared.get_segments()
 
     return _clip_line_by_polygon(line,
                                  polygon,
@@ -1032,36 +1949,70 @@ def join_line_segments(segments, rtol=1.0e-12, atol=1.0e-12):
     Output
         list of Nx2 numpy arrays each corresponding to a continuous line
         formed from consecutive segments
-    """
 
-    lines = []
+    Note
+        All consecutive end points are compared in one vectorised test
+        so the cost is linear in the number of segments.
+    """
 
     if len(segments) == 0:
-        return lines
-
-    line = segments[0]
-    for i in range(len(segments) - 1):
-        if numpy.allclose(segments[i][1], segments[i + 1][0],
-                          rtol=rtol, atol=atol):
-            # Segments are adjacent
-            line.append(segments[i + 1][1])
-        else:
-            # Segments are disjoint - current line finishes here
-            lines.append(numpy.array(line))
-            line = segments[i + 1]
+        return []
 
-    # Finish line
-    lines.append(numpy.array(line))
+    segments = ensure_numeric(segments)
+    lines, _ = _join_segment_runs(segments, rtol=rtol, atol=atol)
 
-    # Return
     return lines
 
 
-def line_dictionary_to_geometry(D):
-    """Convert dictionary of lines to list of Nx2 arrays
+def _join_segment_runs(segments, rtol=1.0e-12, atol=1.0e-12, breaks=None):
+    """Join runs of adjacent consecutive line segments
 
     Input
-        D: Dictionary of lines e.g. as produced by clip_lines_by_polygon
+        segments: Nx2x2 array of line segments [[p0, p1], [p2, p3], ...]
+        rtol, atol: Tolerances as used by numpy.allclose
+        breaks: Optional boolean array of length N - 1 which is True where
+        segment i + 1 must not be joined to segment i even if adjacent
+
+    Output
+        lines: list of Nx2 numpy arrays each corresponding to a continuous
+        line formed from consecutive segments
+        first: array with index of first segment in each line
+    """
+
+    N = segments.shape[0]
+    starts = segments[:, 0, :]
+    ends = segments[:, 1, :]
+
+    # Segments are adjacent if the end of one is close to the start of the
+    # next using the same test as numpy.allclose
+    a = ends[:-1]
+    b = starts[1:]
+    adjacent = numpy.all(numpy.abs(a - b) <= atol + rtol * numpy.abs(b),
+                         axis=1)
+    if breaks is not None:
+        adjacent *= numpy.logical_not(breaks)
+
+    # Each line consists of the start of its first segment followed by the
+    # end of each of its segments
+    new_line = numpy.ones(N, dtype=numpy.bool)
+    new_line[1:] = numpy.logical_not(adjacent)
+    first = numpy.where(new_line)[0]
+    line_of_segment = numpy.cumsum(new_line) - 1
+
+    vertices = numpy.zeros((N + len(first), 2), dtype=segments.dtype)
+    vertices[first + numpy.arange(len(first))] = starts[first]
+    vertices[numpy.arange(N) + line_of_segment + 1] = ends
+
+    lines = numpy.split(vertices, (first + numpy.arange(len(first)))[1:])
+
+    return lines, first
+
+
+def line_dictionary_to_geometry(D):
+    """Convert dictionary of lines to list of Nx2 arrays
+
+    Input
+        D: Dictionary of lines e.g. as produced by clip_lines_by_polygon
 
     Output:
         List of Nx2 arrays suitable as geometry input to class Vector
@@ -1085,75 +2036,116 @@ def line_dictionary_to_geometry(D):
 #--------------------------------------------------
 def generate_random_points_in_bbox(polygon, N, seed=None):
     """Generate random points in polygon bounding box
+
+    Points are drawn with numpy.random.RandomState(seed). A given seed
+    therefore gives other points than the random module used earlier.
     """
 
     # Find outer extent of polygon
+    polygon = ensure_numeric(polygon, numpy.float)
     minpx = min(polygon[:, 0])
     maxpx = max(polygon[:, 0])
     minpy = min(polygon[:, 1])
     maxpy = max(polygon[:, 1])
 
-    seed_function(seed)
+    generator = numpy.random.RandomState(seed)
+
+    return _random_points_in_bbox([minpx, maxpx, minpy, maxpy], N,
+                                  generator)
+
+
+def _random_points_in_bbox(bbox, N, generator):
+    """Draw uniformly distributed points in bounding box
 
-    points = []
-    for _ in range(N):
-        x = uniform(minpx, maxpx)
-        y = uniform(minpy, maxpy)
-        points.append([x, y])
+    Input:
+       bbox: Bounding box [minx, maxx, miny, maxy]
+       N: Number of points
+       generator: numpy.random.RandomState instance
+
+    Output:
+       Nx2 array of points
+
+    Random numbers are drawn in one call for x and y of all points in
+    turn. Hence drawing points in several batches from one generator
+    gives the same points as drawing them all at once.
+    """
 
-    return numpy.array(points)
+    minpx, maxpx, minpy, maxpy = bbox
+    points = generator.random_sample((N, 2))
+    points[:, 0] = minpx + (maxpx - minpx) * points[:, 0]
+    points[:, 1] = minpy + (maxpy - minpy) * points[:, 1]
+
+    return points
 
 
-def populate_polygon(polygon, number_of_points, seed=None, exclude=None):
+def populate_polygon(polygon, number_of_points, seed=None, exclude=None,
+                     batch_size=2 ** 18):
     """Populate given polygon with uniformly distributed points.
 
     Input:
-       polygon - list of vertices of polygon
+       polygon - list of vertices of polygon or PreparedPolygon
 
        number_of_points - (optional) number of points
 
-       seed - seed for random number generator (default=None)
+       seed - seed for numpy.random.RandomState (default=None). Seeds
+       give other points than with the random module used earlier.
 
        exclude - list of polygons (inside main polygon) from where points
        should be excluded
 
+       batch_size - (optional) maximal number of random points drawn and
+       tested at once
+
     Output:
        points - list of points inside polygon
 
     Examples:
        populate_polygon( [[0,0], [1,0], [1,1], [0,1]], 5 )
        will return five randomly selected points inside the unit square
-    """
 
-    polygon = ensure_numeric(polygon)
+    Note:
+       Random points are drawn in batches from the polygon bounding box
+       and each batch is tested against the polygon and the exclusions in
+       one call. Batches are sized from the observed acceptance rate.
+       The points returned are the first points accepted in the random
+       sequence, so they are the same as when points are drawn and
+       tested one at a time.
+    """
 
-    # Find outer extent of polygon
-    minpx = min(polygon[:, 0])
-    maxpx = max(polygon[:, 0])
-    minpy = min(polygon[:, 1])
-    maxpy = max(polygon[:, 1])
+    prepared = prepare_polygon(polygon)
+    if exclude is not None:
+        exclude = [prepare_polygon(ex_poly) for ex_poly in exclude]
 
     # Generate random points until enough are in polygon
-    seed_function(seed)
-    points = []
-    while len(points) < number_of_points:
-        x = uniform(minpx, maxpx)
-        y = uniform(minpy, maxpy)
+    generator = numpy.random.RandomState(seed)
+    batches = []
+    count = 0
+    drawn = 0
+    while count < number_of_points:
+        # Estimate number of points needed from acceptance rate so far
+        remaining = number_of_points - count
+        rate = max(float(count) / max(drawn, 1), 0.01)
+        N = min(int(remaining / rate * 1.1) + 16, batch_size)
 
-        append = False
-        if is_inside_polygon([x, y], polygon):
-            append = True
+        points = _random_points_in_bbox(prepared.bbox, N, generator)
+        drawn += N
 
-            #Check exclusions
-            if exclude is not None:
-                for ex_poly in exclude:
-                    if is_inside_polygon([x, y], ex_poly):
-                        append = False
+        indices = inside_polygon(points, prepared, closed=True)
+        points = points[indices]
 
-        if append is True:
-            points.append([x, y])
+        # Check exclusions
+        if exclude is not None:
+            for ex_poly in exclude:
+                indices = outside_polygon(points, ex_poly, closed=True)
+                points = points[indices]
 
-    return points
+        batches.append(points[:remaining])
+        count += len(batches[-1])
+
+    if len(batches) == 0:
+        return []
+
+    return numpy.concatenate(batches).tolist()
 
 
 #------------------------------------
@@ -1228,6 +2220,49 @@ def intersection(line0, line1):
     x3 = line1[1, 0, :]
     y3 = line1[1, 1, :]
 
+    # Only points that lie within given line segments are true intersections
+    u0, _, mask = _intersection_parameters(x0, y0, x1, y1,
+                                           x2, y2, x3, y3)
+
+    # Calculate intersection points
+    x = x0 + u0[mask] * (x1 - x0)
+    y = y0 + u0[mask] * (y1 - y0)
+
+    # Return intersection points as N x 2 array
+    N = line1.shape[2]
+    result = numpy.zeros((N, 2)) * numpy.nan
+    result[mask, 0] = x
+    result[mask, 1] = y
+
+    # Special treatment of return value if line1 was non vectorised
+    if one_point:
+        result = result.reshape(2)
+        if numpy.any(numpy.isnan(result)):
+            return None
+        else:
+            return result
+
+    # Normal return of Nx2 array of intersections (or nan)
+    return result
+
+
+def _intersection_parameters(x0, y0, x1, y1, x2, y2, x3, y3):
+    """Intersect line segments (x0, y0) -> (x1, y1) and (x2, y2) -> (x3, y3)
+
+    Input:
+        x0, y0, x1, y1, x2, y2, x3, y3: Arrays or scalars of segment end
+        points broadcast against each other.
+
+    Output:
+        u0: Position of intersection along first segment so that the
+            intersection point is (x0 + u0 * (x1 - x0), y0 + u0 * (y1 - y0))
+        u1: Position of intersection along second segment
+        mask: Boolean array which is True where segments intersect.
+            Parallel segments are considered not to intersect.
+
+    This is the underlying elementwise computation of intersection()
+    """
+
     # Calculate denominator (lines are parallel if it is 0)
     y3y2 = y3 - y2
     x3x2 = x3 - x2
@@ -1246,35 +2281,352 @@ def intersection(line0, line1):
     # Restore numpy warnings
     numpy.seterr(**original_numpy_settings)
 
-     # Only points that lie within given line segments are true intersections
+    # Only points that lie within given line segments are true intersections
     mask = (0.0 <= u0) * (u0 <= 1.0) * (0.0 <= u1) * (u1 <= 1.0)
 
-    # Calculate intersection points
-    x = x0 + u0[mask] * x1x0
-    y = y0 + u0[mask] * y1y0
+    return u0, u1, mask
 
-    # Return intersection points as N x 2 array
-    N = line1.shape[2]
-    result = numpy.zeros((N, 2)) * numpy.nan
-    result[mask, 0] = x
-    result[mask, 1] = y
 
-    # Special treatment of return value if line1 was non vectorised
-    if one_point:
-        result = result.reshape(2)
-        if numpy.any(numpy.isnan(result)):
-            return None
+def intersections(segments0, segments1, max_pairs=2 ** 20):
+    """Find all intersections between two collections of line segments
+
+    Args:
+        * segments0: K line segments vectorised following the format
+              used by intersection() and polygon2segments()
+              line[0, 0, :] = x0
+              line[0, 1, :] = y0
+              line[1, 0, :] = x1
+              line[1, 1, :] = y1
+        * segments1: E line segments following the same format, e.g.
+              the edges of a polygon as returned by polygon2segments()
+        * max_pairs: (optional) Maximal number of segment pairs tested at
+              once. This caps the size of temporary arrays.
+
+    Returns:
+        * points: Px2 array of intersection points
+        * indices: Px2 array where row (i, j) refers to segment i of
+              segments0 and segment j of segments1. Rows are sorted by
+              i and then j.
+        * parameters: Px2 array where row (u0, u1) is the position of the
+              intersection along segment i and segment j respectively
+              (0 at the first end point and 1 at the second).
+
+    Note:
+        Intersections are computed as by intersection() so the same
+        points are found as by calling intersection() for each segment in
+        segments0. Parallel segments are considered to not intersect.
+
+        Segments in segments1 are sorted into horizontal slabs so only
+        pairs sharing a slab and having overlapping bounding boxes are
+        tested. Pairs are processed in chunks of at most max_pairs.
+    """
+
+    segments0 = ensure_numeric(segments0, numpy.float)
+    segments1 = ensure_numeric(segments1, numpy.float)
+
+    msg = ('Segments must be vectorised as 2x2xN arrays. I got shapes %s '
+           'and %s' % (str(segments0.shape), str(segments1.shape)))
+    if (len(segments0.shape) != 3 or segments0.shape[:2] != (2, 2) or
+            len(segments1.shape) != 3 or segments1.shape[:2] != (2, 2)):
+        raise InaSAFEError(msg)
+
+    x0 = segments0[0, 0, :]
+    y0 = segments0[0, 1, :]
+    x1 = segments0[1, 0, :]
+    y1 = segments0[1, 1, :]
+
+    if segments0.shape[2] == 0 or segments1.shape[2] == 0:
+        i = k = numpy.arange(0)
+        u0 = u1 = numpy.zeros(0)
+    else:
+        edges = (segments1[0, 0, :], segments1[0, 1, :],
+                 segments1[1, 0, :], segments1[1, 1, :])
+        slab_index = _slab_index(edges)
+        i, k, u0, u1 = _intersect_segments_with_edges(x0, y0, x1, y1,
+                                                      edges, slab_index,
+                                                      max_pairs=max_pairs)
+
+    points = numpy.zeros((len(i), 2))
+    points[:, 0] = x0[i] + u0 * (x1[i] - x0[i])
+    points[:, 1] = y0[i] + u0 * (y1[i] - y0[i])
+    indices = numpy.zeros((len(i), 2), dtype=numpy.int)
+    indices[:, 0] = i
+    indices[:, 1] = k
+    parameters = numpy.zeros((len(i), 2))
+    parameters[:, 0] = u0
+    parameters[:, 1] = u1
+
+    return points, indices, parameters
+
+
+#---------------------------------------------
+# Spatial index for points and bounding boxes
+#---------------------------------------------
+class BoundingBoxIndex(object):
+    """Uniform grid index over points or axis aligned bounding boxes.
+
+    The index is built once and can then be queried repeatedly for all
+    items whose bounding box intersects a given bounding box. This allows
+    e.g. a polygon to only consider the points that fall inside its own
+    bounding box rather than the entire point set.
+
+    Args:
+        * items: Either an Nx2 array of point coordinates or an Nx4
+              array of bounding boxes following the format used
+              throughout this module: [minx, maxx, miny, maxy]
+        * items_per_cell: (optional) Average number of items per grid cell
+              used to determine the cell size. Default 16.
+
+    Note:
+        Items are registered in every grid cell they overlap. Boxes that
+        would span a very large number of cells are kept in a separate list
+        which is tested for every query. Items with non finite coordinates
+        never match any query.
+    """
+
+    def __init__(self, items, items_per_cell=16):
+        items = ensure_numeric(items, numpy.float)
+
+        if len(items.shape) == 1 and items.shape[0] == 0:
+            items = numpy.zeros((0, 4))
+
+        msg = ('Items must be either an Nx2 array of points or an Nx4 '
+               'array of bounding boxes. I got shape %s' % str(items.shape))
+        if len(items.shape) != 2 or items.shape[1] not in [2, 4]:
+            raise InaSAFEError(msg)
+
+        if items.shape[1] == 2:
+            # Points are degenerate bounding boxes
+            bboxes = numpy.zeros((items.shape[0], 4))
+            bboxes[:, 0] = bboxes[:, 1] = items[:, 0]
+            bboxes[:, 2] = bboxes[:, 3] = items[:, 1]
         else:
-            return result
+            bboxes = items
+
+        self.bboxes = bboxes
+
+        valid = numpy.isfinite(bboxes).all(axis=1)
+        valid_indices = numpy.where(valid)[0]
+        if len(valid_indices) == 0:
+            # Nothing can ever be found
+            self.extent = None
+            return
+
+        B = bboxes[valid_indices]
+        minx = B[:, 0].min()
+        maxx = B[:, 1].max()
+        miny = B[:, 2].min()
+        maxy = B[:, 3].max()
+        self.extent = [minx, maxx, miny, maxy]
+
+        # Choose cell size so that each cell holds about items_per_cell items
+        # but is not smaller than the typical item.
+        width = maxx - minx
+        height = maxy - miny
+        number_of_cells = max(1, len(B) // items_per_cell)
+        cell_size = numpy.sqrt(width * height / number_of_cells)
+        if not cell_size > 0:
+            # All items fall on a horizontal or vertical line
+            cell_size = max(width, height) / number_of_cells
+        typical_size = numpy.median(numpy.maximum(B[:, 1] - B[:, 0],
+                                                  B[:, 3] - B[:, 2]))
+        cell_size = max(cell_size, typical_size)
+        if not cell_size > 0:
+            # All items coincide
+            cell_size = 1.0
+
+        self.cell_size = cell_size
+        self.nx = int(width / cell_size) + 1
+        self.ny = int(height / cell_size) + 1
+
+        # Cell ranges covered by each item
+        ix0, ix1 = self._cells(B[:, 0], B[:, 1], minx, self.nx)
+        iy0, iy1 = self._cells(B[:, 2], B[:, 3], miny, self.ny)
+        counts_x = ix1 - ix0 + 1
+        counts_y = iy1 - iy0 + 1
+
+        # Items spanning many cells are not registered in the grid
+        large = (counts_x > 8) + (counts_y > 8)
+        small = numpy.logical_not(large)
+        self.large_items = valid_indices[large]
+
+        ix0 = ix0[small]
+        iy0 = iy0[small]
+        counts_x = counts_x[small]
+        counts = counts_x * counts_y[small]
+
+        # Expand each item into the cells it overlaps
+        item = numpy.repeat(valid_indices[small], counts)
+        offsets = numpy.cumsum(counts) - counts
+        k = numpy.arange(len(item)) - numpy.repeat(offsets, counts)
+        counts_x = numpy.repeat(counts_x, counts)
+        cx = numpy.repeat(ix0, counts) + k % counts_x
+        cy = numpy.repeat(iy0, counts) + k // counts_x
+        keys = cy * self.nx + cx
+
+        # Sort items by cell and record where each cell starts
+        order = numpy.argsort(keys, kind='mergesort')
+        self.items = item[order]
+        self.cell_start = numpy.searchsorted(keys[order],
+                                             numpy.arange(self.nx * self.ny
+                                                          + 1))
+
+    def _cells(self, lower, upper, origin, n):
+        """Get range of cell indices covered by intervals along one axis
+        """
+
+        i0 = numpy.floor((lower - origin) / self.cell_size).astype(numpy.int)
+        i1 = numpy.floor((upper - origin) / self.cell_size).astype(numpy.int)
+        i0 = numpy.clip(i0, 0, n - 1)
+        i1 = numpy.clip(i1, 0, n - 1)
+
+        return i0, i1
+
+    def __len__(self):
+        """Number of items in index
+        """
+        return self.bboxes.shape[0]
+
+    def query(self, bbox):
+        """Find items intersecting bounding box
+
+        Args:
+            * bbox: Bounding box [minx, maxx, miny, maxy]
+
+        Returns:
+            * indices: Sorted array of indices of items whose bounding box
+                  intersects bbox (boundaries included)
+        """
+
+        minx, maxx, miny, maxy = [float(x) for x in bbox]
+
+        if (self.extent is None or
+                maxx < self.extent[0] or minx > self.extent[1] or
+                maxy < self.extent[2] or miny > self.extent[3]):
+            return numpy.arange(0)
+
+        ix0, ix1 = self._cells(numpy.array([minx]), numpy.array([maxx]),
+                               self.extent[0], self.nx)
+        iy0, iy1 = self._cells(numpy.array([miny]), numpy.array([maxy]),
+                               self.extent[2], self.ny)
+
+        # Each row of cells maps to one contiguous run of the sorted items
+        rows = numpy.arange(iy0[0], iy1[0] + 1)
+        starts = self.cell_start[rows * self.nx + ix0[0]]
+        ends = self.cell_start[rows * self.nx + ix1[0] + 1]
+        candidates = numpy.concatenate((self.items[_ranges(starts, ends)],
+                                        self.large_items))
+        candidates = numpy.unique(candidates)
+
+        # Keep only those actually intersecting the query box
+        B = self.bboxes[candidates]
+        mask = ((B[:, 0] <= maxx) * (B[:, 1] >= minx) *
+                (B[:, 2] <= maxy) * (B[:, 3] >= miny))
+
+        return candidates[mask]
+
+    def query_points(self, points):
+        """Find items whose bounding box contains each of many points
+
+        Args:
+            * points: Mx2 array of point coordinates
+
+        Returns:
+            * point_indices, item_indices: Arrays of equal length with one
+                  entry for every pair of point and item whose bounding box
+                  contains the point (boundaries included). Pairs are
+                  sorted by point and then item.
+        """
+
+        points = ensure_numeric(points, numpy.float).reshape((-1, 2))
+        x = points[:, 0]
+        y = points[:, 1]
+
+        if self.extent is None:
+            return numpy.arange(0), numpy.arange(0)
+
+        minx, maxx, miny, maxy = self.extent
+        valid = numpy.isfinite(x) * numpy.isfinite(y)
+        valid *= (x >= minx) * (x <= maxx) * (y >= miny) * (y <= maxy)
+        indices = numpy.where(valid)[0]
+
+        # Every point falls in exactly one cell
+        ix, _ = self._cells(x[indices], x[indices], minx, self.nx)
+        iy, _ = self._cells(y[indices], y[indices], miny, self.ny)
+        cells = iy * self.nx + ix
+        starts = self.cell_start[cells]
+        ends = self.cell_start[cells + 1]
+        point_indices = [numpy.repeat(indices, ends - starts)]
+        item_indices = [self.items[_ranges(starts, ends)]]
+
+        # Large items are candidates for all points
+        L = len(self.large_items)
+        if L > 0:
+            point_indices.append(numpy.repeat(indices, L))
+            item_indices.append(numpy.tile(self.large_items, len(indices)))
+
+        point_indices = numpy.concatenate(point_indices)
+        item_indices = numpy.concatenate(item_indices)
+
+        # Keep only those actually containing the point
+        B = self.bboxes[item_indices]
+        xp = x[point_indices]
+        yp = y[point_indices]
+        mask = ((B[:, 0] <= xp) * (B[:, 1] >= xp) *
+                (B[:, 2] <= yp) * (B[:, 3] >= yp))
+        point_indices = point_indices[mask]
+        item_indices = item_indices[mask]
+
+        order = numpy.lexsort((item_indices, point_indices))
+        return point_indices[order], item_indices[order]
+
+
+def _ranges(starts, ends):
+    """Concatenate integer ranges [start, end) without looping in Python
 
-    # Normal return of Nx2 array of intersections (or nan)
-    return result
+    Args:
+        * starts: Array of range starts
+        * ends: Array of range ends (exclusive)
+
+    Returns:
+        * indices: Array with all integers in each range in order
+    """
+
+    lengths = ends - starts
+    lengths[lengths < 0] = 0
+    total = lengths.sum()
+    if total == 0:
+        return numpy.arange(0)
+
+    offsets = numpy.cumsum(lengths) - lengths
+    return (numpy.repeat(starts - offsets, lengths) +
+            numpy.arange(total))
+
+
+def _bincount(indices, weights=None, minlength=0):
+    """Count indices (or sum their weights) like numpy.bincount
+
+    Args:
+        * indices: Array of non negative integers
+        * weights: Optional array of weights for each index
+        * minlength: Minimal length of the result. May be 0 which older
+              versions of numpy.bincount do not accept.
+
+    Returns:
+        * Array with count or sum of weights for each integer
+    """
+
+    counts = numpy.bincount(indices, weights=weights,
+                            minlength=max(minlength, 1))
+    if len(indices) == 0:
+        counts = counts[:minlength]
+    return counts
 
 
 # Main functions for polygon clipping
 # FIXME (Ole): Both can be rigged to return points or lines
 # outside any polygon by adding that as the entry in the list returned
-def clip_grid_by_polygons(A, geotransform, polygons):
+def clip_grid_by_polygons(A, geotransform, polygons, processes=None):
     """Clip raster grid by polygon.
 
     Args:
@@ -1282,7 +2634,11 @@ def clip_grid_by_polygons(A, geotransform, polygons):
         * geotransform: 6-tuple used to locate A geographically
             (top left x, w-e pixel resolution, rotation,
             top left y, rotation, n-s pixel resolution)
-        * polygons: list of polygon geometry objects or list of polygon arrays
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or list of PreparedPolygon instances
+        * processes: (optional) Number of worker processes. If larger than
+            1, polygons are rasterised in parallel by a pool of processes.
+            Results are identical to those of a single process.
 
     Returns:
         points_covered: List of (points, values) - one per input polygon.
@@ -1297,52 +2653,297 @@ def clip_grid_by_polygons(A, geotransform, polygons):
 
         If multiple polygons overlap, the one first encountered will be used.
 
+        Polygons are rasterised directly in pixel space using
+        grid_indices_inside_polygon so coordinates are only created for
+        grid points inside polygons. Points for each polygon are listed in
+        the row-major order of A.
+
     """
 
-    # Convert raster grid to Nx2 array of points and an N array of pixel values
+    # Get coordinate axes of raster grid and flat view of pixel values
     ny, nx = A.shape
     x, y = geotransform_to_axes(geotransform, nx, ny)
-    points, values = grid_to_points(A, x, y)
+    values = A.reshape(-1)
 
     # Generate list of points and values that fall inside each polygon
     points_covered = []
-    remaining_points = points
-    remaining_values = values
+    for indices in _grid_indices_by_polygons(polygons, x, y, processes):
+        # Add features inside this polygon
+        points = numpy.zeros((len(indices), 2))
+        points[:, 0] = x[indices % nx]
+        points[:, 1] = y[ny - 1 - indices // nx]
+        points_covered.append((points, values[indices]))
 
-    for polygon in polygons:
-        #print 'Remaining points', len(remaining_points)
+    return points_covered
 
-        if hasattr(polygon, 'outer_ring'):
-            outer_ring = polygon.outer_ring
-            inner_rings = polygon.inner_rings
-        else:
-            # Assume it is an array
-            outer_ring = polygon
-            inner_rings = None
-
-        inside, outside = in_and_outside_polygon(remaining_points,
-                                                 outer_ring,
-                                                 holes=inner_rings,
-                                                 closed=True,
-                                                 check_input=False)
-        # Add features inside this polygon
-        points_covered.append((remaining_points[inside],
-                               remaining_values[inside]))
 
-        # Select remaining points to clip
-        remaining_points = remaining_points[outside]
-        remaining_values = remaining_values[outside]
+def label_grid_by_polygons(geotransform, columns, rows, polygons,
+                           processes=None):
+    """Label raster grid cells by the polygon they fall in.
 
-    return points_covered
+    Args:
+        * geotransform: 6-tuple locating the grid geographically
+            (top left x, w-e pixel resolution, rotation,
+            top left y, rotation, n-s pixel resolution)
+        * columns: Number of grid cells in the w-e direction
+        * rows: Number of grid cells in the n-s direction
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or list of PreparedPolygon instances
+        * processes: (optional) Number of worker processes as for
+            clip_grid_by_polygons
+
+    Returns:
+        labels: rows x columns integer array aligned with the grid. Each
+            element is the index of the polygon containing the centre of
+            that grid cell or -1 if no polygon contains it.
+
+    Note:
+        Grid cells are assigned exactly as by clip_grid_by_polygons, i.e.
+        if multiple polygons overlap, the one first encountered will be
+        used. As only one integer is stored per grid cell this is suitable
+        for grids too large to be converted to points.
+    """
+
+    x, y = geotransform_to_axes(geotransform, columns, rows)
 
+    labels = numpy.empty(rows * columns, dtype=numpy.int)
+    labels[:] = -1
+    for i, indices in enumerate(_grid_indices_by_polygons(polygons, x, y,
+                                                          processes)):
+        labels[indices] = i
+
+    return labels.reshape((rows, columns))
+
+
+def _grid_indices_by_polygons(polygons, x, y, processes):
+    """Find grid points inside each of a sequence of polygons
+
+    Input:
+        polygons: List of polygons accepted by prepare_polygon
+        x, y: Increasing arrays of grid point coordinates
+        processes: Number of worker processes or None
 
-def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
+    Output:
+        Generator of sorted index arrays, one per polygon, as returned by
+        grid_indices_inside_polygon. Grid points already inside previous
+        polygons are left out.
+    """
+
+    nx = len(x)
+    ny = len(y)
+
+    # Find grid points inside each polygon
+    polygons = [prepare_polygon(polygon) for polygon in polygons]
+    if processes is not None and processes > 1 and len(polygons) > 1:
+        state = {'polygons': polygons, 'x': x, 'y': y}
+        polygon_indices = _map_in_processes(_grid_indices_of_polygon,
+                                            range(len(polygons)),
+                                            processes, state)
+    else:
+        polygon_indices = (grid_indices_inside_polygon(polygon, x, y,
+                                                       closed=True)
+                           for polygon in polygons)
+
+    covered = numpy.zeros(nx * ny, dtype=numpy.bool)
+    for indices in polygon_indices:
+        # Leave out grid points already covered by previous polygons
+        indices = indices[numpy.logical_not(covered[indices])]
+        covered[indices] = True
+
+        yield indices
+
+
+def _grid_indices_of_polygon(i):
+    """Worker finding grid points inside polygon i of shared state
+    """
+
+    state = _WORKER_STATE
+    return grid_indices_inside_polygon(state['polygons'][i],
+                                       state['x'], state['y'], closed=True)
+
+
+def grid_indices_inside_polygon(polygon, x, y, closed=True):
+    """Find grid points inside polygon by scanline rasterisation
+
+    Args:
+        * polygon: list or Nx2 array of polygon vertices, polygon geometry
+              object or PreparedPolygon. Inner rings are treated as holes.
+        * x: Increasing array of grid point longitudes (west->east)
+        * y: Increasing array of grid point latitudes (south->north)
+        * closed: (optional) determine whether grid points on boundary
+              should be regarded as belonging to the polygon (closed = True)
+              or not (closed = False).
+
+    Returns:
+        * indices: Sorted array of indices of grid points inside polygon.
+              Indices refer to points in the order made by
+              grid_to_points(A, x, y), i.e. the row-major order of A
+              starting with the northernmost row.
+
+    Note:
+        Grid points are classified exactly as in_and_outside_polygon
+        classifies the points made by grid_to_points. However, the polygon
+        is rasterised one row at a time by finding the crossings of its
+        edges with each row of grid points. Coordinates of all grid points
+        are never created and the cost is proportional to the polygon
+        perimeter (in pixels) and the number of grid points found.
+    """
+
+    prepared = prepare_polygon(polygon)
+    x = ensure_numeric(x, numpy.float)
+    y = ensure_numeric(y, numpy.float)
+
+    # Points on boundary of holes are inside polygon if closed is True
+    indices = _grid_indices_inside_ring(prepared, x, y, closed)
+    for hole in prepared.inner_rings:
+        in_hole = _grid_indices_inside_ring(hole, x, y, not closed)
+        indices = numpy.setdiff1d(indices, in_hole)
+
+    return indices
+
+
+def _grid_indices_inside_ring(prepared, x, y, closed):
+    """Find grid points inside outer ring of prepared polygon
+
+    Input:
+       prepared: PreparedPolygon (inner rings are ignored)
+       x, y: Increasing arrays of grid point coordinates
+       closed: Whether points on boundary are inside (True), outside (False)
+       or undefined (None)
+
+    Output:
+       Sorted array of indices of grid points inside as returned by
+       grid_indices_inside_polygon
+    """
+
+    nx = len(x)
+    ny = len(y)
+    minpx, maxpx, minpy, maxpy = prepared.bbox
+    px_i, py_i, px_j, py_j = prepared.get_edges()
+
+    # Only grid points inside polygon bounding box are considered
+    col0 = numpy.searchsorted(x, minpx, side='left')
+    col1 = numpy.searchsorted(x, maxpx, side='right')
+    row0 = numpy.searchsorted(y, minpy, side='left')
+    row1 = numpy.searchsorted(y, maxpy, side='right')
+
+    # Rows crossed by each edge according to the edge crossing
+    # formula, i.e. min(py_i, py_j) < y <= max(py_i, py_j)
+    first = numpy.searchsorted(y, numpy.minimum(py_i, py_j), side='right')
+    last = numpy.searchsorted(y, numpy.maximum(py_i, py_j), side='right')
+    first = numpy.maximum(first, row0)
+    last = numpy.minimum(last, row1)
+    row = _ranges(first, last)
+    edge = numpy.repeat(numpy.arange(len(px_i)),
+                        numpy.maximum(last - first, 0))
+
+    # Edge crossing formula as in _separate_points_by_polygon
+    yr = y[row]
+    sigma = ((yr - py_i[edge]) / (py_j[edge] - py_i[edge]) *
+             (px_j[edge] - px_i[edge]))
+    crossings = px_i[edge] + sigma
+
+    # A point is inside if an odd number of crossings is to its west.
+    # Every row has an even number of crossings so after sorting them
+    # points between crossing 2m and 2m + 1 are inside.
+    idx = numpy.lexsort((crossings, row))
+    row = row[idx[0::2]]
+    crossings = crossings[idx]
+    start = numpy.searchsorted(x, crossings[0::2], side='right')
+    end = numpy.searchsorted(x, crossings[1::2], side='right')
+    start = numpy.clip(start, col0, col1)
+    end = numpy.clip(end, col0, col1)
+    runs = numpy.maximum(end - start, 0)
+    indices = ((ny - 1 - numpy.repeat(row, runs)) * nx +
+               _ranges(start, end))
+
+    if closed is None:
+        indices.sort()
+        return indices
+
+    # Find points on polygon boundary
+    on_boundary = _grid_indices_on_edges(prepared.get_edges(), x, y,
+                                         prepared.bbox)
+    if closed:
+        return numpy.union1d(indices, on_boundary)
+    else:
+        return numpy.setdiff1d(indices, on_boundary)
+
+
+def _grid_indices_on_edges(edges, x, y, bbox):
+    """Find grid points on polygon edges
+
+    Input:
+       edges: px_i, py_i, px_j, py_j as returned by _polygon_edges
+       x, y: Increasing arrays of grid point coordinates
+       bbox: Polygon bounding box. Only grid points inside are considered.
+
+    Output:
+       Array of indices of grid points on edges as returned by
+       grid_indices_inside_polygon (possibly with repetitions)
+
+    Note:
+       Only grid points next to where each edge crosses each row are
+       tested with _points_on_edges using zero tolerances as done in
+       _separate_points_by_polygon.
+    """
+
+    nx = len(x)
+    ny = len(y)
+    px_i, py_i, px_j, py_j = edges
+
+    # Rows near each edge
+    first = numpy.searchsorted(y, numpy.minimum(py_i, py_j), side='left')
+    last = numpy.searchsorted(y, numpy.maximum(py_i, py_j), side='right')
+    first = numpy.maximum(first - 1, 0)
+    last = numpy.minimum(last + 1, ny)
+    row = _ranges(first, last)
+    edge = numpy.repeat(numpy.arange(len(px_i)),
+                        numpy.maximum(last - first, 0))
+
+    # Range of x where each edge crosses each row.
+    # Horizontal edges cover their entire x range
+    x0 = px_i[edge]
+    y0 = py_i[edge]
+    x1 = px_j[edge]
+    y1 = py_j[edge]
+    horizontal = y0 == y1
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+    xc = x0 + (y[row] - y0) / (y1 - y0) * (x1 - x0)
+    numpy.seterr(**original_numpy_settings)
+    lower = numpy.where(horizontal, numpy.minimum(x0, x1), xc)
+    upper = numpy.where(horizontal, numpy.maximum(x0, x1), xc)
+
+    # Candidate grid points in and next to that range
+    start = numpy.searchsorted(x, lower, side='left') - 1
+    end = numpy.searchsorted(x, upper, side='right') + 1
+    start = numpy.clip(start, 0, nx)
+    end = numpy.clip(end, 0, nx)
+    counts = numpy.maximum(end - start, 0)
+    col = _ranges(start, end)
+    pair = numpy.repeat(numpy.arange(len(row)), counts)
+    row = row[pair]
+
+    xp = x[col]
+    yp = y[row]
+    on_edge = _points_on_edges(xp, yp,
+                               x0[pair], y0[pair], x1[pair], y1[pair],
+                               rtol=0.0, atol=0.0)
+    on_edge *= ((xp >= bbox[0]) * (xp <= bbox[1]) *
+                (yp >= bbox[2]) * (yp <= bbox[3]))
+
+    return (ny - 1 - row[on_edge]) * nx + col[on_edge]
+
+
+def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True,
+                           only_intersecting=False):
     """Clip multiple lines by multiple polygons
 
     Args:
         * lines: Sequence of polylines: [[p0, p1, ...], [q0, q1, ...], ...]
             where pi and qi are point coordinates (x, y).
-        * polygons: list of polygons, each an array of vertices
+        * polygons: list of polygons, each an array of vertices or a
+            PreparedPolygon
         * closed: optional parameter to determine whether lines that fall on
             an polygon boundary should be considered to be inside
             (closed=True), outside (closed=False) or
@@ -1350,14 +2951,25 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
             algorithm up but lines on boundaries may or may not be
             deemed to fall inside the polygon and so will be
             indeterministic.
+        * only_intersecting: optional parameter. If True, lines not
+            intersecting a polygon are left out of its dictionary. This
+            saves time and memory for many lines and polygons.
+            Default False.
 
     Returns:
         lines_covered: List of polylines inside a polygon -o ne per input
-        polygon.
+        polygon. Each element is a dictionary of lists of lines keyed by
+        the index of the line they were clipped from. Lines not intersecting
+        the polygon have an empty list unless only_intersecting is True.
 
 
     .. note:: If multiple polygons overlap, the one first encountered will be
         used.
+
+        All line segments are put in a spatial index once so each polygon
+        only clips the segments near its bounding box. The cost is therefore
+        roughly proportional to the size of the output rather than the number
+        of lines times the number of polygons.
     """
 
     if check_input:
@@ -1374,6 +2986,9 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
                 raise RuntimeError(msg)
 
         for i in range(len(polygons)):
+            if isinstance(polygons[i], PreparedPolygon):
+                continue
+
             try:
                 polygons[i] = ensure_numeric(polygons[i], numpy.float)
             except Exception, e:
@@ -1383,39 +2998,602 @@ def clip_lines_by_polygons(lines, polygons, check_input=True, closed=True):
 
     # Initialise structures
     lines_covered = []
-    remaining_lines = lines
+
+    # Build spatial index over all line segments
+    segments, segment_line, _ = _line_segments(lines)
+    bboxes = numpy.zeros((len(segments), 4))
+    bboxes[:, 0] = numpy.minimum(segments[:, 0], segments[:, 2])
+    bboxes[:, 1] = numpy.maximum(segments[:, 0], segments[:, 2])
+    bboxes[:, 2] = numpy.minimum(segments[:, 1], segments[:, 3])
+    bboxes[:, 3] = numpy.maximum(segments[:, 1], segments[:, 3])
+    segment_index = BoundingBoxIndex(bboxes)
 
     # Clip lines to polygons
     for polygon in polygons:
-    #for i, polygon in enumerate(polygons):
-        #print ('Doing polygon %i (%i vertices) of %i with '
-        #       '%i lines' % (i, len(polygon),
-        #                     len(polygons),
-        #                     len(remaining_lines)))
-        inside_lines, _ = clip_lines_by_polygon(remaining_lines,
-                                                polygon,
-                                                check_input=False)
-        #print ('- %i segments were inside'
-        #       % len(line_dictionary_to_geometry(inside_lines)))
+        prepared = prepare_polygon(polygon)
+
+        # Only segments near polygon can have pieces inside it
+        candidates = segment_index.query(prepared.bbox)
+        pieces, parent, inside = _clip_segments_by_polygon(
+            segments[candidates], prepared, closed=closed)
 
         # Record lines inside this polygon
+        piece_line = segment_line[candidates[parent[inside]]]
+        inside_lines = _join_pieces_by_line(pieces[inside], piece_line)
+        if not only_intersecting:
+            for k in range(len(lines)):
+                if k not in inside_lines:
+                    inside_lines[k] = []
         lines_covered.append(inside_lines)
 
-        # Use lines outside as remaining lines
-        # FIXME (Ole): This optimisation needs some thought
-        # as lines are often partially clipped. We also need to keep
-        # track of the parent line to get its attributes if we want
-        # to go down this road
-        #remaining_lines = outside_lines
+        # FIXME (Ole): Using lines outside as remaining lines needs
+        # some thought as lines are often partially clipped. We also need
+        # to keep track of the parent line to get its attributes if we
+        # want to go down this road
 
     return lines_covered
 
 
+def polygon_intersection_areas(polygons, clip_polygons,
+                               max_polygons=2 ** 12):
+    """Calculate areas of intersection between two collections of polygons
+
+    Args:
+        * polygons: list of polygon geometry objects, list of polygon arrays
+            or list of PreparedPolygon instances, e.g. building footprints.
+            Inner rings are treated as holes.
+        * clip_polygons: list of polygons in the same format, e.g. hazard
+            zones
+        * max_polygons: (optional) Maximal number of polygons intersected
+            with one clip polygon at a time. This caps the size of
+            temporary arrays.
+
+    Returns:
+        * indices: Px2 array where row (i, j) refers to polygon i and
+              clip polygon j. Only pairs with a positive area of
+              intersection are included. Rows are sorted by j and then i.
+        * areas: Array of the P areas of intersection
+        * polygon_areas: Array with the area of each polygon in polygons
+
+    Note:
+        The area of intersection is obtained exactly (up to rounding) by
+        Green's theorem as a sum over the boundary of the intersection.
+        That boundary consists of the pieces of each polygon boundary that
+        lie inside the other polygon. Boundaries are split where they
+        intersect or overlap and each piece is classified by testing
+        points just beside it. Edges shared by both polygons are therefore
+        counted once.
+
+        Polygons are put in a spatial index once so each clip polygon only
+        considers polygons near its bounding box. Polygons may be listed
+        clockwise or counterclockwise and need not be convex.
+    """
+
+    polygons = [prepare_polygon(polygon) for polygon in polygons]
+    clip_polygons = [prepare_polygon(polygon) for polygon in clip_polygons]
+    N = len(polygons)
+
+    # Oriented edges of all polygons
+    all_edges, counts = _oriented_edges(polygons)
+    edge_end = numpy.cumsum(counts)
+    edge_start = edge_end - counts
+    px_i, py_i, px_j, py_j = all_edges
+
+    owner = numpy.repeat(numpy.arange(N), counts)
+    polygon_areas = _bincount(owner,
+                             weights=px_i * py_j - px_j * py_i,
+                             minlength=N) / 2
+
+    bboxes = numpy.array([polygon.bbox for polygon in polygons],
+                         dtype=numpy.float).reshape((N, 4))
+    polygon_index = BoundingBoxIndex(bboxes)
+
+    result_indices = [numpy.zeros((0, 2), dtype=numpy.int)]
+    result_areas = [numpy.zeros(0)]
+    for j, clip_polygon in enumerate(clip_polygons):
+        candidates = polygon_index.query(clip_polygon.bbox)
+        if len(candidates) == 0:
+            continue
+
+        clip_edges, _ = _oriented_edges([clip_polygon])
+        clip_slab_index = _slab_index(clip_edges)
+
+        # Chunks of candidates are made compact by sorting them from
+        # south to north. Each chunk then only meets a few clip edges.
+        order = numpy.argsort(bboxes[candidates, 2], kind='mergesort')
+        for start in xrange(0, len(candidates), max_polygons):
+            chunk = numpy.sort(candidates[order[start:start +
+                                                max_polygons]])
+            k = _ranges(edge_start[chunk], edge_end[chunk])
+            areas = _intersection_areas(tuple(e[k] for e in all_edges),
+                                        counts[chunk], bboxes[chunk],
+                                        clip_edges, clip_slab_index)
+
+            # Rounding must not take areas beyond their bounds
+            areas = numpy.minimum(areas, polygon_areas[chunk])
+            mask = areas > 0
+
+            indices = numpy.zeros((mask.sum(), 2), dtype=numpy.int)
+            indices[:, 0] = chunk[mask]
+            indices[:, 1] = j
+            result_indices.append(indices)
+            result_areas.append(areas[mask])
+
+    indices = numpy.concatenate(result_indices)
+    areas = numpy.concatenate(result_areas)
+    order = numpy.lexsort((indices[:, 0], indices[:, 1]))
+
+    return indices[order], areas[order], polygon_areas
+
+
+def _oriented_edges(polygons):
+    """Get edges of all rings of polygons with their interior on the left
+
+    Input:
+        polygons: List of PreparedPolygon instances
+
+    Output:
+        edges: px_i, py_i, px_j, py_j arrays with the edges of each polygon
+        in turn. The edges of its outer ring are counterclockwise and
+        followed by the edges of its inner rings which are clockwise.
+        counts: Array with the number of edges of each polygon
+    """
+
+    rings = []
+    is_outer = []
+    ring_polygon = []
+    for i, polygon in enumerate(polygons):
+        rings.append(polygon.outer_ring)
+        is_outer.append(True)
+        ring_polygon.append(i)
+        for hole in polygon.inner_rings:
+            rings.append(hole.outer_ring)
+            is_outer.append(False)
+            ring_polygon.append(i)
+
+    if len(rings) == 0:
+        edges = tuple(numpy.zeros(0) for c in range(4))
+        return edges, numpy.zeros(len(polygons), dtype=numpy.int)
+
+    # Each vertex starts an edge ending at the next vertex of its ring
+    sizes = numpy.array([len(ring) for ring in rings], dtype=numpy.int)
+    ring_end = numpy.cumsum(sizes)
+    vertices = numpy.concatenate(rings)
+    following = numpy.arange(len(vertices)) + 1
+    following[ring_end - 1] = ring_end - sizes
+
+    px_i = vertices[:, 0]
+    py_i = vertices[:, 1]
+    px_j = px_i[following]
+    py_j = py_i[following]
+
+    # Reverse edges of rings with the wrong orientation
+    ring = numpy.repeat(numpy.arange(len(rings)), sizes)
+    signed_areas = _bincount(ring, weights=px_i * py_j - px_j * py_i,
+                            minlength=len(rings))
+    reverse = (signed_areas > 0) != numpy.array(is_outer)
+    reverse = reverse[ring]
+    px_i, px_j = (numpy.where(reverse, px_j, px_i),
+                  numpy.where(reverse, px_i, px_j))
+    py_i, py_j = (numpy.where(reverse, py_j, py_i),
+                  numpy.where(reverse, py_i, py_j))
+
+    counts = _bincount(numpy.array(ring_polygon)[ring],
+                      minlength=len(polygons))
+
+    return (px_i, py_i, px_j, py_j), counts
+
+
+def _intersection_areas(edges, counts, bboxes, clip_edges, clip_slab_index):
+    """Calculate areas of intersection between polygons and one clip polygon
+
+    Input:
+        edges: px_i, py_i, px_j, py_j arrays with the oriented edges of M
+            polygons as made by _oriented_ring_edges and concatenated
+        counts: Number of edges of each polygon
+        bboxes: Mx4 array of polygon bounding boxes
+        clip_edges: Oriented edges of the clip polygon
+        clip_slab_index: Slab index of clip_edges
+
+    Output:
+        Array of M areas of intersection
+    """
+
+    M = len(counts)
+    edge_end = numpy.cumsum(counts)
+    edge_start = edge_end - counts
+    owner = numpy.repeat(numpy.arange(M), counts)
+    x0, y0, x1, y1 = edges
+
+    # Polygons away from the clip boundary are either inside or outside
+    # the clip polygon as a whole
+    near = _near_boxes(bboxes, _edge_bboxes(clip_edges))
+    far = numpy.where(numpy.logical_not(near))[0]
+    areas = numpy.zeros(M)
+    if len(far) > 0:
+        k = edge_start[far]
+        inside = _crossing_parity(x0[k], y0[k], clip_edges, clip_slab_index)
+        k = _ranges(edge_start[far], edge_end[far])
+        areas[far] = _bincount(owner[k],
+                              weights=x0[k] * y1[k] - x1[k] * y0[k],
+                              minlength=M)[far] * inside
+
+    near = numpy.where(near)[0]
+    if len(near) == 0:
+        return areas / 2
+
+    k = _ranges(edge_start[near], edge_end[near])
+    edges = tuple(e[k] for e in edges)
+    counts = counts[near]
+    bboxes = bboxes[near]
+    areas[near] = _boundary_areas(edges, counts, bboxes,
+                                  clip_edges, clip_slab_index)
+
+    return areas / 2
+
+
+def _boundary_areas(edges, counts, bboxes, clip_edges, clip_slab_index):
+    """Calculate twice the areas of intersection with one clip polygon
+
+    Input:
+        As for _intersection_areas
+
+    Output:
+        Array of M doubled areas of intersection
+    """
+
+    M = len(counts)
+    edge_end = numpy.cumsum(counts)
+    edge_start = edge_end - counts
+    owner = numpy.repeat(numpy.arange(M), counts)
+
+    # Pieces of polygon boundaries with the clip polygon on their left
+    x0, y0, x1, y1 = edges
+    segment, u = _split_parameters(x0, y0, x1, y1,
+                                   clip_edges, clip_slab_index)
+    piece, xa, ya, xb, yb = _split_segments(x0, y0, x1, y1, segment, u)
+    xl, yl = _offset_midpoints(xa, ya, xb, yb, 1)
+    inside = _crossing_parity(xl, yl, clip_edges, clip_slab_index)
+    areas = _bincount(owner[piece],
+                     weights=(xa * yb - xb * ya) * inside,
+                     minlength=M)
+
+    # Pieces of the clip boundary strictly inside each polygon. Only clip
+    # edges near the polygons are considered.
+    cx0, cy0, cx1, cy1 = clip_edges
+    near = _near_boxes(_edge_bboxes(clip_edges), bboxes)
+    cx0 = cx0[near]
+    cy0 = cy0[near]
+    cx1 = cx1[near]
+    cy1 = cy1[near]
+
+    segment, u = _split_parameters(cx0, cy0, cx1, cy1,
+                                   edges, _slab_index(edges))
+    _, xa, ya, xb, yb = _split_segments(cx0, cy0, cx1, cy1, segment, u)
+
+    midpoints = numpy.zeros((len(xa), 2))
+    midpoints[:, 0] = (xa + xb) / 2
+    midpoints[:, 1] = (ya + yb) / 2
+    piece, polygon = BoundingBoxIndex(bboxes).query_points(midpoints)
+    xa = xa[piece]
+    ya = ya[piece]
+    xb = xb[piece]
+    yb = yb[piece]
+
+    # Both sides of the piece must be inside the polygon
+    inside = numpy.ones(len(piece), dtype=numpy.bool)
+    for side in [1, -1]:
+        xs, ys = _offset_midpoints(xa, ya, xb, yb, side)
+        inside *= _crossing_parity_by_polygon(xs, ys, polygon, edges,
+                                              edge_start, edge_end)
+    areas += _bincount(polygon,
+                      weights=(xa * yb - xb * ya) * inside,
+                      minlength=M)
+
+    return areas
+
+
+def _edge_bboxes(edges):
+    """Get bounding boxes [minx, maxx, miny, maxy] of edges as an Nx4 array
+    """
+
+    px_i, py_i, px_j, py_j = edges
+    bboxes = numpy.zeros((len(px_i), 4))
+    bboxes[:, 0] = numpy.minimum(px_i, px_j)
+    bboxes[:, 1] = numpy.maximum(px_i, px_j)
+    bboxes[:, 2] = numpy.minimum(py_i, py_j)
+    bboxes[:, 3] = numpy.maximum(py_i, py_j)
+
+    return bboxes
+
+
+def _near_boxes(bboxes, other_bboxes, resolution=256):
+    """Flag bounding boxes that may intersect any of another set of boxes
+
+    Input:
+        bboxes: Nx4 array of bounding boxes [minx, maxx, miny, maxy]
+        other_bboxes: Mx4 array of bounding boxes
+        resolution: Number of grid cells along each axis
+
+    Output:
+        Boolean array of N flags. Boxes flagged False intersect none of the
+        other boxes. Boxes flagged True share a grid cell with at least
+        one of them.
+
+    Note:
+        The other boxes are rasterised onto a grid over their extent and
+        each box is tested against the covered cells it overlaps using a
+        summed area table.
+    """
+
+    N = bboxes.shape[0]
+    if N == 0 or other_bboxes.shape[0] == 0:
+        return numpy.zeros(N, dtype=numpy.bool)
+
+    minx = other_bboxes[:, 0].min()
+    maxx = other_bboxes[:, 1].max()
+    miny = other_bboxes[:, 2].min()
+    maxy = other_bboxes[:, 3].max()
+    dx = max(maxx - minx, 1.0e-12) / resolution
+    dy = max(maxy - miny, 1.0e-12) / resolution
+
+    def cells(lower, upper, origin, size):
+        i0 = numpy.floor((lower - origin) / size)
+        i1 = numpy.floor((upper - origin) / size)
+        i0 = numpy.clip(i0, 0, resolution - 1).astype(numpy.int)
+        i1 = numpy.clip(i1, 0, resolution - 1).astype(numpy.int)
+        return i0, i1
+
+    # Mark cells covered by other boxes using a two dimensional
+    # difference array
+    ix0, ix1 = cells(other_bboxes[:, 0], other_bboxes[:, 1], minx, dx)
+    iy0, iy1 = cells(other_bboxes[:, 2], other_bboxes[:, 3], miny, dy)
+    n = resolution + 1
+    difference = numpy.zeros(n * n)
+    for iy, ix, sign in [(iy0, ix0, 1), (iy0, ix1 + 1, -1),
+                         (iy1 + 1, ix0, -1), (iy1 + 1, ix1 + 1, 1)]:
+        difference += sign * numpy.bincount(iy * n + ix, minlength=n * n)
+    difference = difference.reshape((n, n))
+    covered = numpy.cumsum(numpy.cumsum(difference, axis=0), axis=1) > 0
+
+    # Count covered cells within the cell range of each box
+    table = numpy.zeros((n, n), dtype=numpy.int)
+    table[1:, 1:] = numpy.cumsum(numpy.cumsum(covered[:-1, :-1], axis=0),
+                                 axis=1)
+    ix0, ix1 = cells(bboxes[:, 0], bboxes[:, 1], minx, dx)
+    iy0, iy1 = cells(bboxes[:, 2], bboxes[:, 3], miny, dy)
+    count = (table[iy1 + 1, ix1 + 1] - table[iy0, ix1 + 1] -
+             table[iy1 + 1, ix0] + table[iy0, ix0])
+
+    # Boxes beyond the extent of the other boxes are never near
+    outside = ((bboxes[:, 1] < minx) + (bboxes[:, 0] > maxx) +
+               (bboxes[:, 3] < miny) + (bboxes[:, 2] > maxy))
+
+    return (count > 0) * numpy.logical_not(outside)
+
+
+def _split_parameters(x0, y0, x1, y1, edges, slab_index,
+                      max_pairs=2 ** 20):
+    """Find where line segments must be split by intersecting edges
+
+    Input:
+       x0, y0, x1, y1: Arrays of K segment end points
+       edges: px_i, py_i, px_j, py_j arrays of edges
+       slab_index: Slab index of edges as returned by _slab_index
+       max_pairs: Maximal number of (segment, edge) pairs tested at once
+
+    Output:
+       segment, u: Arrays with segment indices and positions along those
+       segments where they intersect an edge. Segments overlapping a
+       collinear edge are also split where the end points of the edge
+       fall inside them.
+    """
+
+    px_i, py_i, px_j, py_j = edges
+    xmin = numpy.minimum(x0, x1)
+    xmax = numpy.maximum(x0, x1)
+    ymin = numpy.minimum(y0, y1)
+    ymax = numpy.maximum(y0, y1)
+
+    segments = [numpy.arange(0)]
+    parameters = [numpy.zeros(0)]
+    if len(x0) == 0 or len(px_i) == 0:
+        return segments[0], parameters[0]
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    for a, _, local, k in _slab_pairs(ymin, slab_index,
+                                      max_pairs=max_pairs, y_max=ymax):
+        i = a + local
+
+        # Only pairs with overlapping bounding boxes can intersect
+        mask = ((numpy.minimum(px_i[k], px_j[k]) <= xmax[i]) *
+                (numpy.maximum(px_i[k], px_j[k]) >= xmin[i]) *
+                (numpy.minimum(py_i[k], py_j[k]) <= ymax[i]) *
+                (numpy.maximum(py_i[k], py_j[k]) >= ymin[i]))
+        i = i[mask]
+        k = k[mask]
+
+        u0, _, mask = _intersection_parameters(x0[i], y0[i], x1[i], y1[i],
+                                               px_i[k], py_i[k],
+                                               px_j[k], py_j[k])
+        segments.append(i[mask])
+        parameters.append(u0[mask])
+
+        # Split collinear overlapping segments at end points of edges
+        dx = x1[i] - x0[i]
+        dy = y1[i] - y0[i]
+        length = numpy.sqrt(dx * dx + dy * dy)
+        tolerance = 1.0e-12 * (numpy.abs(x0[i]) + numpy.abs(y0[i]) +
+                               length) * length
+        for ex, ey in [(px_i[k], py_i[k]), (px_j[k], py_j[k])]:
+            ax = ex - x0[i]
+            ay = ey - y0[i]
+            u = (ax * dx + ay * dy) / (length * length)
+            mask = ((numpy.abs(ax * dy - ay * dx) <= tolerance) *
+                    (u > 0) * (u < 1))
+            segments.append(i[mask])
+            parameters.append(u[mask])
+
+    # Restore numpy warnings
+    numpy.seterr(**original_numpy_settings)
+
+    return numpy.concatenate(segments), numpy.concatenate(parameters)
+
+
+def _split_segments(x0, y0, x1, y1, segment, u):
+    """Split line segments into pieces at given positions
+
+    Input:
+       x0, y0, x1, y1: Arrays of K segment end points
+       segment, u: Arrays of segment indices and positions along those
+       segments (between 0 and 1) where they are split
+
+    Output:
+       piece: Index of the segment each piece comes from
+       xa, ya, xb, yb: End points of pieces in the direction of their
+       segment
+    """
+
+    K = len(x0)
+    segment = numpy.concatenate((numpy.arange(K), numpy.arange(K), segment))
+    u = numpy.concatenate((numpy.zeros(K), numpy.ones(K), u))
+    order = numpy.lexsort((u, segment))
+    segment = segment[order]
+    u = u[order]
+
+    # Consecutive positions along the same segment delimit a piece
+    mask = segment[1:] == segment[:-1]
+    piece = segment[:-1][mask]
+    ua = u[:-1][mask]
+    ub = u[1:][mask]
+
+    dx = x1[piece] - x0[piece]
+    dy = y1[piece] - y0[piece]
+    xa = x0[piece] + ua * dx
+    ya = y0[piece] + ua * dy
+    xb = x0[piece] + ub * dx
+    yb = y0[piece] + ub * dy
+
+    return piece, xa, ya, xb, yb
+
+
+def _offset_midpoints(xa, ya, xb, yb, side):
+    """Get points just beside the midpoints of line segments
+
+    Input:
+       xa, ya, xb, yb: Arrays of segment end points
+       side: 1 for points to the left of segments, -1 for the right
+
+    Output:
+       x, y: Arrays of point coordinates. Points are a millionth of the
+       segment length away from the segment.
+    """
+
+    offset = 1.0e-6 * side
+    x = (xa + xb) / 2 - offset * (yb - ya)
+    y = (ya + yb) / 2 + offset * (xb - xa)
+
+    return x, y
+
+
+def _crossing_parity(x, y, edges, slab_index, max_pairs=2 ** 20):
+    """Determine whether points are inside rings by the crossing number
+
+    Input:
+       x, y: Arrays of M point coordinates
+       edges: px_i, py_i, px_j, py_j arrays of the edges of one or more rings
+       slab_index: Slab index of edges as returned by _slab_index
+       max_pairs: Maximal number of (point, edge) pairs tested at once
+
+    Output:
+       Boolean array which is True for points crossing an odd number of
+       edges, i.e. inside a polygon with holes given by all its rings.
+       Points on edges may be deemed to be either inside or outside.
+    """
+
+    M = len(x)
+    px_i, py_i, px_j, py_j = edges
+    inside = numpy.zeros(M, dtype=numpy.bool)
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    for a, b, local, k in _slab_pairs(y, slab_index, max_pairs=max_pairs):
+        inside[a:b] = _crossings(x[a:b][local], y[a:b][local],
+                                 px_i[k], py_i[k], px_j[k], py_j[k],
+                                 local, b - a) % 2 == 1
+
+    # Restore numpy warnings
+    numpy.seterr(**original_numpy_settings)
+
+    return inside
+
+
+def _crossing_parity_by_polygon(x, y, polygon, edges, edge_start, edge_end):
+    """Determine whether points are inside their own polygon
+
+    Input:
+       x, y: Arrays of M point coordinates
+       polygon: Array of M polygon indices, one for each point
+       edges: px_i, py_i, px_j, py_j arrays of the edges of all polygons
+       edge_start, edge_end: Range of the edges of each polygon
+
+    Output:
+       Boolean array which is True for points inside their polygon as
+       determined by _crossing_parity
+    """
+
+    M = len(x)
+    px_i, py_i, px_j, py_j = edges
+    counts = edge_end[polygon] - edge_start[polygon]
+    local = numpy.repeat(numpy.arange(M), counts)
+    k = _ranges(edge_start[polygon], edge_end[polygon])
+
+    # Suppress numpy warnings (as we'll be dividing by zero)
+    original_numpy_settings = numpy.seterr(invalid='ignore', divide='ignore')
+
+    crossings = _crossings(x[local], y[local],
+                           px_i[k], py_i[k], px_j[k], py_j[k], local, M)
+
+    # Restore numpy warnings
+    numpy.seterr(**original_numpy_settings)
+
+    return crossings % 2 == 1
+
+
+def _crossings(xp, yp, ex_i, ey_i, ex_j, ey_j, local, M):
+    """Count edges crossed by horizontal rays from points
+
+    Input:
+       xp, yp: Point coordinates for each (point, edge) pair
+       ex_i, ey_i, ex_j, ey_j: Edge end points for each pair
+       local: Index of the point of each pair
+       M: Number of points
+
+    Output:
+       Integer array with number of edges crossed by a ray going west
+       from each point, using the same formula as
+       _separate_points_by_polygon_slab
+    """
+
+    # Edge crossing formula
+    sigma = (yp - ey_i) / (ey_j - ey_i) * (ex_j - ex_i)
+    seg_i = (ey_i < yp) * (ey_j >= yp)
+    seg_j = (ey_j < yp) * (ey_i >= yp)
+    mask = (ex_i + sigma < xp) * (seg_i + seg_j)
+
+    return _bincount(local, weights=mask,
+                    minlength=M).astype(numpy.int)
+
+
 def polygon2segments(polygon):
     """Convert polygon to segments structure suitable for use in intersection
 
     Args:
-        polygon: Nx2 array of polygon vertices
+        polygon: Nx2 array of polygon vertices or a PreparedPolygon in
+            which case its cached segments are returned.
 
     Returns:
         A collection of line segments (x0, y0) -> (x1, y1) vectorised
@@ -1427,6 +3605,9 @@ def polygon2segments(polygon):
            line[1, 1, :] = y1
     """
 
+    if isinstance(polygon, PreparedPolygon):
+        return polygon.get_segments()
+
     try:
         polygon = ensure_numeric(polygon, numpy.float)
     except Exception, e:
@@ -2,7 +2,8 @@ import numpy
 import unittest
 
 # Import InaSAFE modules
-from safe.common.interpolation2d import interpolate2d, interpolate_raster
+from safe.common.interpolation2d import (interpolate2d, interpolate_raster,
+                                         regular_spacing)
 from safe.common.interpolation import BoundsError
 from safe.common.interpolation1d import interpolate1d
 from safe.common.testing import combine_coordinates
@@ -137,6 +138,62 @@ class Test_interpolate(unittest.TestCase):
 
     test_linear_interpolation_range.slow = True
 
+    def test_interpolation_regular_grid(self):
+        """Interpolation on regular grids matches irregular searching
+        """
+
+        # Regular spacing is detected
+        assert regular_spacing([1.0, 2.0, 3.0, 4.0]) == 1.0
+        assert numpy.allclose(regular_spacing(numpy.linspace(-11, 6, 205)),
+                              17.0 / 204)
+        assert regular_spacing([1.0, 2.0, 4.0]) is None
+        assert regular_spacing([1.0]) is None
+
+        x = numpy.linspace(95.0, 96.0, 13)
+        y = numpy.linspace(-11.0, -10.0, 7)
+        A = numpy.zeros((len(x), len(y)))
+        for i in range(len(x)):
+            for j in range(len(y)):
+                A[i, j] = linear_function(x[i], y[j])
+        A[3, 4] = numpy.nan
+
+        # Random points, all grid nodes and points outside the grid
+        numpy.random.seed(17)
+        points = numpy.random.uniform(size=(200, 2))
+        points[:, 0] = points[:, 0] * 1.2 + 94.9
+        points[:, 1] = points[:, 1] * 1.2 - 11.1
+        points = numpy.concatenate([points, combine_coordinates(x, y)])
+
+        # Perturb one coordinate so that searching is used along x
+        x_irregular = x.copy()
+        x_irregular[1] += 1.0e-3
+        assert regular_spacing(x) is not None
+        assert regular_spacing(x_irregular) is None
+
+        for mode in ['linear', 'constant']:
+            refs = interpolate2d(x, y, A, points, mode=mode)
+            assert numpy.isnan(interpolate2d(x, y, A, [[x[3], y[4]]],
+                                             mode=mode)[0])
+
+            # Result does not depend on chunking
+            for chunk_size in [1, 7, 10000]:
+                vals = interpolate2d(x, y, A, points, mode=mode,
+                                     chunk_size=chunk_size)
+                assert nan_allclose(vals, refs, rtol=0, atol=0)
+
+            # Single precision output
+            vals = interpolate2d(x, y, A, points, mode=mode,
+                                 dtype=numpy.float32)
+            assert vals.dtype == numpy.float32
+            assert nan_allclose(vals, refs, rtol=1.0e-6)
+
+            # Grid nodes are reproduced as on irregular grids
+            vals = interpolate2d(x_irregular, y, A, points, mode=mode)
+            nodes = numpy.zeros(len(points), dtype=bool)
+            nodes[200:] = points[200:, 0] != x[1]
+            assert nan_allclose(vals[nodes], refs[nodes],
+                                rtol=1.0e-12, atol=1.0e-12)
+
     def test_linear_interpolation_nan_points(self):
         """Interpolation library works with interpolation points being NaN
 
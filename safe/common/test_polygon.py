@@ -17,12 +17,23 @@ from safe.common.polygon import (separate_points_by_polygon,
                                  join_line_segments,
                                  clip_line_by_polygon,
                                  clip_grid_by_polygons,
+                                 label_grid_by_polygons,
                                  populate_polygon,
                                  generate_random_points_in_bbox,
                                  PolygonInputError,
-                                 line_dictionary_to_geometry)
+                                 line_dictionary_to_geometry,
+                                 BoundingBoxIndex,
+                                 PreparedPolygon,
+                                 prepare_polygon,
+                                 polygon2segments,
+                                 polygon_intersection_areas,
+                                 grid_indices_inside_polygon,
+                                 intersections,
+                                 PointPool)
 from safe.common.testing import test_polygon, test_lines
 from safe.common.numerics import ensure_numeric
+from safe.common.numerics import grid_to_points, geotransform_to_axes
+from safe.common.exceptions import InaSAFEError
 
 
 def linear_function(x, y):
@@ -540,6 +551,83 @@ class Test_Polygon(unittest.TestCase):
         assert numpy.allclose(ins_p, [1, 2, 3])
         assert numpy.allclose(out_p, [0, 4, 5])
 
+    def test_separate_points_by_polygon_boundary(self):
+        """Boundary points are found consistently by all kernels
+        """
+
+        from safe.common.polygon import (_separate_points_by_polygon,
+                                         _separate_points_by_polygon_python)
+
+        polygon = test_polygon
+        points = generate_random_points_in_bbox(polygon, 10, seed=17)
+        midpoints = (polygon[:-1] + polygon[1:]) / 2
+        points = numpy.concatenate((points, polygon[::20], midpoints[::20]))
+
+        for rtol, atol in [(0.0, 0.0), (1.0e-5, 1.0e-8), (1.0e-3, 0.0)]:
+            for closed in [True, False]:
+                ref = _separate_points_by_polygon_python(points, polygon,
+                                                         closed, rtol, atol)
+                for max_pairs in [10, 2 ** 20]:
+                    res = _separate_points_by_polygon(points, polygon,
+                                                      closed, rtol, atol,
+                                                      max_pairs=max_pairs)
+                    assert numpy.all(res[0] == ref[0])
+                    assert numpy.all(res[1] == ref[1])
+
+    def test_separate_points_by_polygon_slab(self):
+        """Slab version of polygon clipping agrees with numpy version
+        """
+
+        # Real polygon with points inside, outside and on the boundary
+        polygon = test_polygon
+        N = len(polygon)
+        points = generate_random_points_in_bbox(polygon, 2000, seed=13)
+        midpoints = (polygon[:-1] + polygon[1:]) / 2
+        points = numpy.concatenate((points, midpoints, polygon))
+
+        for closed in [True, False]:
+            ref_in, ref_out = separate_points_by_polygon(points, polygon,
+                                                         closed=closed)
+            inside, outside = separate_points_by_polygon(points, polygon,
+                                                         closed=closed,
+                                                         algorithm='slab')
+            assert numpy.all(inside == ref_in)
+            assert numpy.all(outside == ref_out)
+
+            # Vertices are on the boundary
+            vertices = numpy.arange(len(points) - N, len(points))
+            if closed:
+                assert numpy.all(inside[-N:] == vertices)
+            else:
+                assert numpy.all(outside[-N:] == vertices)
+
+        # Small chunks and many slabs give the same result
+        from safe.common.polygon import _separate_points_by_polygon_slab
+        ref_in, ref_out = separate_points_by_polygon(points, polygon)
+        for slabs in [1, 3, N]:
+            inside, outside = _separate_points_by_polygon_slab(
+                points, polygon, closed=True,
+                number_of_slabs=slabs, max_pairs=100)
+            assert numpy.all(inside == ref_in)
+            assert numpy.all(outside == ref_out)
+
+        # Polygon with holes
+        U = [[0, 0], [1, 0], [1, 1], [0, 1]]
+        H = [[0.25, 0.25], [0.75, 0.25], [0.75, 0.75], [0.25, 0.75]]
+        points = numpy.array([[0.1, 0.1], [0.5, 0.5], [0.25, 0.5],
+                              [0.9, 0.5], [2, 2]])
+        inside = inside_polygon(points, U, holes=[H], algorithm='slab')
+        assert numpy.all(inside == [0, 2, 3])
+
+        # Unknown algorithm is caught
+        try:
+            separate_points_by_polygon(points, U, algorithm='magic')
+        except PolygonInputError:
+            pass
+        else:
+            msg = 'Unknown algorithm should have raised exception'
+            raise Exception(msg)
+
     def test_polygon_clipping_error_handling(self):
         """Polygon clipping checks input as expected"""
 
@@ -638,6 +726,12 @@ class Test_Polygon(unittest.TestCase):
         assert values[3]['val'] == 43
         assert values[9]['val'] == 75
 
+        # Labels agree with clipped grid points
+        labels = label_grid_by_polygons(geotransform, N, N, polygon_arg)
+        assert labels.shape == A.shape
+        assert numpy.all(A[labels == 0] == res[0][1])
+        assert numpy.sum(labels == -1) == N * N - len(res[0][1])
+
         # Optionally store output for inspection with QGIS (this one is nice)
         if False:
             R = Raster(A, geotransform=geotransform)
@@ -648,6 +742,28 @@ class Test_Polygon(unittest.TestCase):
             Vector(geometry=points,
                    data=values).write_to_file('test_points.shp')
 
+    def test_label_grid_by_polygons(self):
+        """Grid cells are labelled by the first polygon containing them
+        """
+
+        # 4 x 3 grid with pixel centres at x = 0.5, ... 3.5 and
+        # y = 0.5, 1.5, 2.5
+        geotransform = (0, 1, 0, 3, 0, -1)
+        polygons = [[[0, 0], [2, 0], [2, 3], [0, 3]],
+                    [[1, 1], [4, 1], [4, 2], [1, 2]],
+                    [[10, 10], [11, 10], [11, 11]]]
+
+        labels = label_grid_by_polygons(geotransform, 4, 3, polygons)
+        assert numpy.all(labels == [[0, 0, -1, -1],
+                                    [0, 0, 1, 1],
+                                    [0, 0, -1, -1]])
+
+        # Same assignment as clip_grid_by_polygons
+        A = numpy.arange(12.0).reshape((3, 4))
+        res = clip_grid_by_polygons(A, geotransform, polygons)
+        for i, (points, values) in enumerate(res):
+            assert numpy.all(A[labels == i] == values)
+
     def test_populate_polygon(self):
         """Polygon can be populated by random points
         """
@@ -667,6 +783,29 @@ class Test_Polygon(unittest.TestCase):
         for point in points:
             assert is_inside_polygon(point, polygon)
 
+    def test_populate_polygon_in_batches(self):
+        """Seeded random points do not depend on the batch size
+        """
+
+        polygon = [[0, 0], [10, 10], [15, 5], [20, 10], [25, 0],
+                   [30, 10], [40, -10]]
+        ex_poly = [[-1, -1], [5, 0], [5, 5], [-1, 5]]
+
+        reference = populate_polygon(polygon, 100, seed=13,
+                                     exclude=[ex_poly])
+        assert len(reference) == 100
+        for point in reference:
+            assert is_inside_polygon(point, polygon)
+            assert not is_inside_polygon(point, ex_poly)
+
+        for batch_size in [1, 7, 1000]:
+            points = populate_polygon(polygon, 100, seed=13,
+                                      exclude=[ex_poly],
+                                      batch_size=batch_size)
+            assert numpy.allclose(points, reference)
+
+        assert populate_polygon(polygon, 0) == []
+
     def test_populate_polygon_with_exclude(self):
         """Polygon with hole can be populated by random points
         """
@@ -894,13 +1033,14 @@ class Test_Polygon(unittest.TestCase):
         all_points = ensure_numeric(all_points)
 
         # Test separation algorithm
+        # (counts are for points drawn with numpy.random.RandomState)
         inside, outside = separate_points_by_polygon(all_points, main_polygon)
         count = len(inside)
-        msg = 'Expected %i points inside, got %i' % (271, count)
-        assert count == 271, msg
+        msg = 'Expected %i points inside, got %i' % (270, count)
+        assert count == 270, msg
 
-        msg = 'Expected %i indices outside, got %i' % (729, len(outside))
-        assert len(outside) == 729, msg
+        msg = 'Expected %i indices outside, got %i' % (730, len(outside))
+        assert len(outside) == 730, msg
 
         for point in all_points[inside]:
             assert is_inside_polygon(point, main_polygon)
@@ -1524,6 +1664,13 @@ class Test_Polygon(unittest.TestCase):
                               [[0.3, 0.2],
                                [0.31666667, 0.31666667]])
 
+        # Lines not intersecting a polygon can be left out
+        sparse = clip_lines_by_polygons(input_lines, polygons,
+                                        only_intersecting=True)
+        for lines, sparse_lines in zip(lines_covered, sparse):
+            keys = [k for k in lines if len(lines[k]) > 0]
+            assert sorted(sparse_lines.keys()) == sorted(keys)
+
     def test_clip_lines_by_polygon_real_data(self):
         """Real roads are clipped by complex polygon
         """
@@ -1628,6 +1775,53 @@ class Test_Polygon(unittest.TestCase):
 
     test_clip_lines_by_polygon_real_data.slow = True
 
+    def test_clip_lines_by_polygon_vectorised(self):
+        """Vectorised line clipping agrees with clipping one line at a time
+        """
+
+        lines = [numpy.array(line) for line in test_lines]
+
+        # Add lines along, touching and crossing polygon boundary
+        polygon = numpy.array(test_polygon)
+        lines.append(polygon[:5].copy())
+        lines.append(numpy.array([polygon[0], polygon[0], polygon[10]]))
+        lines.append(numpy.array([polygon[3]]))
+
+        for closed in [True, False]:
+            inside_lines, outside_lines = \
+                clip_lines_by_polygon(lines, polygon, closed=closed)
+
+            for k, line in enumerate(lines):
+                inside, outside = clip_line_by_polygon(line, polygon,
+                                                       closed=closed)
+                for res, ref in [(inside_lines[k], inside),
+                                 (outside_lines[k], outside)]:
+                    if len(res) == 1 and res[0] is line:
+                        # Whole line was outside polygon bounding box
+                        res = join_line_segments([[line[i], line[i + 1]]
+                                                  for i in
+                                                  range(len(line) - 1)])
+                    assert len(res) == len(ref)
+                    for a, b in zip(res, ref):
+                        assert numpy.allclose(a, b, rtol=0, atol=0)
+
+        # Multiple polygons can report only lines that intersect them
+        polygons = [polygon, polygon + 0.001, polygon + 10]
+        lines_covered = clip_lines_by_polygons(lines, polygons,
+                                               only_intersecting=True)
+        assert len(lines_covered) == 3
+        assert len(lines_covered[2]) == 0
+        for i in range(2):
+            inside_lines, _ = clip_lines_by_polygon(lines, polygons[i])
+            assert len(lines_covered[i]) > 0
+            for k in inside_lines:
+                if len(inside_lines[k]) == 0:
+                    assert k not in lines_covered[i]
+                else:
+                    assert len(lines_covered[i][k]) == len(inside_lines[k])
+                    for a, b in zip(lines_covered[i][k], inside_lines[k]):
+                        assert numpy.allclose(a, b, rtol=0, atol=0)
+
     def test_join_segments(self):
         """Consecutive line segments can be joined into continuous line
         """
@@ -1682,6 +1876,434 @@ class Test_Polygon(unittest.TestCase):
         for i in range(len(lines)):
             assert numpy.allclose(lines[i], segments[i])
 
+        # Tolerances are honoured
+        segments = [[[0, 0], [1, 1]],
+                    [[1 + 1.0e-13, 1], [2, 1]],
+                    [[2 + 1.0e-6, 1], [3, 0]]]
+        lines = join_line_segments(segments)
+        assert len(lines) == 2
+        assert numpy.allclose(lines[0], [[0, 0], [1, 1], [2, 1]])
+        lines = join_line_segments(segments, rtol=0, atol=1.0e-5)
+        assert len(lines) == 1
+        assert numpy.allclose(lines[0], [[0, 0], [1, 1], [2, 1], [3, 0]])
+
+        # Many segments agree with pairwise comparison of end points
+        numpy.random.seed(7)
+        N = 1000
+        points = numpy.cumsum(numpy.random.uniform(-1, 1, (N + 1, 2)),
+                              axis=0)
+        segments = numpy.zeros((N, 2, 2))
+        segments[:, 0, :] = points[:-1]
+        segments[:, 1, :] = points[1:]
+        gaps = numpy.random.randint(0, N, 50)
+        segments[gaps, 0, :] += 0.1
+        lines = join_line_segments(segments)
+        number_of_lines = 1
+        for i in range(N - 1):
+            if not numpy.allclose(segments[i][1], segments[i + 1][0],
+                                  rtol=1.0e-12, atol=1.0e-12):
+                number_of_lines += 1
+        assert len(lines) == number_of_lines
+        assert sum([len(line) - 1 for line in lines]) == N
+        assert numpy.allclose(numpy.concatenate([line[1:]
+                                                 for line in lines]),
+                              segments[:, 1, :])
+
+    def test_intersections(self):
+        """Batched intersections agree with intersection for each segment
+        """
+
+        numpy.random.seed(5)
+        K = 200
+        E = 150
+        segments0 = numpy.random.uniform(0, 10, (2, 2, K))
+        segments1 = polygon2segments(numpy.random.uniform(0, 10, (E, 2)))
+
+        # Segments sharing end points and parallel segments
+        segments0[0, :, 0] = segments1[0, :, 3]
+        segments0[:, :, 1] = segments1[:, :, 5]
+
+        ref_points = []
+        ref_indices = []
+        for i in range(K):
+            values = intersection(segments0[:, :, i], segments1)
+            mask = -numpy.isnan(values[:, 0])
+            ref_points.append(values[mask])
+            ref_indices.extend([(i, j) for j in numpy.where(mask)[0]])
+        ref_points = numpy.concatenate(ref_points)
+
+        for max_pairs in [10, 1000, 2 ** 20]:
+            points, indices, parameters = intersections(segments0,
+                                                        segments1,
+                                                        max_pairs=max_pairs)
+            assert len(points) > K
+            assert numpy.all(indices == ref_indices)
+            assert numpy.all(points == ref_points)
+
+            # Parameters locate intersection points along both segments
+            i = indices[:, 0]
+            j = indices[:, 1]
+            u0 = parameters[:, 0]
+            u1 = parameters[:, 1]
+            assert numpy.allclose(points, (segments0[0, :, i] +
+                                           u0[:, None] *
+                                           (segments0[1, :, i] -
+                                            segments0[0, :, i])))
+            assert numpy.allclose(points, (segments1[0, :, j] +
+                                           u1[:, None] *
+                                           (segments1[1, :, j] -
+                                            segments1[0, :, j])))
+
+        # No segments
+        points, indices, parameters = intersections(segments0[:, :, :0],
+                                                    segments1)
+        assert points.shape == (0, 2)
+        assert indices.shape == (0, 2)
+
+        # Wrong shape
+        self.assertRaises(InaSAFEError, intersections,
+                          segments0[0], segments1)
+
+    def test_bounding_box_index(self):
+        """Bounding box index finds the same items as a brute force search
+        """
+
+        # Points including duplicates, a NaN and points on query boundaries
+        numpy.random.seed(17)
+        points = numpy.random.uniform(0, 10, size=(2000, 2))
+        points[0] = [5, 5]
+        points[1] = [5, 5]
+        points[2] = [2, 7]
+        points[3] = [numpy.nan, 3]
+
+        index = BoundingBoxIndex(points)
+        assert len(index) == 2000
+        for bbox in [[2, 8, 3, 7], [0, 10, 0, 10], [5, 5, 5, 5],
+                     [-3, -1, 2, 4], [9.9, 20, -5, 0.5], [1, 2, 6, 7]]:
+            x = points[:, 0]
+            y = points[:, 1]
+            ref = numpy.where((x >= bbox[0]) * (x <= bbox[1]) *
+                              (y >= bbox[2]) * (y <= bbox[3]))[0]
+            res = index.query(bbox)
+            assert numpy.all(res == ref)
+
+        # Bounding boxes of varying size including one covering everything
+        x0 = numpy.random.uniform(0, 10, size=500)
+        y0 = numpy.random.uniform(0, 10, size=500)
+        w = numpy.random.exponential(0.3, size=500)
+        h = numpy.random.exponential(0.3, size=500)
+        bboxes = numpy.array([x0, x0 + w, y0, y0 + h]).transpose()
+        bboxes[7] = [-100, 100, -100, 100]
+
+        index = BoundingBoxIndex(bboxes)
+        for bbox in [[2, 3, 3, 4], [5, 5, 5, 5], [11, 12, 11, 12],
+                     [200, 300, 0, 1]]:
+            ref = numpy.where((bboxes[:, 0] <= bbox[1]) *
+                              (bboxes[:, 1] >= bbox[0]) *
+                              (bboxes[:, 2] <= bbox[3]) *
+                              (bboxes[:, 3] >= bbox[2]))[0]
+            res = index.query(bbox)
+            assert numpy.all(res == ref)
+            if bbox[0] < 100:
+                assert 7 in res
+
+        # Degenerate inputs
+        assert len(BoundingBoxIndex([]).query([0, 1, 0, 1])) == 0
+        index = BoundingBoxIndex([[1, 1], [1, 1]])
+        assert numpy.all(index.query([0, 1, 0, 1]) == [0, 1])
+        assert len(index.query([0, 0.5, 0, 1])) == 0
+
+        # Points on a horizontal line
+        points = numpy.zeros((100, 2))
+        points[:, 0] = numpy.arange(100)
+        index = BoundingBoxIndex(points)
+        assert numpy.all(index.query([10.5, 20, -1, 1]) == range(11, 21))
+
+        # Query many points at once
+        index = BoundingBoxIndex(bboxes)
+        points = numpy.random.uniform(0, 10, size=(300, 2))
+        point_indices, item_indices = index.query_points(points)
+        for k, point in enumerate(points):
+            ref = index.query([point[0], point[0], point[1], point[1]])
+            assert numpy.all(item_indices[point_indices == k] == ref)
+
+    def test_prepared_polygon(self):
+        """Prepared polygons give same results as plain polygon arrays
+        """
+
+        outer_ring = numpy.array([[0, 0], [10, 0], [10, 10], [0, 10]])
+        hole = numpy.array([[2, 2], [4, 2], [4, 4], [2, 4]])
+
+        prepared = PreparedPolygon(outer_ring, [hole])
+        assert len(prepared) == 4
+        assert len(prepared.inner_rings) == 1
+        assert numpy.allclose(prepared.bbox, [0, 10, 0, 10])
+
+        # Cached structures are reused
+        assert prepared.get_edges() is prepared.get_edges()
+        assert prepared.get_segments() is prepared.get_segments()
+        assert numpy.allclose(polygon2segments(prepared),
+                              polygon2segments(outer_ring))
+
+        # Points inside, on boundary, in hole and outside
+        numpy.random.seed(13)
+        points = numpy.random.uniform(-2, 12, size=(500, 2))
+        points = numpy.concatenate((points, outer_ring, hole))
+        for algorithm in ['numpy', 'slab', 'python']:
+            for closed in [True, False]:
+                res = inside_polygon(points, prepared, closed=closed,
+                                     algorithm=algorithm)
+                ref = inside_polygon(points, outer_ring, closed=closed,
+                                     holes=[hole], algorithm=algorithm)
+                assert numpy.allclose(res, ref)
+
+                res = outside_polygon(points, prepared, closed=closed,
+                                      algorithm=algorithm)
+                ref = outside_polygon(points, outer_ring, closed=closed,
+                                      holes=[hole], algorithm=algorithm)
+                assert numpy.allclose(res, ref)
+
+        # Only the outer ring is used by separate_points_by_polygon
+        res = separate_points_by_polygon(points, prepared)
+        ref = separate_points_by_polygon(points, outer_ring)
+        assert numpy.allclose(res[0], ref[0])
+        assert numpy.allclose(res[1], ref[1])
+
+        # Geometry objects are prepared for each call
+        P = Polygon(outer_ring, inner_rings=[hole])
+        assert prepare_polygon(P) is not prepare_polygon(P)
+        assert prepare_polygon(prepared) is prepared
+        assert numpy.allclose(inside_polygon(points, prepare_polygon(P)),
+                              inside_polygon(points, outer_ring,
+                                             holes=[hole]))
+
+        # Line clipping
+        lines = [numpy.array([[-1, 5], [11, 5]]),
+                 numpy.array([[3, -1], [3, 11], [20, 11]]),
+                 numpy.array([[20, 20], [30, 30]])]
+        res_in, res_out = clip_lines_by_polygon(lines, prepared)
+        ref_in, ref_out = clip_lines_by_polygon(lines, outer_ring)
+        for k in range(len(lines)):
+            assert len(res_in[k]) == len(ref_in[k])
+            for a, b in zip(res_in[k], ref_in[k]):
+                assert numpy.allclose(a, b)
+            assert len(res_out[k]) == len(ref_out[k])
+            for a, b in zip(res_out[k], ref_out[k]):
+                assert numpy.allclose(a, b)
+
+        res = clip_line_by_polygon(lines[1], prepared)
+        ref = clip_line_by_polygon(lines[1], outer_ring)
+        for res_lines, ref_lines in zip(res, ref):
+            assert len(res_lines) == len(ref_lines)
+            for a, b in zip(res_lines, ref_lines):
+                assert numpy.allclose(a, b)
+
+        res = clip_lines_by_polygons(lines, [prepared])
+        ref = clip_lines_by_polygons(lines, [outer_ring])
+        assert len(line_dictionary_to_geometry(res[0])) == \
+            len(line_dictionary_to_geometry(ref[0]))
+
+        # Grid clipping honours holes of prepared polygons
+        A = numpy.arange(144, dtype='float').reshape(12, 12)
+        geotransform = (-1.0, 1.0, 0.0, 11.0, 0.0, -1.0)
+        res = clip_grid_by_polygons(A, geotransform, [prepared])
+        ref = clip_grid_by_polygons(A, geotransform, [P])
+        assert numpy.allclose(res[0][0], ref[0][0])
+        assert numpy.allclose(res[0][1], ref[0][1])
+
+        # Rings of geometry objects may be changed between calls
+        P = Polygon(outer_ring.astype(float), inner_rings=[hole])
+        res = clip_grid_by_polygons(A, geotransform, [P])
+        P.outer_ring[2] = [10, 5]
+        res = clip_grid_by_polygons(A, geotransform, [P])
+        ref = clip_grid_by_polygons(A, geotransform,
+                                    [Polygon(P.outer_ring.copy(), [hole])])
+        assert len(res[0][1]) == len(ref[0][1])
+        assert numpy.allclose(res[0][0], ref[0][0])
+
+        P.outer_ring += 5
+        res = clip_grid_by_polygons(A, geotransform, [P])
+        ref = clip_grid_by_polygons(A, geotransform,
+                                    [Polygon(P.outer_ring.copy(), [hole])])
+        assert numpy.allclose(res[0][0], ref[0][0])
+        assert numpy.allclose(res[0][1], ref[0][1])
+
+        # Invalid input
+        self.assertRaises(PolygonInputError, PreparedPolygon,
+                          [[0, 0, 0], [1, 1, 1]])
+
+    def test_grid_indices_inside_polygon(self):
+        """Scanline rasterisation agrees with point in polygon for grids
+        """
+
+        # Grid of 30 x 20 pixels with pixel centres at 0.5, 1.5, ...
+        nx = 30
+        ny = 20
+        geotransform = (0.0, 1.0, 0.0, 20.0, 0.0, -1.0)
+        x, y = geotransform_to_axes(geotransform, nx, ny)
+        A = numpy.arange(nx * ny, dtype='float').reshape(ny, nx)
+        points, values = grid_to_points(A, x, y)
+
+        # Vertices on pixel centres, pixel edges and in between
+        outer_ring = numpy.array([[2.5, 1.5], [20.5, 1.5], [27, 9.5],
+                                  [20.5, 18.5], [12.25, 12.0], [2.5, 18.5],
+                                  [2.5, 10.0], [0.0, 8.5]])
+        hole = numpy.array([[6.5, 4.5], [10.5, 4.5], [10.5, 8.5],
+                            [8.0, 7.0]])
+        polygon = Polygon(outer_ring, inner_rings=[hole])
+
+        for closed in [True, False]:
+            indices = grid_indices_inside_polygon(polygon, x, y,
+                                                  closed=closed)
+            ref = inside_polygon(points, outer_ring, holes=[hole],
+                                 closed=closed)
+            assert numpy.all(indices == numpy.sort(ref))
+
+        # Pixel centres on boundary are included when closed
+        indices = grid_indices_inside_polygon(outer_ring, x, y)
+        on_boundary = (ny - 1 - 1) * nx + numpy.arange(2, 21)
+        assert numpy.all(numpy.in1d(on_boundary, indices))
+        indices = grid_indices_inside_polygon(outer_ring, x, y,
+                                              closed=False)
+        assert not numpy.any(numpy.in1d(on_boundary, indices))
+
+        # Clipping by overlapping polygons uses first polygon encountered
+        square = numpy.array([[0, 0], [10, 0], [10, 10], [0, 10]])
+        res = clip_grid_by_polygons(A, geotransform, [polygon, square])
+        indices = inside_polygon(points, outer_ring, holes=[hole])
+        assert numpy.allclose(res[0][0], points[indices])
+        assert numpy.allclose(res[0][1], values[indices])
+        indices = inside_polygon(points, square)
+        indices = numpy.setdiff1d(indices,
+                                  inside_polygon(points, outer_ring,
+                                                 holes=[hole]))
+        assert numpy.allclose(res[1][0], points[indices])
+        assert numpy.allclose(res[1][1], values[indices])
+
+        # Polygon outside grid
+        indices = grid_indices_inside_polygon(square + 100, x, y)
+        assert len(indices) == 0
+
+    def test_separate_points_by_polygon_in_processes(self):
+        """Points separated by a pool of processes as by a single process
+        """
+
+        numpy.random.seed(11)
+        polygon = numpy.array(test_polygon)
+        hole = polygon[::10] * 0.999 + polygon[::10].mean(axis=0) * 0.001
+        minx, miny = polygon.min(axis=0)
+        maxx, maxy = polygon.max(axis=0)
+        points = numpy.zeros((5000, 2))
+        points[:, 0] = numpy.random.uniform(minx, maxx, 5000)
+        points[:, 1] = numpy.random.uniform(miny, maxy, 5000)
+        points[:10] = polygon[:10]  # On boundary
+
+        for algorithm in ['numpy', 'slab']:
+            ref = separate_points_by_polygon(points, polygon,
+                                             algorithm=algorithm)
+            res = separate_points_by_polygon(points, polygon,
+                                             algorithm=algorithm,
+                                             processes=3)
+            assert numpy.all(res[0] == ref[0])
+            assert numpy.all(res[1] == ref[1])
+
+        ref = in_and_outside_polygon(points, polygon, holes=[hole])
+        res = in_and_outside_polygon(points, polygon, holes=[hole],
+                                     processes=2)
+        assert numpy.all(res[0] == ref[0])
+        assert numpy.all(res[1] == ref[1])
+        assert numpy.all(inside_polygon(points, polygon, processes=2) ==
+                         inside_polygon(points, polygon))
+
+        # One pool can be reused for several polygons. Points beyond its
+        # capacity are classified in batches.
+        pool = PointPool(2, 1000)
+        try:
+            for P in [polygon, hole]:
+                res = in_and_outside_polygon(points, P, processes=pool)
+                ref = in_and_outside_polygon(points, P)
+                assert numpy.all(res[0] == ref[0])
+                assert numpy.all(res[1] == ref[1])
+        finally:
+            pool.close()
+
+        # Fewer points than processes
+        res = separate_points_by_polygon(points[:2], polygon, processes=4)
+        ref = separate_points_by_polygon(points[:2], polygon)
+        assert numpy.all(res[0] == ref[0])
+        assert numpy.all(res[1] == ref[1])
+
+        # Grid clipping
+        A = numpy.arange(1200, dtype='float').reshape(30, 40)
+        dx = (maxx - minx) / 40
+        dy = (maxy - miny) / 30
+        geotransform = (minx, dx, 0, maxy, 0, -dy)
+        polygons = [polygon, Polygon(polygon, inner_rings=[hole]),
+                    polygon[::-1] - [dx * 10, 0]]
+        ref = clip_grid_by_polygons(A, geotransform, polygons)
+        res = clip_grid_by_polygons(A, geotransform, polygons, processes=2)
+        assert len(res) == len(ref)
+        for (P, V), (P_ref, V_ref) in zip(res, ref):
+            assert numpy.all(P == P_ref)
+            assert numpy.all(V == V_ref)
+
+    def test_polygon_intersection_areas(self):
+        """Areas of intersection between polygons are calculated exactly
+        """
+
+        square = numpy.array([[0, 0], [2, 0], [2, 2], [0, 2]], dtype=float)
+        hole = numpy.array([[0.5, 0.5], [1.5, 0.5], [1.5, 1.5], [0.5, 1.5]])
+        polygons = [square,                     # Identical to clip polygon
+                    square + [1, 1],            # Overlapping quarter
+                    square + [2, 0],            # Sharing an edge
+                    square[::-1] + [1, 0],      # Clockwise half
+                    square / 4 + [0.2, 0.2],    # Contained
+                    square * 2 - [1, 1],        # Containing
+                    square + [5, 5]]            # Disjoint
+        clip_polygons = [square,
+                         Polygon(square, inner_rings=[hole])]
+
+        indices, areas, polygon_areas = polygon_intersection_areas(
+            polygons, clip_polygons)
+
+        assert numpy.allclose(polygon_areas, [4, 4, 4, 4, 0.25, 16, 4])
+
+        ref = {(0, 0): 4, (1, 0): 1, (3, 0): 2, (4, 0): 0.25, (5, 0): 4,
+               (0, 1): 3, (1, 1): 0.75, (3, 1): 1.5, (4, 1): 0.21,
+               (5, 1): 3}
+        res = dict(zip([tuple(i) for i in indices], areas))
+        assert sorted(res.keys()) == sorted(ref.keys())
+        for key in ref:
+            msg = 'Area of %s was %f. Expected %f' % (key, res[key],
+                                                      ref[key])
+            assert numpy.allclose(res[key], ref[key]), msg
+
+        # Ordered by clip polygon first
+        assert numpy.all(indices[:, 1] == sorted(indices[:, 1]))
+
+        # Chunks give the same result
+        res = polygon_intersection_areas(polygons, clip_polygons,
+                                         max_polygons=2)
+        assert numpy.all(res[0] == indices)
+        assert numpy.allclose(res[1], areas)
+
+        # Many small footprints tiling a grid covered partly by a triangle
+        cells = []
+        for i in range(20):
+            for j in range(20):
+                cells.append(square / 20 + [i * 0.1, j * 0.1])
+        triangle = numpy.array([[0, 0], [2, 0], [0, 2]])
+        indices, areas, polygon_areas = polygon_intersection_areas(
+            cells, [triangle], max_polygons=64)
+        assert numpy.allclose(areas.sum(), 2)
+        assert numpy.all(areas <= polygon_areas[indices[:, 0]] + 1.0e-12)
+        assert len(indices) == 20 * 21 / 2
+
+        # Degenerate inputs
+        indices, areas, _ = polygon_intersection_areas([], [square])
+        assert indices.shape == (0, 2)
+        assert len(areas) == 0
+
 if __name__ == '__main__':
     suite = unittest.makeSuite(Test_Polygon, 'test')
     runner = unittest.TextTestRunner(verbosity=2)
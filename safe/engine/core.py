@@ -113,7 +113,12 @@ def calculate_impact(layers, impact_fcn):
 
     output_filename = unique_filename(suffix=extension)
     F.filename = output_filename
-    F.write_to_file(output_filename)
+    if F.is_raster:
+        # Lossless compression in tiles keeps large grids small on disk
+        # and quick to display
+        F.write_to_file(output_filename, compression='DEFLATE', tiled=True)
+    else:
+        F.write_to_file(output_filename)
 
     # Establish default name (layer1 X layer1 x impact_function)
     if not F.get_name():
@@ -9,14 +9,20 @@ import numpy
 from safe.common.interpolation2d import interpolate_raster
 from safe.common.utilities import verify
 from safe.common.utilities import ugettext as tr
-from safe.common.numerics import ensure_numeric
+from safe.common.numerics import ensure_numeric, geotransform_to_axes
 from safe.common.geodesy import Point
 from safe.common.exceptions import InaSAFEError, BoundsError
 from safe.common.polygon import (inside_polygon,
-                                 clip_lines_by_polygons, clip_grid_by_polygons)
+                                 clip_lines_by_polygons, clip_grid_by_polygons,
+                                 label_grid_by_polygons,
+                                 polygon_intersection_areas,
+                                 BoundingBoxIndex, prepare_polygon,
+                                 _bincount)
 
 from safe.storage.vector import Vector, convert_polygons_to_centroids
+from safe.storage.raster import Raster
 from safe.storage.utilities import geometry_type_to_string
+from safe.storage.utilities import densify_lines
 from safe.storage.utilities import DEFAULT_ATTRIBUTE
 from safe.storage.geometry import Polygon
 
@@ -24,7 +30,8 @@ from safe.storage.geometry import Polygon
 def assign_hazard_values_to_exposure_data(hazard, exposure,
                                           layer_name=None,
                                           attribute_name=None,
-                                          mode='linear'):
+                                          mode='linear', overlay=False,
+                                          delta=None, thresholds=None):
     """Assign hazard values to exposure data
 
         This is the high level wrapper around interpolation functions for
@@ -53,13 +60,25 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
                  this attribute is ignored.
 
             * mode:
-                 Interpolation mode for raster to point interpolation only.
+                 Interpolation mode for interpolation from raster layers.
                  Permissible values are 'linear' (default) which will employ
                  billinear interpolation and 'constant' which will employ a
                  piecewise constant interpolation. This parameter is passed
                  all the way down to the underlying interpolation function
                  interpolate2d (module common/interpolation2d.py)
 
+            * overlay:
+                 If True and both layers are polygon data, attributes are
+                 assigned by area of intersection rather than by centroid.
+                 Default False. This parameter is passed to
+                 interpolate_polygon_vector.
+
+            * delta, thresholds:
+                 Sampling distance and hazard class thresholds used when
+                 hazard layer is raster and exposure layer is line data.
+                 Default None. These parameters are passed to
+                 interpolate_raster_vector_lines.
+
     Returns:
             Layer representing the exposure data with hazard levels assigned.
 
@@ -84,7 +103,9 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
 
           Polygon-Line: * Not Implemented *
 
-          Polygon-Polygon: * Not Implemented *
+          Polygon-Polygon: Calculate centroids and use Polygon - Point
+            algorithm. With overlay=True attributes are assigned by area
+            of intersection instead
 
           Polygon-Raster: Convert raster to points, clip to polygon,
             assign values and return point data
@@ -92,11 +113,14 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
           Raster-Point: Bilinear (or constant) interpolation as currently
             implemented
 
-          Raster-Line: * Not Implemented *
+          Raster-Line: Densify lines, sample raster at all points at once
+            and split lines where the sampled values change class
 
           Raster-Polygon:  Calculate centroids and use Raster - Point algorithm
 
-          Raster-Raster:   Exposure raster is returned as is
+          Raster-Raster:   Resample hazard raster onto the exposure grid
+            with bilinear (or constant) interpolation. If rasters are
+            aligned the hazard raster is returned as is
 
         The data type of the resulting layer depends on the combination of
         input types as follows:
@@ -105,13 +129,13 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
 
           Polygon-Line: N/A
 
-          Polygon-Polygon: N/A
+          Polygon-Polygon: Polygon data
 
           Polygon-Raster: Point data
 
           Raster-Point: Point data
 
-          Raster-Line: N/A
+          Raster-Line: Line data
 
           Raster-Polygon: Polygon data
 
@@ -136,14 +160,17 @@ def assign_hazard_values_to_exposure_data(hazard, exposure,
         return interpolate_raster_vector(hazard, exposure,
                                          layer_name=layer_name,
                                          attribute_name=attribute_name,
-                                         mode=mode)
+                                         mode=mode,
+                                         delta=delta,
+                                         thresholds=thresholds)
     # Raster-Raster
     elif hazard.is_raster and exposure.is_raster:
-        return interpolate_raster_raster(hazard, exposure)
+        return interpolate_raster_raster(hazard, exposure, mode=mode)
     # Vector-Vector
     elif hazard.is_vector and exposure.is_vector:
         return interpolate_polygon_vector(hazard, exposure,
-                                          layer_name=layer_name)
+                                          layer_name=layer_name,
+                                          overlay=overlay)
     # Vector-Raster
     elif hazard.is_vector and exposure.is_raster:
         return interpolate_polygon_raster(hazard, exposure,
@@ -215,16 +242,20 @@ def check_inputs(hazard, exposure, layer_name, attribute_name):
 #-------------------------------------------------------------
 def interpolate_raster_vector(source, target,
                               layer_name=None, attribute_name=None,
-                              mode='linear'):
+                              mode='linear', delta=None, thresholds=None):
     """Interpolate from raster layer to vector data
 
     Args:
         * source: Raster data set (grid)
-        * target: Vector data set (points or polygons)
+        * target: Vector data set (points, lines or polygons)
         * layer_name: Optional name of returned interpolated layer.
               If None the name of V is used for the returned layer.
         * attribute_name: Name for new attribute.
               If None (default) the name of R is used
+        * mode: 'linear' or 'constant' as for
+              interpolate_raster_vector_points
+        * delta, thresholds: Only used for line data. See
+              interpolate_raster_vector_lines
 
     Returns:
         I: Vector data set; points located as target with values
@@ -244,9 +275,13 @@ def interpolate_raster_vector(source, target,
                                              layer_name=layer_name,
                                              attribute_name=attribute_name,
                                              mode=mode)
-    #elif target.is_line_data:
-    # TBA - issue https://github.com/AIFDR/inasafe/issues/36
-    #
+    elif target.is_line_data:
+        R = interpolate_raster_vector_lines(source, target,
+                                            layer_name=layer_name,
+                                            attribute_name=attribute_name,
+                                            mode=mode,
+                                            delta=delta,
+                                            thresholds=thresholds)
     elif target.is_polygon_data:
         # Use centroids, in case of polygons
         P = convert_polygons_to_centroids(target)
@@ -256,7 +291,11 @@ def interpolate_raster_vector(source, target,
         # In case of polygon data, restore the polygon geometry
         # Do this setting the geometry of the returned set to
         # that of the original polygon
-        R = Vector(data=R.get_data(),
+        if R.is_columnar:
+            data = R.get_columns()
+        else:
+            data = R.get_data()
+        R = Vector(data=data,
                    projection=R.get_projection(),
                    geometry=target.get_geometry(),
                    name=R.get_name())
@@ -270,7 +309,7 @@ def interpolate_raster_vector(source, target,
 
 
 def interpolate_polygon_vector(source, target,
-                               layer_name=None):
+                               layer_name=None, overlay=False):
     """Interpolate from polygon vector layer to vector data
 
     Args:
@@ -278,6 +317,9 @@ def interpolate_polygon_vector(source, target,
         * target: Vector data set (points or polygons)  - TBA also lines
         * layer_name: Optional name of returned interpolated layer.
               If None the name of target is used for the returned layer.
+        * overlay: If True and target geometry is polygon, attributes are
+              assigned by area of intersection using
+              interpolate_polygon_polygons. Default False.
 
     Output
         I: Vector data set; points located as target with values interpolated
@@ -285,7 +327,8 @@ def interpolate_polygon_vector(source, target,
 
     Note:
         If target geometry is polygon, data will be interpolated to
-        its centroids and the output is a point data set.
+        its centroids unless overlay is True. The returned data set keeps
+        the polygon geometry of target.
     """
 
     # Input checks
@@ -299,6 +342,9 @@ def interpolate_polygon_vector(source, target,
     elif target.is_line_data:
         R = interpolate_polygon_lines(source, target,
                                       layer_name=layer_name)
+    elif target.is_polygon_data and overlay:
+        R = interpolate_polygon_polygons(source, target,
+                                         layer_name=layer_name)
     elif target.is_polygon_data:
         # Use polygon centroids
         X = convert_polygons_to_centroids(target)
@@ -321,8 +367,81 @@ def interpolate_polygon_vector(source, target,
     return R
 
 
+def interpolate_polygon_polygons(source, target, layer_name=None):
+    """Interpolate from polygon vector layer to polygon vector data
+
+    Args:
+        * source: Vector data set (polygon)
+        * target: Vector data set (polygon)
+        * layer_name: Optional name of returned interpolated layer.
+              If None the name of target is used for the returned layer.
+
+    Returns:
+        Vector data set with the polygons of target. Each polygon gets the
+        attributes of the source polygon it overlaps the most together with
+
+        * polygon_id: Index of that source polygon
+        * area_frac: Fraction of the target polygon area covered by it
+
+    Note:
+        Target polygons not intersecting any source polygon get None for
+        all source attributes and an area_frac of 0.
+
+        Areas are calculated exactly from the polygon boundaries (holes
+        included) using a bounding box index and processing target
+        polygons in chunks. This scales to several hundred thousand
+        target polygons such as building footprints.
+    """
+
+    msg = ('Vector layer to interpolate to must be polygon geometry. '
+           'I got OGR geometry type %s'
+           % geometry_type_to_string(target.geometry_type))
+    verify(target.is_polygon_data, msg)
+
+    attribute_names = source.get_attribute_names()
+    attribute_names.append('polygon_id')
+    attribute_names.append(DEFAULT_ATTRIBUTE)
+
+    # Extract polygon features
+    geometry = target.get_geometry(as_geometry_objects=True)
+    attributes = target.get_data()
+    hazard_geometry = source.get_geometry(as_geometry_objects=True)
+    hazard_attributes = source.get_data()
+    verify(len(hazard_geometry) == len(hazard_attributes))
+
+    # Areas of intersection between target and source polygons
+    indices, areas, polygon_areas = polygon_intersection_areas(
+        geometry, hazard_geometry)
+
+    # Source polygon with the largest area of intersection for each target
+    order = numpy.lexsort((-areas, indices[:, 0]))
+    indices = indices[order]
+    areas = areas[order]
+    first = numpy.r_[True, indices[1:, 0] != indices[:-1, 0]]
+    indices = indices[first]
+    areas = areas[first]
+
+    # Augment polygon features with empty attributes from source
+    for a in attributes:
+        for key in attribute_names:
+            a[key] = None
+        a['area_frac'] = 0.0
+
+    for (i, j), area in zip(indices, areas):
+        attributes[i].update(hazard_attributes[j])
+        attributes[i]['polygon_id'] = int(j)
+        attributes[i][DEFAULT_ATTRIBUTE] = True
+        attributes[i]['area_frac'] = float(area / polygon_areas[i])
+
+    return Vector(data=attributes,
+                  projection=target.get_projection(),
+                  geometry=geometry,
+                  name=layer_name)
+
+
 def interpolate_polygon_raster(source, target,
-                               layer_name=None, attribute_name=None):
+                               layer_name=None, attribute_name=None,
+                               output='points'):
     """Interpolate from polygon layer to raster data
 
     Args
@@ -332,14 +451,27 @@ def interpolate_polygon_raster(source, target,
               If None the name of source is used for the returned layer.
         * attribute_name: Name for new attribute.
               If None (default) the name of layer target is used
+        * output: Determines the returned layer. Options are
+
+            * 'points' - one point per grid cell inside a polygon (default)
+            * 'polygons' - the polygons of source with the sum of grid
+              values inside each polygon stored as attribute_name and the
+              number of grid cells as 'cell_count'
+            * 'raster' - raster aligned with target holding the index of
+              the polygon containing each grid cell and NaN elsewhere
+
     Output
         I: Vector data set; points located as target with
-           values interpolated from source
+           values interpolated from source. For other values of output
+           see above.
 
     Note:
         Each point in the resulting dataset will have an attribute
         'polygon_id' which refers to the polygon it belongs to.
 
+        Outputs 'polygons' and 'raster' label the grid cells in place
+        and never create one feature per grid cell. They are much faster
+        and use far less memory for large grids.
     """
 
     # Input checks
@@ -347,9 +479,20 @@ def interpolate_polygon_raster(source, target,
     verify(source.is_vector)
     verify(source.is_polygon_data)
 
+    msg = ('Argument output must be either "points", "polygons" or '
+           '"raster". I got "%s"' % output)
+    verify(output in ['points', 'polygons', 'raster'], msg)
+
     # Run underlying clipping algorithm
     polygon_geometry = source.get_geometry(as_geometry_objects=True)
 
+    if output != 'points':
+        return label_raster_by_polygons(source, target,
+                                        polygon_geometry,
+                                        layer_name=layer_name,
+                                        attribute_name=attribute_name,
+                                        output=output)
+
     polygon_attributes = source.get_data()
     res = clip_grid_by_polygons(target.get_data(scaling=False),
                                 target.get_geotransform(),
@@ -376,10 +519,67 @@ def interpolate_polygon_raster(source, target,
     return R
 
 
+def label_raster_by_polygons(source, target, polygon_geometry,
+                             layer_name=None, attribute_name=None,
+                             output='polygons'):
+    """Aggregate raster data by the polygons containing each grid cell
+
+    Args
+        * source: Polygon data set
+        * target: Raster data set
+        * polygon_geometry: Polygon geometry objects of source
+        * layer_name: Optional name of returned layer
+        * attribute_name: Name of attribute holding the sums.
+              If None (default) the name of layer target is used
+        * output: 'polygons' or 'raster' as for interpolate_polygon_raster
+
+    Output
+        Vector data set with source polygons or raster of polygon ids
+    """
+
+    labels = label_grid_by_polygons(target.get_geotransform(),
+                                    target.columns, target.rows,
+                                    polygon_geometry)
+
+    if output == 'raster':
+        # Polygon index as value for each grid cell
+        ids = numpy.where(labels < 0, numpy.nan, labels)
+        return Raster(data=ids,
+                      projection=target.get_projection(),
+                      geotransform=target.get_geotransform(),
+                      name=layer_name)
+
+    # Sum and count grid cells inside each polygon ignoring NaN
+    N = len(polygon_geometry)
+    A = target.get_data(scaling=False)
+    inside = labels >= 0
+    counts = _bincount(labels[inside], minlength=N)
+
+    inside *= numpy.logical_not(numpy.isnan(A))
+    sums = _bincount(labels[inside], weights=A[inside], minlength=N)
+
+    if attribute_name is None:
+        attribute_name = target.get_name()
+
+    new_attributes = []
+    for i, attributes in enumerate(source.get_data()):
+        attr = attributes.copy()
+        attr[attribute_name] = sums[i]
+        attr['cell_count'] = int(counts[i])
+        new_attributes.append(attr)
+
+    return Vector(data=new_attributes,
+                  projection=source.get_projection(),
+                  geometry=polygon_geometry,
+                  geometry_type='polygon',
+                  name=layer_name)
+
+
 def interpolate_raster_vector_points(source, target,
                                      layer_name=None,
                                      attribute_name=None,
-                                     mode='linear'):
+                                     mode='linear',
+                                     windowed=False):
     """Interpolate from raster layer to point data
 
     Args:
@@ -391,6 +591,9 @@ def interpolate_raster_vector_points(source, target,
               If None (default) the name of layer source is used
         * mode: 'linear' or 'constant' - determines whether interpolation
               from grid to points should be bilinear or piecewise constant
+        * windowed: If True, only the raster windows covering target
+              points are read and interpolation is done window by window.
+              If False (default) the whole raster is read.
 
     Output
         I: Vector data set; points located as target with values
@@ -407,23 +610,64 @@ def interpolate_raster_vector_points(source, target,
     verify(target.is_vector)
     verify(target.is_point_data)
 
-    # Get raster data and corresponding x and y axes
-    A = source.get_data(nan=True)
-    longitudes, latitudes = source.get_geometry()
-    verify(len(longitudes) == A.shape[1])
-    verify(len(latitudes) == A.shape[0])
-
     # Get vector point geometry as Nx2 array
     coordinates = numpy.array(target.get_geometry(),
                               dtype='d',
                               copy=False)
-    # Get original attributes
-    attributes = target.get_data()
-
     # Create new attribute and interpolate
+    values = interpolate_raster_coordinates(source, target, coordinates,
+                                            mode=mode, windowed=windowed)
+
+    # Add interpolated attribute to existing attributes and return
+    if target.is_columnar:
+        # Add new column without touching the attributes of target
+        attributes = target.get_columns().copy(deep=False)
+        attributes.set_column(attribute_name, values)
+    else:
+        attributes = target.get_data()
+        N = len(target)
+        for i in range(N):
+            attributes[i][attribute_name] = values[i]
+
+    return Vector(data=attributes,
+                  projection=target.get_projection(),
+                  geometry=coordinates,
+                  name=layer_name)
+
+
+def interpolate_raster_coordinates(source, target, coordinates,
+                                   mode='linear', windowed=False):
+    """Interpolate from raster layer to coordinates of a vector layer
+
+    Args:
+        * source: Raster data set (grid)
+        * target: Vector data set the coordinates were taken from.
+              Only used for error messages.
+        * coordinates: Nx2 array of point coordinates (lon, lat)
+        * mode: 'linear' or 'constant' as for interpolate_raster
+        * windowed: True or False as for
+              interpolate_raster_vector_points
+
+    Returns:
+        * values: Array of length N with values interpolated from source
+
+    Raises:
+        InaSAFEError if interpolation fails
+    """
+
     try:
-        values = interpolate_raster(longitudes, latitudes, A,
-                                    coordinates, mode=mode)
+        if windowed:
+            values = interpolate_raster_windows(source, coordinates,
+                                                mode=mode)
+        else:
+            # Get raster data and corresponding x and y axes
+            A = source.get_data(nan=True)
+            longitudes, latitudes = source.get_geometry()
+            verify(len(longitudes) == A.shape[1])
+            verify(len(latitudes) == A.shape[0])
+
+            values = interpolate_raster(longitudes, latitudes, A,
+                                        coordinates, mode=mode)
     except (BoundsError, InaSAFEError), e:
         msg = (tr('Could not interpolate from raster layer %(raster)s to '
                  'vector layer %(vector)s. Error message: %(error)s')
@@ -432,17 +676,208 @@ def interpolate_raster_vector_points(source, target,
                   'error': str(e)})
         raise InaSAFEError(msg)
 
-    # Add interpolated attribute to existing attributes and return
-    N = len(target)
-    for i in range(N):
-        attributes[i][attribute_name] = values[i]
+    return values
 
-    return Vector(data=attributes,
+
+def interpolate_raster_vector_lines(source, target,
+                                    layer_name=None,
+                                    attribute_name=None,
+                                    mode='linear',
+                                    delta=None,
+                                    thresholds=None,
+                                    windowed=False):
+    """Interpolate from raster layer to line data
+
+    Args:
+        * source: Raster data set (grid)
+        * target: Vector data set (lines)
+        * layer_name: Optional name of returned interpolated layer.
+              If None the name of target is used for the returned layer.
+        * attribute_name: Name for new attribute.
+              If None (default) the name of layer source is used
+        * mode: 'linear' or 'constant' as for
+              interpolate_raster_vector_points
+        * delta: Maximal distance between points where the raster is
+              sampled along the lines. If None (default) the resolution
+              of the raster is used.
+        * thresholds: Optional increasing sequence of hazard levels
+              defining hazard classes. If None (default) lines are only
+              split where they enter or leave areas without data.
+        * windowed: True or False as for
+              interpolate_raster_vector_points
+
+    Returns:
+        Vector data set of lines. Each line of target is split into runs
+        of points with the same hazard class. Each run carries the
+        attributes of its parent line together with
+
+        * attribute_name: Maximal raster value sampled along the run
+              (NaN for runs without data)
+        * parent_line_id: Index of the line in target
+
+    Note:
+        Lines are densified and the raster is sampled at all points of all
+        lines in one call. Runs are split half way between consecutive
+        points of different class so split positions are accurate to
+        within delta / 2.
+    """
+
+    # Input checks
+    verify(source.is_raster)
+    verify(target.is_vector)
+    verify(target.is_line_data)
+
+    if attribute_name is None:
+        attribute_name = source.get_name()
+
+    if delta is None:
+        geotransform = source.get_geotransform()
+        delta = min(abs(geotransform[1]), abs(geotransform[5]))
+
+    # Sample raster at densified points along all lines
+    line_attributes = target.get_data()
+    points, line_index = densify_lines(target.get_geometry(), delta)
+    values = interpolate_raster_coordinates(source, target, points,
+                                            mode=mode, windowed=windowed)
+
+    # Hazard class of each point with -1 for no data
+    nodata = numpy.isnan(values)
+    if thresholds is None:
+        classes = numpy.zeros(len(values), dtype=numpy.int)
+    else:
+        thresholds = ensure_numeric(thresholds, numpy.float)
+        verify(numpy.all(numpy.diff(thresholds) > 0),
+               'Thresholds must be increasing. I got %s' % thresholds)
+        classes = numpy.searchsorted(thresholds, values, side='right')
+    classes[nodata] = -1
+
+    # Runs start at the first point of each line and where class changes
+    same_line = line_index[1:] == line_index[:-1]
+    split = numpy.r_[False, same_line * (classes[1:] != classes[:-1])]
+    starts = numpy.flatnonzero(split + numpy.r_[True,
+                                                numpy.logical_not(same_line)])
+    ends = numpy.r_[starts[1:], len(points)]
+
+    # Maximal value of each run ignoring missing data
+    maxima = numpy.where(nodata, -numpy.inf, values)
+    if len(starts) > 0:
+        maxima = numpy.maximum.reduceat(maxima, starts)
+    maxima[numpy.isinf(maxima)] = numpy.nan
+
+    # Create one line per run. Consecutive runs of the same line share the
+    # point half way between their samples.
+    new_geometry = []
+    new_attributes = []
+    for i, (a, b) in enumerate(zip(starts, ends)):
+        run = points[a:b]
+        if split[a]:
+            run = numpy.r_[(points[a - 1:a] + points[a:a + 1]) / 2, run]
+        if b < len(points) and split[b]:
+            run = numpy.r_[run, (points[b - 1:b] + points[b:b + 1]) / 2]
+
+        j = line_index[a]
+        attr = line_attributes[j].copy()
+        attr[attribute_name] = maxima[i]
+        attr['parent_line_id'] = int(j)
+
+        new_geometry.append(run)
+        new_attributes.append(attr)
+
+    return Vector(data=new_attributes,
                   projection=target.get_projection(),
-                  geometry=coordinates,
+                  geometry=new_geometry,
+                  geometry_type='line',
                   name=layer_name)
 
 
+def interpolate_raster_windows(source, coordinates, mode='linear',
+                               tile_size=512):
+    """Interpolate from raster layer to points reading one window at a time
+
+    Args:
+        * source: Raster data set (grid)
+        * coordinates: Nx2 array of point coordinates (lon, lat)
+        * mode: 'linear' or 'constant' as for interpolate_raster
+        * tile_size: Approximate number of pixels along each side of the
+              windows read from the raster. Windows are aligned to the
+              natural blocks of the raster file.
+
+    Returns:
+        * values: Array of length N with values interpolated from source.
+              Points outside the raster are assigned NaN.
+
+    Note:
+        Points are grouped by the raster tile they fall in. Each tile is
+        read with a halo of one pixel so that bilinear interpolation
+        uses the same four neighbours as when the whole raster is read.
+        Only tiles containing points are read so memory use scales with
+        the extent of the points rather than that of the raster.
+    """
+
+    coordinates = ensure_numeric(coordinates, numpy.float)
+    N = coordinates.shape[0]
+    values = numpy.empty(N)
+    values[:] = numpy.nan
+    if N == 0:
+        return values
+
+    geotransform = source.get_geotransform()
+    columns = source.columns
+    rows = source.rows
+
+    # Tile dimensions as multiples of the natural block size
+    tile_dims = []
+    for block in source.get_block_size():
+        if block < tile_size:
+            tile_dims.append(block * (tile_size // block))
+        else:
+            tile_dims.append(tile_size)
+    tile_columns, tile_rows = tile_dims
+
+    # Pixel containing each point
+    old_set = numpy.seterr(invalid='ignore')  # NaN coordinates
+    col = numpy.floor((coordinates[:, 0] - geotransform[0]) /
+                      geotransform[1])
+    row = numpy.floor((coordinates[:, 1] - geotransform[3]) /
+                      geotransform[5])
+    inside = (col >= 0) * (col < columns) * (row >= 0) * (row < rows)
+    numpy.seterr(**old_set)
+
+    # Points outside the raster remain NaN
+    indices = numpy.flatnonzero(inside)
+    col = col[indices].astype(numpy.int)
+    row = row[indices].astype(numpy.int)
+
+    # Group points by tile
+    number_of_tile_columns = (columns + tile_columns - 1) // tile_columns
+    tile = ((row // tile_rows) * number_of_tile_columns +
+            col // tile_columns)
+    order = numpy.argsort(tile, kind='mergesort')
+    indices = indices[order]
+    tile = tile[order]
+    starts = numpy.flatnonzero(numpy.r_[True, tile[1:] != tile[:-1]])
+    ends = numpy.r_[starts[1:], len(tile)]
+
+    for start, end in zip(starts, ends):
+        tile_row, tile_column = divmod(tile[start], number_of_tile_columns)
+
+        # Window covering tile with one pixel halo
+        xoff = max(tile_column * tile_columns - 1, 0)
+        yoff = max(tile_row * tile_rows - 1, 0)
+        xend = min((tile_column + 1) * tile_columns + 1, columns)
+        yend = min((tile_row + 1) * tile_rows + 1, rows)
+        window = (xoff, yoff, xend - xoff, yend - yoff)
+
+        A = source.get_data(nan=True, window=window)
+        longitudes, latitudes = source.get_geometry(window=window)
+
+        points = indices[start:end]
+        values[points] = interpolate_raster(longitudes, latitudes, A,
+                                            coordinates[points], mode=mode)
+
+    return values
+
+
 def interpolate_polygon_points(source, target,
                                layer_name=None):
     """Interpolate from polygon vector layer to point vector data
@@ -498,6 +933,10 @@ def interpolate_polygon_points(source, target,
         for key in attribute_names:
             a[key] = None
 
+    # Build spatial index over points once so that each polygon only
+    # needs to test the points that fall inside its bounding box
+    point_index = BoundingBoxIndex(points)
+
     # Traverse polygons and assign attributes to points that fall inside
     for i, polygon in enumerate(geom):
         # Carry all attributes across from source
@@ -506,9 +945,15 @@ def interpolate_polygon_points(source, target,
         # Assign default attribute to indicate points inside
         poly_attr[DEFAULT_ATTRIBUTE] = True
 
-        # Clip data points by polygons and add polygon attributes
-        indices = inside_polygon(points, polygon.outer_ring,
-                                 holes=polygon.inner_rings)
+        # Get candidate points from the polygon bounding box
+        prepared = prepare_polygon(polygon)
+        candidates = point_index.query(prepared.bbox)
+        if len(candidates) == 0:
+            continue
+
+        # Clip candidate points by polygons and add polygon attributes
+        local_indices = inside_polygon(points[candidates], prepared)
+        indices = candidates[local_indices]
 
         for k in indices:
             for key in poly_attr:
@@ -559,7 +1004,8 @@ def interpolate_polygon_lines(source, target,
     #clipped_attributes = []
 
     # Clip line lines to polygons
-    lines_covered = clip_lines_by_polygons(lines, polygons)
+    lines_covered = clip_lines_by_polygons(lines, polygons,
+                                           only_intersecting=True)
 
     # Create one new line data layer with joined attributes
     # from polygons and lines
@@ -568,8 +1014,8 @@ def interpolate_polygon_lines(source, target,
     for i in range(len(polygons)):
         # Loop over polygons
 
-        for j in lines_covered[i]:
-            # Loop over parent lines
+        for j in sorted(lines_covered[i]):
+            # Loop over parent lines clipped by polygon i
 
             lines = lines_covered[i][j]
             for line in lines:
@@ -594,18 +1040,91 @@ def interpolate_polygon_lines(source, target,
     return R
 
 
-def interpolate_raster_raster(source, target):
-    """Check for alignment and returns target layer as is
+def interpolate_raster_raster(source, target, mode='linear',
+                              block_size=2 ** 20):
+    """Resample raster layer onto the grid of another raster layer
+
+    Args:
+        * source: Raster data set (grid) to be resampled, e.g. hazard
+        * target: Raster data set (grid) defining the new grid, e.g.
+              exposure
+        * mode: 'linear' (default) for bilinear or 'constant' for
+              nearest neighbour resampling as for interpolate_raster
+        * block_size: Approximate number of target grid cells resampled
+              at a time
+
+    Returns:
+        Raster data set with the values of source at the cell centres of
+        target. Cells outside source are NaN. If both rasters are aligned
+        source is returned as is.
+
+    Note:
+        The target grid is processed in blocks of rows. For each block
+        only the window of source covering it (plus a halo of one pixel)
+        is read so large rasters are resampled without being read whole
+        and without writing temporary files.
     """
 
-    if source.get_geotransform() != target.get_geotransform():
-        msg = ('Intergrid interpolation not implemented here. '
-               'Make sure rasters are aligned and sampled to '
-               'the same resolution')
-        raise InaSAFEError(msg)
-    else:
+    # Input checks
+    verify(source.is_raster)
+    verify(target.is_raster)
+
+    geotransform = target.get_geotransform()
+    if (source.get_geotransform() == geotransform and
+            source.rows == target.rows and source.columns == target.columns):
         # Rasters are aligned, no need to interpolate
-        return target
+        return source
+
+    source_geotransform = source.get_geotransform()
+    for g in [source_geotransform, geotransform]:
+        msg = ('Resampling of rotated rasters is not supported. '
+               'I got geotransform %s' % str(g))
+        verify(g[2] == 0 and g[4] == 0, msg)
+
+    # Cell centres of target grid
+    columns = target.columns
+    rows = target.rows
+    longitudes, latitudes = geotransform_to_axes(geotransform, columns, rows)
+    latitudes = latitudes[::-1]  # Row by row from the top
+
+    def source_cells(coordinates, origin, resolution, n):
+        """Range of source cells covering coordinates with halo
+        """
+        cells = numpy.floor((numpy.array(coordinates) - origin) /
+                            resolution)
+        return (int(numpy.clip(cells.min() - 1, 0, n)),
+                int(numpy.clip(cells.max() + 2, 0, n)))
+
+    xoff, xend = source_cells(longitudes, source_geotransform[0],
+                              source_geotransform[1], source.columns)
+
+    A = numpy.empty((rows, columns))
+    A[:] = numpy.nan
+    block_rows = max(1, block_size // max(columns, 1))
+    for start in xrange(0, rows, block_rows):
+        end = min(start + block_rows, rows)
+        yoff, yend = source_cells(latitudes[start:end],
+                                  source_geotransform[3],
+                                  source_geotransform[5], source.rows)
+        if xend <= xoff or yend <= yoff:
+            # Block is outside source
+            continue
+
+        window = (xoff, yoff, xend - xoff, yend - yoff)
+        data = source.get_data(nan=True, window=window)
+        x, y = source.get_geometry(window=window)
+
+        points = numpy.empty(((end - start) * columns, 2))
+        points[:, 0] = numpy.tile(longitudes, end - start)
+        points[:, 1] = numpy.repeat(latitudes[start:end], columns)
+        values = interpolate_raster(x, y, data, points, mode=mode)
+        A[start:end, :] = values.reshape((end - start, columns))
+
+    return Raster(data=A,
+                  projection=target.get_projection(),
+                  geotransform=geotransform,
+                  name=source.get_name(),
+                  keywords=source.get_keywords())
 
 
 # FIXME (Ole): Not sure this is the place for this function
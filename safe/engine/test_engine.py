@@ -8,16 +8,23 @@ from os.path import join
 # Import InaSAFE modules
 from safe.engine.core import calculate_impact
 from safe.engine.interpolation import interpolate_polygon_raster
+from safe.engine.interpolation import interpolate_polygon_vector
 from safe.engine.interpolation import interpolate_raster_vector_points
+from safe.engine.interpolation import interpolate_raster_vector_lines
+from safe.engine.interpolation import interpolate_raster_windows
+from safe.engine.interpolation import interpolate_raster_raster
 from safe.engine.interpolation import assign_hazard_values_to_exposure_data
 from safe.engine.interpolation import tag_polygons_by_grid
+from safe.engine.interpolation import label_raster_by_polygons
 
 
 from safe.storage.core import read_layer
 from safe.storage.core import write_vector_data
 from safe.storage.core import write_raster_data
 from safe.storage.vector import Vector
+from safe.storage.raster import Raster
 from safe.storage.utilities import DEFAULT_ATTRIBUTE
+from safe.storage.utilities import densify_lines
 
 from safe.common.polygon import separate_points_by_polygon
 from safe.common.polygon import is_inside_polygon, inside_polygon
@@ -27,7 +34,8 @@ from safe.common.interpolation2d import interpolate_raster
 from safe.common.numerics import (normal_cdf,
                                   log_normal_cdf,
                                   erf,
-                                  ensure_numeric)
+                                  ensure_numeric,
+                                  geotransform_to_axes)
 from safe.common.numerics import nan_allclose
 from safe.common.utilities import (VerificationError,
                                    unique_filename,
@@ -908,6 +916,38 @@ class Test_Engine(unittest.TestCase):
         assert numpy.allclose(attributes[23]['grid_value'], 50.0377)
         assert attributes[23]['polygon_id'] == 3
 
+        # Aggregated output agrees with point output
+        Q = interpolate_polygon_raster(H, E,
+                                       layer_name='poly2raster_test',
+                                       attribute_name='grid_value',
+                                       output='polygons')
+        assert len(Q) == N
+        assert Q.is_polygon_data
+        for i, attr in enumerate(Q.get_data()):
+            assert attr['name'] == H.get_data()[i]['name']
+
+            values = [x['grid_value'] for x in attributes
+                      if x['polygon_id'] == i]
+            assert attr['cell_count'] == len(values)
+            assert numpy.allclose(attr['grid_value'], numpy.nansum(values))
+
+        # Raster of polygon ids
+        R = interpolate_polygon_raster(H, E, output='raster')
+        ids = R.get_data()
+        assert ids.shape == E.get_data().shape
+        assert numpy.allclose(R.get_geotransform(), E.get_geotransform())
+        for i, attr in enumerate(Q.get_data()):
+            assert numpy.sum(ids == i) == attr['cell_count']
+        assert numpy.sum(numpy.isnan(ids)) == (ids.size -
+                                               len(attributes))
+
+        # Layers without polygons give no aggregated values
+        empty = Vector(data=[], geometry=[], geometry_type='polygon',
+                       projection=H.get_projection())
+        Q = label_raster_by_polygons(empty, E, [])
+        assert len(Q) == 0
+        assert Q.is_polygon_data
+
     def test_tagging_polygons_by_raster_values(self):
         """Polygons can be tagged by raster values
 
@@ -1723,6 +1763,179 @@ class Test_Engine(unittest.TestCase):
 
     test_interpolation_lembang.slow = True
 
+    def test_interpolation_windowed(self):
+        """Windowed interpolation from raster matches reading whole raster
+        """
+
+        hazard_filename = '%s/lembang_mmi_hazmap.asc' % TESTDATA
+        exposure_filename = '%s/test_buildings.shp' % TESTDATA
+
+        hazard_raster = read_layer(hazard_filename)
+        exposure_vector = read_layer(exposure_filename)
+        assert not hazard_raster.is_loaded()
+
+        # Window is a part of the whole grid
+        window = (3, 2, 10, 7)
+        A = hazard_raster.get_data(nan=True)
+        W = hazard_raster.get_data(nan=True, window=window)
+        assert nan_allclose(W, A[2:9, 3:13], rtol=0, atol=0)
+        longitudes, latitudes = hazard_raster.get_geometry()
+        x, y = hazard_raster.get_geometry(window=window)
+        assert numpy.allclose(x, longitudes[3:13])
+        assert numpy.allclose(y, latitudes[::-1][2:9][::-1])
+
+        for mode in ['linear', 'constant']:
+            I = interpolate_raster_vector_points(hazard_raster,
+                                                 exposure_vector,
+                                                 attribute_name='MMI',
+                                                 mode=mode,
+                                                 windowed=False)
+            refs = [x['MMI'] for x in I.get_data()]
+
+            I = interpolate_raster_vector_points(hazard_raster,
+                                                 exposure_vector,
+                                                 attribute_name='MMI',
+                                                 mode=mode,
+                                                 windowed=True)
+            vals = [x['MMI'] for x in I.get_data()]
+            assert nan_allclose(vals, refs, rtol=0, atol=0)
+
+            # Small tiles and points outside the raster
+            points = numpy.concatenate([exposure_vector.get_geometry(),
+                                        [[0, 0], [numpy.nan, 0]]])
+            vals = interpolate_raster_windows(hazard_raster, points,
+                                              mode=mode, tile_size=3)
+            assert nan_allclose(vals[:-2], refs, rtol=0, atol=0)
+            assert numpy.all(numpy.isnan(vals[-2:]))
+
+    def test_interpolation_raster_to_lines(self):
+        """Raster interpolation to lines splits lines by hazard class
+        """
+
+        hazard_filename = join(HAZDATA,
+                               'Flood_Current_Depth_Jakarta_geographic.asc')
+        exposure_filename = join(TESTDATA, 'indonesia_highway_sample.shp')
+
+        H = read_layer(hazard_filename)
+        E = read_layer(exposure_filename)
+        E_geometry = E.get_geometry()
+        E_attributes = E.get_data()
+
+        def length(line):
+            d = numpy.diff(numpy.array(line), axis=0)
+            return numpy.sqrt((d * d).sum(axis=1)).sum()
+
+        # Default is to split where lines leave the data only
+        I = assign_hazard_values_to_exposure_data(H, E,
+                                                  attribute_name='depth')
+        assert I.is_line_data
+        assert len(I) >= len(E)
+
+        thresholds = [0.1, 1.0]
+        I = interpolate_raster_vector_lines(H, E, attribute_name='depth',
+                                            thresholds=thresholds)
+        I_geometry = I.get_geometry()
+        I_attributes = I.get_data()
+
+        # Thresholds are available through the high level wrapper
+        J = assign_hazard_values_to_exposure_data(H, E,
+                                                  attribute_name='depth',
+                                                  thresholds=thresholds)
+        assert len(J) == len(I)
+        assert ([a['parent_line_id'] for a in J.get_data()] ==
+                [a['parent_line_id'] for a in I_attributes])
+
+        lengths = numpy.zeros(len(E))
+        previous = None
+        for line, attributes in zip(I_geometry, I_attributes):
+            j = attributes['parent_line_id']
+            lengths[j] += length(line)
+
+            # Original attributes are carried forward
+            for key in E_attributes[j]:
+                assert attributes[key] == E_attributes[j][key]
+
+            # Consecutive runs of the same line differ in class
+            depth = attributes['depth']
+            if numpy.isnan(depth):
+                hazard_class = -1
+            else:
+                hazard_class = numpy.searchsorted(thresholds, depth,
+                                                  side='right')
+            if previous is not None and previous[0] == j:
+                assert previous[1] != hazard_class
+                assert numpy.allclose(previous[2], line[0])
+            previous = (j, hazard_class, line[-1])
+
+        # Runs cover the original lines exactly
+        ref = numpy.array([length(line) for line in E_geometry])
+        assert numpy.allclose(lengths, ref)
+
+        # Maximal depth along each line matches point interpolation
+        geotransform = H.get_geotransform()
+        delta = min(abs(geotransform[1]), abs(geotransform[5]))
+        longitudes, latitudes = H.get_geometry()
+        A = H.get_data(nan=True)
+        maxima = {}
+        for attributes in I_attributes:
+            j = attributes['parent_line_id']
+            if not numpy.isnan(attributes['depth']):
+                maxima[j] = max(maxima.get(j, -numpy.inf),
+                                attributes['depth'])
+        for j in range(min(50, len(E))):
+            points, _ = densify_lines([E_geometry[j]], delta)
+            values = interpolate_raster(longitudes, latitudes, A, points)
+            if numpy.all(numpy.isnan(values)):
+                assert j not in maxima
+            else:
+                assert numpy.allclose(maxima[j], numpy.nanmax(values))
+
+    test_interpolation_raster_to_lines.slow = True
+
+    def test_interpolation_raster_to_raster(self):
+        """Raster is resampled onto the grid of another raster
+        """
+
+        hazard_filename = join(HAZDATA,
+                               'Flood_Current_Depth_Jakarta_geographic.asc')
+        H = read_layer(hazard_filename)
+        longitudes, latitudes = H.get_geometry()
+        A = H.get_data(nan=True)
+
+        # Aligned rasters need no resampling
+        assert interpolate_raster_raster(H, H) is H
+
+        # Coarser exposure grid shifted and extending beyond the hazard
+        g = H.get_geotransform()
+        geotransform = (g[0] - 7.3 * g[1], g[1] * 2.7, 0,
+                        g[3] + 3.1 * g[5], 0, g[5] * 3.3)
+        columns = int(H.columns / 2.7) + 5
+        rows = int(H.rows / 3.3) + 5
+        E = Raster(data=numpy.zeros((rows, columns)),
+                   projection=H.get_projection(),
+                   geotransform=geotransform,
+                   name='exposure')
+
+        x, y = geotransform_to_axes(geotransform, columns, rows)
+        points = numpy.zeros((rows * columns, 2))
+        points[:, 0] = numpy.tile(x, rows)
+        points[:, 1] = numpy.repeat(y[::-1], columns)
+        for mode in ['linear', 'constant']:
+            ref = interpolate_raster(longitudes, latitudes, A, points,
+                                     mode=mode).reshape((rows, columns))
+
+            I = assign_hazard_values_to_exposure_data(H, E, mode=mode)
+            assert I.get_geotransform() == geotransform
+            assert I.get_name() == H.get_name()
+            assert nan_allclose(I.get_data(), ref, rtol=0, atol=0)
+
+            # Edges of the exposure grid are outside the hazard
+            assert numpy.all(numpy.isnan(I.get_data()[:, -2:]))
+
+            # Small blocks read small windows of the hazard raster
+            I = interpolate_raster_raster(H, E, mode=mode, block_size=100)
+            assert nan_allclose(I.get_data(), ref, rtol=0, atol=0)
+
     def test_interpolation_tsunami(self):
         """Interpolation using tsunami data set works
 
@@ -2070,6 +2283,54 @@ class Test_Engine(unittest.TestCase):
 
     test_interpolation_from_polygons_multiple.slow = True
 
+    def test_interpolation_from_polygons_to_polygons(self):
+        """Polygon interpolation to polygons by area of intersection works
+        """
+
+        square = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=float)
+
+        # Two hazard zones side by side
+        H = Vector(data=[{'depth': 1.0}, {'depth': 2.0}],
+                   geometry=[square * 2, square * 2 + [2, 0]])
+
+        # Buildings fully inside, straddling and outside the zones
+        E = Vector(data=[{'id': 0}, {'id': 1}, {'id': 2}, {'id': 3}],
+                   geometry=[square / 2 + [0.5, 0.5],
+                             square + [1.25, 0.5],
+                             square + [3.5, 1.75],
+                             square + [10, 10]])
+
+        I = interpolate_polygon_vector(H, E, layer_name='depth',
+                                       overlay=True)
+        assert I.is_polygon_data
+        assert I.get_name() == 'depth'
+        assert len(I) == 4
+
+        attributes = I.get_data()
+        assert [a['id'] for a in attributes] == [0, 1, 2, 3]
+        assert [a['depth'] for a in attributes] == [1.0, 1.0, 2.0, None]
+        assert [a['polygon_id'] for a in attributes] == [0, 0, 1, None]
+        assert [a[DEFAULT_ATTRIBUTE] for a in attributes] == [True, True,
+                                                              True, None]
+        assert numpy.allclose([a['area_frac'] for a in attributes],
+                              [1.0, 0.75, 0.125, 0.0])
+
+        # Hazard attributes are left untouched
+        assert H.get_data() == [{'depth': 1.0}, {'depth': 2.0}]
+
+        # Centroids remain the default
+        I = interpolate_polygon_vector(H, E)
+        attributes = I.get_data()
+        assert I.is_polygon_data
+        assert [a['depth'] for a in attributes] == [1.0, 1.0, None, None]
+        assert 'area_frac' not in attributes[0]
+
+        # Overlay is available through the high level wrapper
+        I = assign_hazard_values_to_exposure_data(H, E, layer_name='depth',
+                                                  overlay=True)
+        assert numpy.allclose([a['area_frac'] for a in I.get_data()],
+                              [1.0, 0.75, 0.125, 0.0])
+
     def test_interpolation_from_polygons_error_handling(self):
         """Interpolation using polygons handles input errors as expected
 
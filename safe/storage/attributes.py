@@ -0,0 +1,365 @@
+# coding=utf-8
+"""**Columnar storage of vector attributes**
+
+.. tip:: Attributes of vector layers are normally held as one dictionary per
+   feature. An AttributeTable holds them as one numpy array per attribute
+   instead which is far more compact for large layers and allows whole
+   columns to be read or added in one operation. Dictionary like views of
+   each row are provided for backwards compatibility.
+
+"""
+
+import copy as copy_module
+import numpy
+from UserDict import DictMixin
+
+from safe.common.utilities import verify
+from safe.common.exceptions import InaSAFEError
+
+
+def _column_kind(value):
+    """Get numpy dtype kind able to hold value without changing its type
+
+    :param value: Attribute value
+    :type value: object
+
+    :returns: 'b', 'i' or 'f' for booleans, integers and floats.
+        'O' for all other values.
+    :rtype: str
+    """
+
+    if isinstance(value, (bool, numpy.bool_)):
+        return 'b'
+    elif isinstance(value, (int, long, numpy.integer)):
+        return 'i'
+    elif isinstance(value, (float, numpy.floating)):
+        return 'f'
+    else:
+        return 'O'
+
+
+def make_column(values):
+    """Convert sequence of attribute values to a numpy array
+
+    :param values: Sequence of values for one attribute
+    :type values: list, numpy.ndarray
+
+    :returns: Boolean, integer or float array if all values are of
+        that type. Otherwise an object array holding the values as is.
+    :rtype: numpy.ndarray
+    """
+
+    if isinstance(values, numpy.ndarray) and values.ndim == 1:
+        if values.dtype.kind in 'bifO':
+            return values
+        else:
+            # E.g. strings are held as Python objects
+            return _object_column(values.tolist())
+
+    values = list(values)
+    kinds = set([_column_kind(value) for value in values])
+    if len(kinds) == 1 and 'O' not in kinds:
+        dtype = {'b': numpy.bool, 'i': numpy.int, 'f': numpy.float}
+        return numpy.array(values, dtype=dtype[kinds.pop()])
+
+    return _object_column(values)
+
+
+def _object_column(values):
+    """Store list of values in an object array
+
+    Values are assigned one by one so that sequences are kept as values
+    """
+
+    column = numpy.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        column[i] = value
+    return column
+
+
+class AttributeTable(object):
+    """Attributes of vector features held as one array per attribute
+
+    Args:
+        * columns: Dictionary of attribute names and sequences of values.
+              All sequences must have the same length.
+        * names: Optional list of attribute names giving their order.
+              If None the keys of columns are used in sorted order.
+
+    Note:
+        Columns are converted with make_column. Numeric arrays are used as
+        is without copying. Values are returned as Python objects so rows
+        behave exactly like the dictionaries used for list based
+        attributes.
+
+        Assigning a value of a different type to an element of a numeric
+        column converts that column to an object array.
+
+        Columns may be shared with copies of the table (see copy). Such
+        columns are copied before they are first changed through
+        set_value or handed out by get_column.
+    """
+
+    def __init__(self, columns=None, names=None):
+        if columns is None:
+            columns = {}
+        if names is None:
+            names = sorted(columns.keys())
+
+        msg = ('Attribute names %s must match the columns %s'
+               % (names, columns.keys()))
+        verify(sorted(names) == sorted(columns.keys()), msg)
+
+        self.names = []
+        self.columns = {}
+        self.size = None
+        self._rows = None
+        self._shared = set()
+        for name in names:
+            self.set_column(name, columns[name])
+
+        if self.size is None:
+            self.size = 0
+
+    @classmethod
+    def from_records(cls, records):
+        """Create table from list of dictionaries
+
+        :param records: List with one dictionary of attributes per feature
+        :type records: list
+
+        :returns: AttributeTable instance. Attributes missing from some
+            records are None for those records.
+        """
+
+        names = []
+        seen = set()
+        for record in records:
+            for name in record.keys():
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+
+        columns = {}
+        for name in names:
+            columns[name] = make_column([record.get(name)
+                                         for record in records])
+
+        table = cls(columns, names=names)
+        table.size = len(records)
+        return table
+
+    def __len__(self):
+        """Number of rows (features) in table
+        """
+        return self.size
+
+    def __contains__(self, name):
+        """Check if table has attribute name
+        """
+        return name in self.columns
+
+    def __getstate__(self):
+        """Pickle columns without the cached row views
+        """
+        state = self.__dict__.copy()
+        state['_rows'] = None
+        return state
+
+    def get_column(self, name, writable=True):
+        """Get all values of one attribute
+
+        :param name: Attribute name
+        :type name: str
+
+        :param writable: If True (default) a column shared with another
+            table (see copy) is first replaced by a copy so that the
+            returned array can be modified. If False the stored column is
+            returned as is and must not be modified.
+        :type writable: bool
+
+        :returns: Array of values. This is the stored column, not a copy.
+        :rtype: numpy.ndarray
+        """
+
+        msg = ('Specified attribute %s does not exist. Valid names are %s'
+               % (name, self.names))
+        verify(name in self.columns, msg)
+        if writable and name in self._shared:
+            self._unshare(name)
+        return self.columns[name]
+
+    def set_column(self, name, values):
+        """Add or replace all values of one attribute
+
+        :param name: Attribute name
+        :type name: str
+
+        :param values: Sequence of values with one value per row
+        :type values: list, numpy.ndarray
+        """
+
+        column = make_column(values)
+        if self.size is None:
+            self.size = len(column)
+
+        msg = ('Attribute %s must have %i values. I got %i'
+               % (name, self.size, len(column)))
+        verify(len(column) == self.size, msg)
+
+        if name not in self.columns:
+            self.names.append(name)
+        self.columns[name] = column
+        self._shared.discard(name)
+
+    def get_value(self, index, name):
+        """Get value of one attribute for one row
+
+        :param index: Row index
+        :type index: int
+
+        :param name: Attribute name
+        :type name: str
+
+        :returns: Value as a Python object
+        """
+
+        value = self.columns[name][index]
+        if isinstance(value, numpy.generic):
+            value = value.item()
+        return value
+
+    def set_value(self, index, name, value):
+        """Set value of one attribute for one row
+
+        :param index: Row index
+        :type index: int
+
+        :param name: Attribute name. A new column filled with None is
+            created if it does not exist.
+        :type name: str
+
+        :param value: New value
+        """
+
+        if name not in self.columns:
+            self.set_column(name, make_column([None] * self.size))
+
+        column = self.columns[name]
+        kind = column.dtype.kind
+        if kind != 'O' and _column_kind(value) != kind:
+            column = _object_column(column.tolist())
+            self.columns[name] = column
+            self._shared.discard(name)
+        elif name in self._shared:
+            column = self._unshare(name)
+        column[index] = value
+
+    def _unshare(self, name):
+        """Replace column shared with another table by a copy
+        """
+
+        column = self.columns[name].copy()
+        self.columns[name] = column
+        self._shared.discard(name)
+        return column
+
+    def get_rows(self):
+        """Get list of dictionary like views of each row
+
+        :returns: List of AttributeRow instances. Assigning to a row
+            updates the table.
+        :rtype: list
+        """
+
+        if self._rows is None:
+            self._rows = [AttributeRow(self, i) for i in xrange(self.size)]
+        return self._rows
+
+    def to_records(self):
+        """Convert table to list of dictionaries
+
+        :returns: List with one new dictionary per row
+        :rtype: list
+        """
+
+        columns = [self.columns[name].tolist() for name in self.names]
+        return [dict(zip(self.names, values)) for values in zip(*columns)]
+
+    def copy(self, deep=True):
+        """Copy table
+
+        :param deep: If True (default) the columns are copied including
+            any objects they hold. If False the new table shares the
+            column arrays with this one (copy on write). Either table
+            copies a shared column before it is first changed, so neither
+            table affects the other. Objects held in object columns are
+            shared as is.
+        :type deep: bool
+
+        :returns: AttributeTable instance
+        """
+
+        columns = {}
+        for name in self.names:
+            column = self.columns[name]
+            if deep:
+                if column.dtype.kind == 'O':
+                    column = _object_column(copy_module.deepcopy(
+                        column.tolist()))
+                else:
+                    column = column.copy()
+            columns[name] = column
+
+        table = AttributeTable(columns, names=self.names)
+        table.size = self.size
+        if not deep:
+            self._shared.update(self.names)
+            table._shared.update(self.names)
+        return table
+
+
+class AttributeRow(DictMixin):
+    """Dictionary like view of the attributes of one feature
+
+    Args:
+        * table: AttributeTable instance
+        * index: Row index
+    """
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, name):
+        if name not in self.table.columns:
+            raise KeyError(name)
+        return self.table.get_value(self.index, name)
+
+    def __setitem__(self, name, value):
+        self.table.set_value(self.index, name, value)
+
+    def __delitem__(self, name):
+        msg = ('Attribute %s cannot be removed from one row of a '
+               'columnar attribute table' % name)
+        raise InaSAFEError(msg)
+
+    def __contains__(self, name):
+        return name in self.table.columns
+
+    def __iter__(self):
+        return iter(self.table.names)
+
+    def __len__(self):
+        return len(self.table.names)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def keys(self):
+        return list(self.table.names)
+
+    def copy(self):
+        """Get attributes of this row as a new dictionary
+        """
+        return dict(self.iteritems())
@@ -0,0 +1,119 @@
+# coding=utf-8
+"""**Least recently used cache for blocks of raster data**
+
+.. tip:: Raster layers read from file keep the blocks (tiles) of data read
+   by windowed calls to get_data in a BlockCache so that overlapping or
+   repeated windows are not read and converted again. The cache is bounded
+   by a memory budget in bytes and drops the least recently used blocks
+   when the budget is exceeded.
+
+"""
+
+from collections import OrderedDict
+
+from safe.common.utilities import verify
+
+# Default memory budget for cached blocks of each raster layer in bytes
+DEFAULT_CACHE_SIZE = 2 ** 27
+
+
+class BlockCache(object):
+    """Least recently used cache of numpy arrays with a memory budget
+
+    Args:
+        * max_bytes: Maximal total size of the cached arrays in bytes.
+              If 0 nothing is cached.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        msg = 'Cache size must be non negative. I got %s' % max_bytes
+        verify(max_bytes >= 0, msg)
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._blocks = OrderedDict()
+        self._sizes = {}
+
+    def __len__(self):
+        """Number of cached blocks
+        """
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def get(self, key):
+        """Get cached block and mark it as most recently used
+
+        :param key: Block identifier
+        :type key: tuple
+
+        :returns: Cached array or None if block is not in the cache
+        :rtype: numpy.ndarray
+        """
+
+        block = self._blocks.pop(key, None)
+        if block is not None:
+            self._blocks[key] = block
+        return block
+
+    def put(self, key, block, nbytes=None):
+        """Add block to the cache
+
+        Least recently used blocks are dropped until the cache is within
+        its budget. Blocks larger than the budget are not cached.
+
+        :param key: Block identifier
+        :type key: tuple
+
+        :param block: Block of data
+        :type block: numpy.ndarray
+
+        :param nbytes: Size of block in bytes. If None, block.nbytes is
+            used. This allows other objects than arrays to be cached.
+        :type nbytes: int
+        """
+
+        if nbytes is None:
+            nbytes = block.nbytes
+
+        if key in self._blocks:
+            self.nbytes -= self._sizes.pop(key)
+            del self._blocks[key]
+
+        if nbytes > self.max_bytes:
+            return
+
+        while self.nbytes + nbytes > self.max_bytes:
+            self._drop_oldest()
+
+        self._blocks[key] = block
+        self._sizes[key] = nbytes
+        self.nbytes += nbytes
+
+    def _drop_oldest(self):
+        """Drop least recently used block
+        """
+        key, _ = self._blocks.popitem(last=False)
+        self.nbytes -= self._sizes.pop(key)
+
+    def resize(self, max_bytes):
+        """Change memory budget dropping blocks as needed
+
+        :param max_bytes: New budget in bytes
+        :type max_bytes: int
+        """
+
+        msg = 'Cache size must be non negative. I got %s' % max_bytes
+        verify(max_bytes >= 0, msg)
+
+        self.max_bytes = max_bytes
+        while self.nbytes > self.max_bytes:
+            self._drop_oldest()
+
+    def clear(self):
+        """Drop all cached blocks
+        """
+        self._blocks.clear()
+        self._sizes.clear()
+        self.nbytes = 0
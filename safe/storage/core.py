@@ -8,6 +8,7 @@ import os
 
 from vector import Vector
 from raster import Raster
+from layer_cache import LayerCache
 from safe.common.utilities import verify, VerificationError
 from safe.common.exceptions import BoundingBoxError, ReadLayerError
 
@@ -16,16 +17,42 @@ import logging
 logger = logging.getLogger('inasafe')
 
 
-def read_layer(filename):
+# Layers read by read_layer with cache=True
+LAYER_CACHE = LayerCache()
+
+
+def read_layer(filename, sublayer=None, cache=False):
     """Read spatial layer from file.
     This can be either raster or vector data.
+
+    Args:
+        * filename: Raster or vector file
+        * sublayer: Optional vector sublayer (e.g. sqlite table) to read
+        * cache: If True the layer is kept in LAYER_CACHE and later calls
+              with cache=True for unchanged files return a new layer
+              sharing its data without reading the file again.
+              Default False.
+
+    Note:
+        Layers returned from the cache can be modified without affecting
+        it. See copy_cached_layer in module layer_cache.
+    """
+
+    if cache:
+        return LAYER_CACHE.get_layer(filename, _read_layer,
+                                     sublayer=sublayer)
+    return _read_layer(filename, sublayer)
+
+
+def _read_layer(filename, sublayer=None):
+    """Read spatial layer from file without caching
     """
 
     _, ext = os.path.splitext(filename)
     if ext in ['.asc', '.tif', '.nc']:
         return Raster(filename)
-    elif ext in ['.shp', '.sqlite']:
-        return Vector(filename)
+    elif ext in ['.shp', '.sqlite', '.gpkg']:
+        return Vector(filename, sublayer=sublayer)
     else:
         msg = ('Could not read %s. '
                'Extension "%s" has not been implemented' % (filename, ext))
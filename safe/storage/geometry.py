@@ -1,3 +1,8 @@
+import numpy
+
+from safe.common.polygon import _bincount
+from safe.common.utilities import verify
+
 # Geometry types
 
 
@@ -28,3 +33,250 @@ class Polygon(Geometry):
         s = 'Polygon(%s, inner_rings=%s' % (self.outer_ring,
                                             self.inner_rings)
         return s
+
+
+class GeometryBuffer(object):
+    """Line or polygon geometries held in one flat coordinate array
+
+    Args:
+        * coordinates: Mx2 array of the vertex coordinates of all rings
+        * ring_offsets: Array of R + 1 indices into coordinates. Ring k
+              consists of vertices ring_offsets[k]:ring_offsets[k + 1]
+        * feature_offsets: Array of N + 1 indices into rings. Feature i
+              consists of rings feature_offsets[i]:feature_offsets[i + 1]
+        * geometry_type: 'line' or 'polygon'
+
+    Note:
+        The first ring of each polygon is its outer ring and any following
+        rings are its inner rings (holes). Each line has exactly one ring.
+
+        Geometries are returned as views into the coordinate array which
+        are created when first requested. Vertices changed in place through
+        these views change the buffer. Bounding boxes and centroids of all
+        features are calculated from the current coordinates at once
+        without looping over features.
+    """
+
+    def __init__(self, coordinates, ring_offsets, feature_offsets,
+                 geometry_type='polygon'):
+
+        msg = ('Geometry type must be either "line" or "polygon". '
+               'I got %s' % geometry_type)
+        verify(geometry_type in ['line', 'polygon'], msg)
+
+        self.coordinates = numpy.ascontiguousarray(coordinates,
+                                                   dtype=numpy.float64)
+        self.coordinates = self.coordinates.reshape((-1, 2))
+        self.ring_offsets = numpy.asarray(ring_offsets, dtype=numpy.int)
+        self.feature_offsets = numpy.asarray(feature_offsets,
+                                             dtype=numpy.int)
+        self.geometry_type = geometry_type
+
+        msg = 'Offsets must start at 0 and end at the number of items'
+        verify(self.ring_offsets[0] == 0 and
+               self.ring_offsets[-1] == len(self.coordinates), msg)
+        verify(self.feature_offsets[0] == 0 and
+               self.feature_offsets[-1] == len(self.ring_offsets) - 1, msg)
+        if geometry_type == 'line':
+            msg = 'Each line must consist of exactly one ring'
+            verify(numpy.all(numpy.diff(self.feature_offsets) == 1), msg)
+
+        self._features = None
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Create buffer from list of Nx2 arrays of line vertices
+        """
+
+        return cls._from_rings([[line] for line in lines], 'line')
+
+    @classmethod
+    def from_polygons(cls, polygons):
+        """Create buffer from list of polygons
+
+        Polygons are either Polygon instances or Nx2 arrays of vertices
+        of their outer ring.
+        """
+
+        rings = []
+        for polygon in polygons:
+            if isinstance(polygon, Polygon):
+                rings.append([polygon.outer_ring] + list(polygon.inner_rings))
+            else:
+                rings.append([polygon])
+        return cls._from_rings(rings, 'polygon')
+
+    @classmethod
+    def _from_rings(cls, features, geometry_type):
+        """Create buffer from list of lists of rings for each feature
+        """
+
+        rings = [numpy.asarray(ring, dtype=numpy.float64).reshape((-1, 2))
+                 for feature in features for ring in feature]
+        ring_sizes = [len(ring) for ring in rings]
+        feature_sizes = [len(feature) for feature in features]
+
+        if len(rings) > 0:
+            coordinates = numpy.concatenate(rings)
+        else:
+            coordinates = numpy.zeros((0, 2))
+
+        ring_offsets = numpy.zeros(len(rings) + 1, dtype=numpy.int)
+        ring_offsets[1:] = numpy.cumsum(ring_sizes)
+        feature_offsets = numpy.zeros(len(features) + 1, dtype=numpy.int)
+        feature_offsets[1:] = numpy.cumsum(feature_sizes)
+
+        return cls(coordinates, ring_offsets, feature_offsets,
+                   geometry_type=geometry_type)
+
+    def __len__(self):
+        """Number of features
+        """
+        return len(self.feature_offsets) - 1
+
+    def __getstate__(self):
+        """Pickle the arrays only
+        """
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def get_ring(self, k):
+        """Get vertices of ring k as a view into the coordinate array
+        """
+        return self.coordinates[self.ring_offsets[k]:
+                                self.ring_offsets[k + 1]]
+
+    def get_features(self):
+        """Get geometry of each feature
+
+        Returns:
+            * List of Nx2 arrays for lines and list of Polygon instances
+              for polygons. All rings are views into the coordinate array.
+        """
+
+        if self._features is None:
+            rings = numpy.split(self.coordinates, self.ring_offsets[1:-1])
+            if self.geometry_type == 'line':
+                self._features = rings
+            else:
+                offsets = self.feature_offsets
+                self._features = [Polygon(rings[offsets[i]],
+                                          rings[offsets[i] + 1:
+                                                offsets[i + 1]])
+                                  for i in xrange(len(self))]
+        return self._features
+
+    def get_outer_rings(self):
+        """Get list with the outer ring (or line) of each feature
+        """
+
+        if self.geometry_type == 'line':
+            return self.get_features()
+        return [polygon.outer_ring for polygon in self.get_features()]
+
+    def get_bounding_boxes(self):
+        """Get bounding box of each feature
+
+        Returns:
+            * Nx4 array with rows [minx, maxx, miny, maxy]. The bounding
+              box of a polygon is that of its outer ring. Features without
+              vertices get NaN.
+        """
+
+        # First ring of each feature
+        rings = self.feature_offsets[:-1]
+        start = self.ring_offsets[rings]
+        end = self.ring_offsets[rings + 1]
+
+        N = len(self)
+        bboxes = numpy.empty((N, 4))
+        bboxes[:] = numpy.nan
+        valid = end > start
+        if numpy.any(valid):
+            x = self.coordinates[:, 0]
+            y = self.coordinates[:, 1]
+            i = start[valid]
+            j = end[valid]
+            bboxes[valid, 0] = _reduce_runs(numpy.minimum, x, i, j)
+            bboxes[valid, 1] = _reduce_runs(numpy.maximum, x, i, j)
+            bboxes[valid, 2] = _reduce_runs(numpy.minimum, y, i, j)
+            bboxes[valid, 3] = _reduce_runs(numpy.maximum, y, i, j)
+        return bboxes
+
+    def get_extent(self):
+        """Get bounding box [minx, maxx, miny, maxy] of all features
+        """
+
+        bboxes = self.get_bounding_boxes()
+        if len(bboxes) == 0 or numpy.all(numpy.isnan(bboxes)):
+            return [0, 0, 0, 0]
+        return [numpy.nanmin(bboxes[:, 0]), numpy.nanmax(bboxes[:, 1]),
+                numpy.nanmin(bboxes[:, 2]), numpy.nanmax(bboxes[:, 3])]
+
+    def get_centroids(self):
+        """Get centroid of the outer ring of each polygon
+
+        Returns:
+            * Nx2 array of centroids calculated with the same formula as
+              safe.storage.utilities.calculate_polygon_centroid. Rings are
+              assumed to be closed. The area is also calculated relative
+              to the lower left corner of each polygon.
+        """
+
+        msg = 'Centroids are only available for polygon geometries'
+        verify(self.geometry_type == 'polygon', msg)
+
+        # Vertex pairs (i, i + 1) along the outer ring of each polygon
+        rings = self.feature_offsets[:-1]
+        start = self.ring_offsets[rings]
+        end = self.ring_offsets[rings + 1]
+        counts = numpy.maximum(end - start - 1, 0)
+        polygon = numpy.repeat(numpy.arange(len(self)), counts)
+        k = (numpy.arange(counts.sum()) -
+             numpy.repeat(numpy.cumsum(counts) - counts, counts) +
+             numpy.repeat(start, counts))
+
+        # Normalise by lower left corner for numerical accuracy
+        origin = self.get_bounding_boxes()[:, [0, 2]]
+        x0 = self.coordinates[k, 0] - origin[polygon, 0]
+        y0 = self.coordinates[k, 1] - origin[polygon, 1]
+        x1 = self.coordinates[k + 1, 0] - origin[polygon, 0]
+        y1 = self.coordinates[k + 1, 1] - origin[polygon, 1]
+
+        N = len(self)
+        cross = x0 * y1 - y0 * x1
+        area = _bincount(polygon, weights=cross, minlength=N) / 2
+        centroids = numpy.zeros((N, 2))
+        centroids[:, 0] = _bincount(polygon, weights=(x0 + x1) * cross,
+                                    minlength=N)
+        centroids[:, 1] = _bincount(polygon, weights=(y0 + y1) * cross,
+                                    minlength=N)
+        centroids /= 6.0 * area[:, numpy.newaxis]
+
+        return centroids + origin
+
+    def copy(self):
+        """Copy buffer
+        """
+
+        return GeometryBuffer(self.coordinates.copy(),
+                              self.ring_offsets.copy(),
+                              self.feature_offsets.copy(),
+                              geometry_type=self.geometry_type)
+
+
+def _reduce_runs(ufunc, values, start, end):
+    """Reduce non empty runs values[start:end] with a numpy ufunc
+    """
+
+    # Reduceat reduces from each start to the next index given
+    indices = numpy.zeros(2 * len(start), dtype=numpy.int)
+    indices[0::2] = start
+    indices[1::2] = numpy.minimum(end, len(values) - 1)
+    result = ufunc.reduceat(values, indices)[0::2]
+
+    # Runs ending at the last value were cut short by one
+    last = end == len(values)
+    result[last] = ufunc(result[last], values[-1])
+    return result
@@ -0,0 +1,190 @@
+# coding=utf-8
+"""**Cache of layers read from file**
+
+.. tip:: The same exposure and hazard files are often read many times in
+   one session, e.g. by the dock, the batch runner and the realtime
+   pipeline. A LayerCache keeps layers read by read_layer with cache=True
+   keyed on the path and the size and modification time of the files
+   making up the dataset, so unchanged files are parsed only once. Each
+   call returns a new layer sharing the data of the cached one.
+
+"""
+
+import os
+import glob
+import copy as copy_module
+
+from block_cache import BlockCache
+from geometry import GeometryBuffer
+
+# Default memory budget for cached layers in bytes
+DEFAULT_LAYER_CACHE_SIZE = 2 ** 28
+
+
+def get_file_signature(filename):
+    """Get signature identifying the current content of a dataset
+
+    :param filename: Path of raster or vector file
+    :type filename: str
+
+    :returns: Tuple with absolute path and (name, size, modification
+        time, inode) of the file and all files sharing its base name such
+        as .dbf, .prj and .keywords files.
+    :rtype: tuple
+    """
+
+    path = os.path.abspath(filename)
+    base_name = os.path.splitext(path)[0]
+
+    files = set(glob.glob(base_name + '.*'))
+    files.add(path)
+
+    signature = []
+    for name in sorted(files):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            # File does not exist (yet)
+            signature.append((name, None, None, None))
+        else:
+            signature.append((name, stat.st_size, stat.st_mtime,
+                              stat.st_ino))
+    return path, tuple(signature)
+
+
+def get_layer_size(layer):
+    """Estimate memory held by layer in bytes
+
+    :param layer: Raster or Vector layer
+    :type layer: Layer
+
+    :returns: Bytes used by arrays of data and geometry plus an estimate
+        of 100 bytes for each attribute value held as a Python object.
+        Rasters count with the budget of their tile cache which also
+        holds the grids kept by get_data.
+    :rtype: int
+    """
+
+    nbytes = 0
+    if layer.is_raster:
+        if layer.is_loaded():
+            nbytes += layer.data.nbytes
+        block_cache = getattr(layer, 'block_cache', None)
+        if block_cache is not None:
+            nbytes += block_cache.max_bytes
+    else:
+        geometry = getattr(layer, 'geometry', None)
+        if isinstance(geometry, GeometryBuffer):
+            nbytes += (geometry.coordinates.nbytes +
+                       geometry.ring_offsets.nbytes +
+                       geometry.feature_offsets.nbytes)
+        elif geometry is not None:
+            nbytes += 100 * len(geometry)
+
+        if layer.is_columnar:
+            for name in layer.data.names:
+                column = layer.data.get_column(name, writable=False)
+                if column.dtype.kind == 'O':
+                    nbytes += 100 * len(column)
+                else:
+                    nbytes += column.nbytes
+        elif getattr(layer, 'data', None) is not None:
+            nbytes += sum([100 * (len(x) + 1) for x in layer.data])
+    return nbytes
+
+
+def copy_cached_layer(layer):
+    """Create new layer sharing the data of a cached layer
+
+    :param layer: Raster or Vector layer held in a LayerCache
+    :type layer: Layer
+
+    :returns: Layer of the same class with its own keywords and
+        attributes. Rasters share the open file and the tile cache with
+        grids kept by get_data which are read only. Vectors get a copy of
+        the geometry and share columns of attributes until they are
+        changed.
+    :rtype: Layer
+    """
+
+    new_layer = copy_module.copy(layer)
+    new_layer.keywords = copy_module.deepcopy(layer.keywords)
+
+    if layer.is_vector:
+        geometry = layer.geometry
+        if isinstance(geometry, GeometryBuffer):
+            new_layer.geometry = geometry.copy()
+        else:
+            new_layer.geometry = list(geometry)
+
+        if layer.is_columnar:
+            new_layer.data = layer.data.copy(deep=False)
+        else:
+            # Attribute values read from file are immutable
+            new_layer.data = [dict(x) for x in layer.data]
+
+    return new_layer
+
+
+class LayerCache(object):
+    """Least recently used cache of layers read from file
+
+    Args:
+        * max_bytes: Memory budget in bytes (see get_layer_size).
+              If 0 nothing is cached.
+
+    Note:
+        Layers are keyed on the signature of their files (see
+        get_file_signature) and sublayer. Modified files are therefore
+        read again. The counters hits and misses record how many requests
+        were served from the cache and from file.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_LAYER_CACHE_SIZE):
+        self.layers = BlockCache(max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """Number of cached layers
+        """
+        return len(self.layers)
+
+    def get_layer(self, filename, reader, sublayer=None):
+        """Get layer from cache or read it from file
+
+        :param filename: Path of raster or vector file
+        :type filename: str
+
+        :param reader: Function reading layer from filename and sublayer
+        :type reader: callable
+
+        :param sublayer: Optional sublayer
+        :type sublayer: str
+
+        :returns: New layer sharing data with the cached layer
+        :rtype: Layer
+        """
+
+        key = (get_file_signature(filename), sublayer)
+        layer = self.layers.get(key)
+        if layer is None:
+            self.misses += 1
+            layer = reader(filename, sublayer)
+            self.layers.put(key, layer, nbytes=get_layer_size(layer))
+        else:
+            self.hits += 1
+
+        return copy_cached_layer(layer)
+
+    def resize(self, max_bytes):
+        """Change memory budget dropping least recently used layers
+        """
+        self.layers.resize(max_bytes)
+
+    def clear(self):
+        """Drop all layers and reset counters
+        """
+        self.layers.clear()
+        self.hits = 0
+        self.misses = 0
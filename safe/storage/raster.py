@@ -2,8 +2,8 @@
 """
 
 import os
-import gc
 import numpy
+import tempfile
 import copy as copy_module
 from osgeo import gdal
 
@@ -18,6 +18,7 @@ from safe.common.exceptions import GetDataError, InaSAFEError
 from layer import Layer
 from vector import Vector
 from projection import Projection
+from block_cache import BlockCache
 
 from utilities import DRIVER_MAP
 from utilities import read_keywords
@@ -26,6 +27,12 @@ from utilities import (geotransform_to_bbox, geotransform_to_resolution,
                        check_geotransform)
 
 
+# GDAL data types for writing raster files
+GDAL_DATA_TYPES = {'float64': gdal.GDT_Float64,
+                   'float32': gdal.GDT_Float32,
+                   'int16': gdal.GDT_Int16}
+
+
 class Raster(Layer):
     """InaSAFE representation of raster data
 
@@ -62,6 +69,12 @@ class Raster(Layer):
     Note:
         If data is a filename, all other arguments are ignored
         as they will be inferred from the file.
+
+        Data read from file is not held in memory. Windows requested from
+        get_data are read in tiles aligned to the blocks of the file and
+        the tiles are kept in a least recently used cache (see
+        set_cache_size). Alternatively the grid can be copied once into a
+        memory mapped file with use_memmap.
     """
 
     def __init__(self, data=None, projection=None, geotransform=None,
@@ -232,14 +245,34 @@ class Raster(Layer):
             msg = 'Could not read raster band from %s' % filename
             raise ReadLayerError(msg)
 
+        # Data is read on demand through a cache of tiles
+        self.block_cache = BlockCache()
+        self.memmap = None
+
         # FIXME (Ole): I think internal data array should be populated at
         #              this point - then refactor get_data()
 
-    def write_to_file(self, filename):
+    def write_to_file(self, filename, dtype=numpy.float64, compression=None,
+                      tiled=False, block_size=256):
         """Save raster data to file
 
         Args:
             * filename: filename with extension .tif
+            * dtype: Numpy type of the stored values. Admissible types are
+                  numpy.float64 (default), numpy.float32 and numpy.int16.
+                  Integer values are rounded and missing values are
+                  stored as the nodata value (-9999 if it is NaN or
+                  does not fit in the data type).
+            * compression: Optional GeoTIFF compression 'DEFLATE' or 'LZW'.
+                  Both are lossless. Default None.
+            * tiled: If True store data in tiles of block_size x block_size
+                  pixels rather than in strips. Default False.
+            * block_size: Size of tiles in pixels. Must be a multiple of 16.
+
+        Note:
+            Data is written in strips of whole blocks. Data read from file
+            is streamed strip by strip through get_data without holding
+            the whole grid in memory.
 
         Gdal documentation at: http://www.gdal.org/classGDALRasterBand.html
         """
@@ -252,38 +285,89 @@ class Raster(Layer):
         verify(extension in ['.tif'], msg)
         file_format = DRIVER_MAP[extension]
 
-        # Get raster data
-        A = self.get_data()
+        # Check options
+        dtype = numpy.dtype(dtype)
+        msg = ('Raster data type must be one of %s. I got %s'
+               % (sorted(GDAL_DATA_TYPES.keys()), dtype.name))
+        verify(dtype.name in GDAL_DATA_TYPES, msg)
+
+        options = ['BIGTIFF=IF_SAFER']
+        if compression is not None:
+            msg = ('Compression must be either None, "DEFLATE" or "LZW". '
+                   'I got %s' % compression)
+            verify(compression in ['DEFLATE', 'LZW'], msg)
+            options.append('COMPRESS=%s' % compression)
+
+        if tiled:
+            msg = ('Block size must be a positive multiple of 16. '
+                   'I got %s' % block_size)
+            verify(block_size > 0 and block_size % 16 == 0, msg)
+            options.extend(['TILED=YES',
+                            'BLOCKXSIZE=%i' % block_size,
+                            'BLOCKYSIZE=%i' % block_size])
+
+        nodata = self.get_nodata_value()
+        if dtype.kind == 'i':
+            info = numpy.iinfo(dtype)
+            if numpy.isnan(nodata) or not info.min <= nodata <= info.max:
+                nodata = -9999
 
         # Get Dimensions. Note numpy and Gdal swap order
-        N, M = A.shape
+        N, M = self.rows, self.columns
 
         # Create empty file.
-        # FIXME (Ole): It appears that this is created as single
-        #              precision even though Float64 is specified
-        #              - see issue #17
         driver = gdal.GetDriverByName(file_format)
-        fid = driver.Create(filename, M, N, 1, gdal.GDT_Float64)
+        fid = driver.Create(filename, M, N, 1, GDAL_DATA_TYPES[dtype.name],
+                            options)
         if fid is None:
             msg = ('Gdal could not create filename %s using '
                    'format %s' % (filename, file_format))
             raise WriteLayerError(msg)
 
-        self.filename = filename
-
         # Write metada
         fid.SetProjection(str(self.projection))
         fid.SetGeoTransform(self.geotransform)
 
-        # Write data
-        fid.GetRasterBand(1).WriteArray(A)
-        fid.GetRasterBand(1).SetNoDataValue(self.get_nodata_value())
+        # Write data in strips of about 2**22 pixels
+        band = fid.GetRasterBand(1)
+        if tiled:
+            strip = block_size * max(1, 2 ** 22 // (M * block_size))
+        else:
+            strip = max(1, 2 ** 22 // M)
+
+        if self.is_loaded():
+            A = self.get_data()
+        for yoff in range(0, N, strip):
+            rows = min(strip, N - yoff)
+            if self.is_loaded():
+                B = A[yoff:yoff + rows]
+            else:
+                B = self.get_data(window=(0, yoff, M, rows))
+
+            if dtype.kind == 'i':
+                B = numpy.where(numpy.isnan(B), nodata, numpy.round(B))
+                if numpy.any(B < info.min) or numpy.any(B > info.max):
+                    # Do not leave a partially written file behind
+                    band = fid = None
+                    driver.Delete(filename)
+
+                    msg = ('Values of raster %s do not fit in data type %s'
+                           % (self.get_name(), dtype.name))
+                    raise WriteLayerError(msg)
+            if B.dtype != dtype:
+                B = B.astype(dtype)
+            band.WriteArray(B, 0, yoff)
+
+        band.SetNoDataValue(nodata)
         fid = None  # Close
 
+        self.filename = filename
+
         # Write keywords if any
         write_keywords(self.keywords, basename + '.keywords')
 
-    def get_data(self, nan=True, scaling=None, copy=False):
+    def get_data(self, nan=True, scaling=None, copy=False, window=None,
+                 dtype=numpy.float64, keep=False):
         """Get raster data as numeric array
 
         Args:
@@ -316,65 +400,61 @@ class Raster(Layer):
 
             * copy (optional): If present and True return copy
 
+            * window (optional): Tuple (xoff, yoff, columns, rows) in pixels
+                       selecting a rectangular part of the grid. Only that
+                       part is read from file. If None (default) all data
+                       is returned.
+
+            * dtype (optional): Numpy float type of the returned array.
+                       Default is numpy.float64. If None, single precision
+                       data is returned as single precision and all other
+                       data as double precision.
+
+            * keep (optional): If True the processed grid is kept for
+                       subsequent calls with keep=True and the same nan,
+                       scaling and dtype. The kept array is read only and
+                       is returned without copying unless copy is True.
+                       Default False.
+
         Note:
             Scaling does not currently work with projected layers.
             See issue #123
-        """
 
-        if hasattr(self, 'data') and self.data is not None:
-            # Return internal data grid
-            if copy:
+            Unless keep is True a new array is returned which can be
+            modified without affecting the layer.
 
-                A = copy_module.deepcopy(self.data)
-            else:
-                A = self.data
-            verify(A.shape[0] == self.rows and A.shape[1] == self.columns)
+            Kept grids are held in the tile cache of the layer and count
+            towards its memory budget (see set_cache_size). Grids larger
+            than the budget are not kept. Call clear_cache after modifying
+            data in place.
+        """
 
+        if window is None:
+            xoff, yoff, columns, rows = 0, 0, self.columns, self.rows
         else:
-            # Force garbage collection to free up any memory we can (TS)
-            gc.collect()
-
-            # Read from raster file
-            # FIXME: This can be slow so should be moved to read_from_file
-            A = self.band.ReadAsArray()
-
-            # Convert to double precision (issue #75)
-            A = numpy.array(A, dtype=numpy.float64)
-
-            # Self check
-            M, N = A.shape
-            msg = ('Dimensions of raster array do not match those of '
-                   'raster file %s' % self.filename)
-            verify(M == self.rows, msg)
-            verify(N == self.columns, msg)
-
-        # Handle no data value
-        # FIXME (Ole): This only pertains to data read from file
-        # and should be moved to read_from_file.
-        nodata = self.get_nodata_value()
+            xoff, yoff, columns, rows = [int(w) for w in window]
+            msg = ('Window %s must lie within the %i x %i grid of raster '
+                   '%s' % (str(window), self.columns, self.rows,
+                           self.get_name()))
+            verify(xoff >= 0 and yoff >= 0 and columns > 0 and rows > 0, msg)
+            verify(xoff + columns <= self.columns, msg)
+            verify(yoff + rows <= self.rows, msg)
 
         # Must explicit comparison to False and True as nan can be a number
         # so 0 would evaluate to False and e.g. 1 to True.
         if nan is False:
             # No change
-            pass
+            NAN = None
+        elif nan is True:
+            NAN = numpy.nan  # Use numpy's nan value
         else:
-            # Nan value should be changed
-            if nan is True:
-                NAN = numpy.nan  # Use numpy's nan value
-            else:
-                try:
-                    # Use user specified number
-                    NAN = float(nan)
-                except (ValueError, TypeError):
-                    msg = ('Argument nan must be either True, False or a '
-                           'number. I got "nan=%s"' % str(nan))
-                    raise InaSAFEError(msg)
-
-            # Replace NODATA_VALUE with NaN array
-            #print 'Replacing', nodata, 'with', NAN
-            NaN = numpy.ones(A.shape, A.dtype) * NAN
-            A = numpy.where(A == nodata, NaN, A)
+            try:
+                # Use user specified number
+                NAN = float(nan)
+            except (ValueError, TypeError):
+                msg = ('Argument nan must be either True, False or a '
+                       'number. I got "nan=%s"' % str(nan))
+                raise InaSAFEError(msg)
 
         # Take care of possible scaling
         if scaling is None:
@@ -408,8 +488,119 @@ class Raster(Layer):
                        'number: %s' % (scaling, str(e)))
                 raise GetDataError(msg)
 
+        if dtype is None:
+            dtype = self._get_storage_dtype()
+        dtype = numpy.dtype(dtype)
+
+        # Look for kept grid
+        keep = keep and window is None
+        if keep:
+            if NAN is not None and numpy.isnan(NAN):
+                key = ('grid', 'nan', sigma, dtype.str)
+            else:
+                key = ('grid', NAN, sigma, dtype.str)
+            if not hasattr(self, 'block_cache'):
+                self.block_cache = BlockCache()
+            A = self.block_cache.get(key)
+            if A is not None:
+                if copy:
+                    A = A.copy()
+                return A
+
+        # Array A is owned if it is not a view of the internal data grid
+        if self.is_loaded():
+            # Return internal data grid
+            verify(self.data.shape[0] == self.rows and
+                   self.data.shape[1] == self.columns)
+            if window is None:
+                A = self.data
+            else:
+                A = self.data[yoff:yoff + rows, xoff:xoff + columns]
+            owned = False
+        else:
+            # Read from raster file
+            A = self._read_window(xoff, yoff, columns, rows)
+            owned = True
+
+            # Self check
+            M, N = A.shape
+            msg = ('Dimensions of raster array do not match those of '
+                   'raster file %s' % self.filename)
+            verify(M == rows, msg)
+            verify(N == columns, msg)
+
+        # Convert to requested precision (issue #75)
+        if A.dtype != dtype:
+            A = A.astype(dtype)
+            owned = True
+
+        # Handle no data value
+        # FIXME (Ole): This only pertains to data read from file
+        # and should be moved to read_from_file.
+        if NAN is not None:
+            # Replace NODATA_VALUE with NaN in place
+            nodata = self.get_nodata_value()
+            mask = A == nodata
+            if numpy.any(mask):
+                if not owned:
+                    A = A.copy()
+                    owned = True
+                A[mask] = NAN
+
         # Return possibly scaled data
-        return sigma * A
+        if sigma != 1:
+            if owned:
+                A *= sigma
+            else:
+                A = A * sigma
+                owned = True
+
+        if keep:
+            # Keep read only grid for subsequent calls. Views of data held
+            # in memory take no extra memory.
+            if owned:
+                nbytes = A.nbytes
+            else:
+                A = A.view()
+                nbytes = 0
+            A.flags.writeable = False
+            self.block_cache.put(key, A, nbytes=nbytes)
+            if copy:
+                A = A.copy()
+        elif not owned:
+            A = A.copy()
+
+        return A
+
+    def clear_cache(self):
+        """Drop grids kept by get_data and cached tiles
+
+        Note:
+            This must be called if data held in memory is modified in
+            place. Otherwise get_data may return the old values.
+        """
+
+        if hasattr(self, 'block_cache'):
+            self.block_cache.clear()
+
+    def _get_storage_dtype(self):
+        """Get float type in which grid is read and cached
+
+        Single precision data is kept in single precision. All other
+        data is converted to double precision.
+        """
+
+        if self.is_loaded():
+            dtype = self.data.dtype
+        elif (hasattr(self, 'band') and
+                self.band.DataType == gdal.GDT_Float32):
+            dtype = numpy.float32
+        else:
+            dtype = numpy.float64
+
+        if dtype == numpy.float32:
+            return numpy.dtype(numpy.float32)
+        return numpy.dtype(numpy.float64)
 
     def get_geotransform(self, copy=False):
         """Return geotransform for this raster layer
@@ -430,9 +621,14 @@ class Raster(Layer):
         else:
             return self.geotransform
 
-    def get_geometry(self):
+    def get_geometry(self, window=None):
         """Return longitudes and latitudes (the axes) for grid.
 
+        Args:
+            * window (optional): Tuple (xoff, yoff, columns, rows) as
+                       accepted by get_data. If given, only the axes of
+                       that part of the grid are returned.
+
         Note:
             Return two vectors (longitudes and latitudes) corresponding to
             grid. The values are offset by half a pixel size to correspond to
@@ -454,9 +650,151 @@ class Raster(Layer):
         # Compute x and y axes
         x, y = geotransform_to_axes(g, nx, ny)
 
+        if window is not None:
+            # Latitudes go bottom-up whereas rows go top-down
+            xoff, yoff, columns, rows = [int(w) for w in window]
+            x = x[xoff:xoff + columns]
+            y = y[ny - yoff - rows:ny - yoff]
+
         # Return them
         return x, y
 
+    def is_loaded(self):
+        """Determine whether raster data is held in memory
+
+        Returns:
+            * True if data is held in memory, False if it is read from
+              file on demand
+        """
+
+        return hasattr(self, 'data') and self.data is not None
+
+    def get_block_size(self):
+        """Get natural block size of the underlying raster file
+
+        Returns:
+            * 2-tuple (columns, rows) of the blocks in which data is stored
+              in the file. Reading windows aligned to these blocks is most
+              efficient. For data held in memory the whole grid is one block.
+        """
+
+        if self.is_loaded() or not hasattr(self, 'band'):
+            return self.columns, self.rows
+
+        columns, rows = self.band.GetBlockSize()
+        return int(columns), int(rows)
+
+    def get_tile_size(self):
+        """Get size of the tiles in which data is read and cached
+
+        Returns:
+            * 2-tuple (columns, rows). Tiles consist of whole blocks of the
+              file and are at least 256 x 256 pixels unless the grid is
+              smaller.
+        """
+
+        # Round 256 up to whole blocks
+        block_columns, block_rows = self.get_block_size()
+        columns = min(self.columns, block_columns * -(-256 // block_columns))
+        rows = min(self.rows, block_rows * -(-256 // block_rows))
+        return max(columns, 1), max(rows, 1)
+
+    def set_cache_size(self, max_bytes):
+        """Set memory budget for cached tiles and grids kept by get_data
+
+        Args:
+            * max_bytes: Maximal size of the cached tiles and kept grids
+                  in bytes. 0 disables caching.
+        """
+
+        if hasattr(self, 'block_cache'):
+            self.block_cache.resize(max_bytes)
+        else:
+            self.block_cache = BlockCache(max_bytes)
+
+    def use_memmap(self, filename=None):
+        """Copy grid from file into a memory mapped array
+
+        Args:
+            * filename: Optional name of the file backing the array.
+                  If None, an anonymous temporary file is used.
+
+        Note:
+            The grid is converted to floating point once. Subsequent
+            calls to get_data read from the memory mapped array rather
+            than from the raster file and the tile cache is cleared.
+            This has no effect for data held in memory.
+        """
+
+        if self.is_loaded() or not hasattr(self, 'band'):
+            return
+
+        if filename is None:
+            fid = tempfile.TemporaryFile()
+        else:
+            fid = open(filename, 'w+b')
+        backing = numpy.memmap(fid, dtype=self._get_storage_dtype(),
+                               mode='w+', shape=(self.rows, self.columns))
+        fid.close()
+
+        # Copy in strips of whole tiles
+        _, tile_rows = self.get_tile_size()
+        for yoff in range(0, self.rows, tile_rows):
+            rows = min(tile_rows, self.rows - yoff)
+            backing[yoff:yoff + rows] = self.band.ReadAsArray(
+                0, yoff, self.columns, rows)
+
+        self.memmap = backing
+        self.clear_cache()
+
+    def _read_window(self, xoff, yoff, columns, rows):
+        """Read window of raster file as floating point array
+
+        Input:
+            xoff, yoff, columns, rows: Window in pixels
+
+        Output:
+            New array with data as stored in the file converted to the
+            type given by _get_storage_dtype
+
+        Windows that fit within the cache budget are assembled from
+        cached tiles. Larger windows are read directly.
+        """
+
+        if self.memmap is not None:
+            return numpy.array(self.memmap[yoff:yoff + rows,
+                                           xoff:xoff + columns])
+
+        dtype = self._get_storage_dtype()
+        if rows * columns * dtype.itemsize > self.block_cache.max_bytes:
+            A = self.band.ReadAsArray(xoff, yoff, columns, rows)
+            return numpy.array(A, dtype=dtype)
+
+        tile_columns, tile_rows = self.get_tile_size()
+        A = numpy.empty((rows, columns), dtype=dtype)
+        for j in range(yoff // tile_rows, (yoff + rows - 1) // tile_rows + 1):
+            y0 = j * tile_rows
+            y1 = min(y0 + tile_rows, self.rows)
+            for i in range(xoff // tile_columns,
+                           (xoff + columns - 1) // tile_columns + 1):
+                x0 = i * tile_columns
+                x1 = min(x0 + tile_columns, self.columns)
+
+                tile = self.block_cache.get((i, j))
+                if tile is None:
+                    tile = self.band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+                    tile = numpy.array(tile, dtype=dtype)
+                    self.block_cache.put((i, j), tile)
+
+                # Copy overlap between window and tile
+                top = max(yoff, y0)
+                bottom = min(yoff + rows, y1)
+                left = max(xoff, x0)
+                right = min(xoff + columns, x1)
+                overlap = tile[top - y0:bottom - y0, left - x0:right - x0]
+                A[top - yoff:bottom - yoff, left - xoff:right - xoff] = overlap
+        return A
+
     def copy(self):
         """Return copy of raster layer
 
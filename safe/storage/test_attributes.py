@@ -0,0 +1,132 @@
+# coding=utf-8
+"""**Tests for columnar attribute tables**"""
+
+import unittest
+import cPickle
+import numpy
+
+from safe.storage.attributes import AttributeTable, make_column
+from safe.common.exceptions import InaSAFEError
+
+
+class AttributeTableTest(unittest.TestCase):
+
+    def test_make_column(self):
+        """Columns keep the type of their values
+        """
+
+        assert make_column([1, 2, 3]).dtype.kind == 'i'
+        assert make_column([1.0, 2, 3]).dtype.kind == 'O'
+        assert make_column([1.0, numpy.float64(2)]).dtype.kind == 'f'
+        assert make_column([True, False]).dtype.kind == 'b'
+        assert make_column(['a', None]).dtype.kind == 'O'
+        assert make_column(numpy.array(['a', 'bc'])).dtype.kind == 'O'
+
+        # Sequences are kept as values
+        column = make_column([[1, 2], [3, 4]])
+        assert column.shape == (2,)
+        assert column[1] == [3, 4]
+
+        # Numeric arrays are used as is
+        A = numpy.arange(4.0)
+        assert make_column(A) is A
+
+    def test_records(self):
+        """Tables convert to and from lists of dictionaries
+        """
+
+        records = [{'NAME': 'school', 'FLOORS': 2, 'DEPTH': 0.5},
+                   {'NAME': 'hospital', 'FLOORS': 3, 'DEPTH': 1.5,
+                    'WET': True}]
+        table = AttributeTable.from_records(records)
+        assert len(table) == 2
+        assert sorted(table.names) == ['DEPTH', 'FLOORS', 'NAME', 'WET']
+        assert table.get_column('FLOORS').dtype.kind == 'i'
+        assert table.get_column('DEPTH').dtype.kind == 'f'
+
+        # Missing values become None
+        ref = [dict(records[0], WET=None), records[1]]
+        assert table.to_records() == ref
+
+        # Values are plain Python objects
+        assert type(table.get_value(0, 'FLOORS')) is int
+        assert type(table.get_value(1, 'DEPTH')) is float
+
+        # Pickling does not need the row views
+        table.get_rows()
+        assert cPickle.loads(cPickle.dumps(table)).to_records() == ref
+
+    def test_rows(self):
+        """Rows are dictionary like views updating the table
+        """
+
+        table = AttributeTable({'ID': [0, 1, 2],
+                                'DEPTH': numpy.array([0.1, 0.2, 0.3])})
+        rows = table.get_rows()
+        assert len(rows) == 3
+        assert rows[1]['ID'] == 1
+        assert rows[1].copy() == {'ID': 1, 'DEPTH': 0.2}
+        assert sorted(rows[2].keys()) == ['DEPTH', 'ID']
+        assert 'ID' in rows[0]
+        assert rows[0].get('FLOODED') is None
+
+        # Assignment updates columns keeping types
+        rows[0]['DEPTH'] = 1.5
+        assert table.get_column('DEPTH').dtype.kind == 'f'
+        assert table.get_value(0, 'DEPTH') == 1.5
+
+        rows[0]['ID'] = 'a'
+        assert table.get_column('ID').dtype.kind == 'O'
+        assert table.get_column('ID').tolist() == ['a', 1, 2]
+
+        # New attributes are added as columns
+        rows[2]['FLOODED'] = True
+        assert table.get_column('FLOODED').tolist() == [None, None, True]
+
+        # Rows can not lose attributes
+        self.assertRaises(InaSAFEError, rows[0].__delitem__, 'ID')
+
+    def test_columns(self):
+        """Columns are added and copied as a whole
+        """
+
+        table = AttributeTable({'ID': range(5)})
+        depth = numpy.linspace(0, 1, 5)
+        table.set_column('DEPTH', depth)
+        assert table.get_column('DEPTH') is depth
+        assert table.names == ['ID', 'DEPTH']
+
+        # Lengths must match
+        self.assertRaises(Exception, table.set_column, 'X', [1, 2])
+
+        # Shallow copies share columns but not the set of columns
+        shallow = table.copy(deep=False)
+        shallow.set_column('X', numpy.zeros(5))
+        assert 'X' not in table
+        assert shallow.get_column('DEPTH', writable=False) is depth
+
+        # Either table copies shared columns when first changed
+        shallow.get_rows()[1]['DEPTH'] = 5.0
+        assert depth.flags.writeable
+        assert table.get_value(1, 'DEPTH') == 0.25
+        assert table.get_column('DEPTH', writable=False) is depth
+        assert shallow.get_column('DEPTH') is not depth
+        table.set_value(0, 'ID', 7)
+        assert shallow.get_value(0, 'ID') == 0
+
+        # Shared columns are copied before they are handed out
+        shallow = table.copy(deep=False)
+        shallow.get_column('DEPTH')[0] = 3.0
+        assert table.get_value(0, 'DEPTH') == 0.0
+        table.get_column('DEPTH')[1] = 4.0
+        assert shallow.get_value(1, 'DEPTH') == 0.25
+
+        # Deep copies are independent
+        deep = table.copy()
+        deep.get_rows()[0]['DEPTH'] = 10.0
+        assert table.get_value(0, 'DEPTH') == 0.0
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(AttributeTableTest, 'test')
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
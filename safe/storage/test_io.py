@@ -3,14 +3,14 @@ import numpy
 import sys
 import os
 
-from osgeo import gdal
+from osgeo import gdal, ogr
 
 from raster import Raster
 from vector import Vector
 from vector import convert_polygons_to_centroids
 from projection import Projection
 from projection import DEFAULT_PROJECTION
-from core import read_layer
+from core import read_layer, LAYER_CACHE
 from core import write_raster_data
 from utilities import write_keywords
 from utilities import read_keywords
@@ -21,6 +21,7 @@ from utilities import array_to_wkt
 from utilities import calculate_polygon_area
 from utilities import calculate_polygon_centroid
 from utilities import points_along_line
+from utilities import densify_lines
 from utilities import geotransform_to_bbox
 from utilities import geotransform_to_resolution
 from utilities import raster_geometry_to_geotransform
@@ -28,7 +29,11 @@ from core import get_bounding_box
 from core import bboxlist2string, bboxstring2list
 from core import check_bbox_string
 from utilities_test import same_API
-from geometry import Polygon
+from geometry import Polygon, GeometryBuffer
+from block_cache import BlockCache
+from layer_cache import DEFAULT_LAYER_CACHE_SIZE
+from layer_cache import get_layer_size
+from attributes import AttributeTable
 from safe.common.numerics import nan_allclose
 from safe.common.testing import TESTDATA, HAZDATA, DATADIR
 from safe.common.testing import FEATURE_COUNTS
@@ -36,6 +41,7 @@ from safe.common.testing import GEOTRANSFORMS
 from safe.common.utilities import ugettext as tr, unique_filename
 from safe.common.polygon import is_inside_polygon
 from safe.common.exceptions import BoundingBoxError, ReadLayerError
+from safe.common.exceptions import WriteLayerError
 from safe.common.exceptions import VerificationError, InaSAFEError
 
 
@@ -754,6 +760,187 @@ class Test_IO(unittest.TestCase):
         assert V_tmp == V_new
         assert not V_tmp != V_new
 
+    def test_reading_with_filters(self):
+        """Vector data can be selected and read column by column
+        """
+
+        # Create polygon layer with two rows of unit squares
+        polygons = []
+        data = []
+        for i in range(10):
+            x = 106.0 + i
+            for j, y in enumerate([-7.0, -6.0]):
+                square = numpy.array([[x, y], [x + 1, y], [x + 1, y + 1],
+                                      [x, y + 1], [x, y]])
+                polygons.append(square)
+                data.append({'ID': 2 * i + j, 'ROW': j,
+                             'NAME': 'square %i' % i})
+        V = Vector(data=data, geometry=polygons,
+                   projection=DEFAULT_PROJECTION)
+        filename = unique_filename(suffix='.shp')
+        V.write_to_file(filename)
+
+        # Read all features with small batches
+        V_all = Vector()
+        V_all.read_from_file(filename, batch_size=3)
+        assert V_all == V
+        assert isinstance(V_all.geometry, GeometryBuffer)
+        assert numpy.allclose(V_all.extent, [106.0, 116.0, -7.0, -5.0])
+
+        # Columnar attributes
+        V_col = Vector(filename, columnar=True)
+        assert V_col.is_columnar
+        assert V_col == V
+        assert V_col.get_column('ID').tolist() == range(20)
+
+        # Attribute filter
+        V_row = Vector(filename, attribute_filter='ROW = 1')
+        assert len(V_row) == 10
+        assert V_row.get_data('ID') == range(1, 20, 2)
+        assert numpy.allclose(V_row.extent, [106.0, 116.0, -6.0, -5.0])
+
+        # Bounding box filter [West, South, East, North]
+        V_box = Vector(filename, bbox=[107.5, -6.5, 108.5, -6.2])
+        assert sorted(V_box.get_data('ID')) == [2, 4]
+        assert numpy.allclose(V_box.extent, [107.0, 109.0, -7.0, -6.0])
+
+        # Both filters
+        V_both = Vector(filename, attribute_filter="NAME = 'square 1'",
+                        bbox=[107.5, -6.5, 108.5, -5.5], columnar=True)
+        assert sorted(V_both.get_data('ID')) == [2, 3]
+
+        # Invalid filters
+        self.assertRaises(ReadLayerError, Vector, filename,
+                          attribute_filter='NO_SUCH_FIELD = 1')
+        self.assertRaises(InaSAFEError, Vector, filename, bbox=[1, 2, 3])
+
+    def test_batched_writing_of_vector_data(self):
+        """Vector data is written in batches to shp and gpkg files
+        """
+
+        polygons = []
+        data = []
+        for i in range(25):
+            x = 106.0 + i * 0.1
+            square = numpy.array([[x, -6.0], [x + 0.1, -6.0],
+                                  [x + 0.1, -5.9], [x, -5.9], [x, -6.0]])
+            polygons.append(square)
+
+            # Types are established from all features
+            if i == 0:
+                depth = None
+            elif i % 2:
+                depth = 1
+            else:
+                depth = i / 10.0
+            data.append({'ID': i, 'DEPTH': depth,
+                         'LONG_ATTRIBUTE_NAME': 'name %i' % i})
+        V = Vector(data=data, geometry=polygons,
+                   projection=DEFAULT_PROJECTION)
+
+        for extension in ['.shp', '.gpkg']:
+            filename = unique_filename(suffix=extension)
+            V.write_to_file(filename, batch_size=7)
+
+            V2 = read_layer(filename)
+            assert len(V2) == 25
+            for i in range(25):
+                assert numpy.allclose(V2.get_geometry()[i], polygons[i])
+            assert V2.get_data('ID') == range(25)
+            assert V2.get_data('DEPTH')[2] == 0.2
+
+            fid = ogr.Open(filename)
+            layer_def = fid.GetLayer(0).GetLayerDefn()
+            index = layer_def.GetFieldIndex('DEPTH')
+            assert layer_def.GetFieldDefn(index).GetType() == ogr.OFTReal
+
+        # Full attribute names and spatial index in GeoPackage
+        assert 'LONG_ATTRIBUTE_NAME' in V2.get_attribute_names()
+        layer_name = fid.GetLayer(0).GetName()
+        result = fid.ExecuteSQL("SELECT HasSpatialIndex('%s', '%s')"
+                                % (layer_name,
+                                   fid.GetLayer(0).GetGeometryColumn()))
+        assert result.GetNextFeature().GetField(0) == 1
+        fid.ReleaseResultSet(result)
+
+        # Columnar attributes are written in the same way
+        V_col = Vector(data=AttributeTable.from_records(data),
+                       geometry=polygons, projection=DEFAULT_PROJECTION)
+        filename = unique_filename(suffix='.gpkg')
+        V_col.write_to_file(filename, sublayer='buildings')
+        V2 = Vector(filename, sublayer='buildings')
+        assert V2.get_data('LONG_ATTRIBUTE_NAME', 3) == 'name 3'
+        assert V2.get_data('DEPTH')[1:3] == [1.0, 0.2]
+
+    def test_layer_cache(self):
+        """Layers read repeatedly are served from cache until files change
+        """
+
+        LAYER_CACHE.clear()
+
+        polygons = [numpy.array([[106.0, -6.0], [106.1, -6.0],
+                                 [106.1, -5.9], [106.0, -6.0]])]
+        V = Vector(data=[{'ID': 1}], geometry=polygons,
+                   projection=DEFAULT_PROJECTION,
+                   keywords={'category': 'exposure'})
+        filename = unique_filename(suffix='.shp')
+        V.write_to_file(filename)
+
+        V1 = read_layer(filename, cache=True)
+        V2 = read_layer(filename, cache=True)
+        assert LAYER_CACHE.misses == 1
+        assert LAYER_CACHE.hits == 1
+        assert V1 is not V2
+        assert V1 == V2
+
+        # Changes to returned layers do not affect the cache
+        V1.keywords['category'] = 'hazard'
+        V1.get_data()[0]['ID'] = 2
+        V3 = read_layer(filename, cache=True)
+        assert V3.get_keywords('category') == 'exposure'
+        assert V3.get_data('ID') == [1]
+
+        # Returned geometry can be modified
+        V3.get_geometry()[0][0] = 0.0
+        V5 = read_layer(filename, cache=True)
+        assert numpy.allclose(V5.get_geometry()[0], V2.get_geometry()[0])
+
+        # Modified files are read again
+        write_keywords({'category': 'hazard'}, filename[:-4] + '.keywords')
+        V4 = read_layer(filename, cache=True)
+        assert LAYER_CACHE.misses == 2
+        assert V4.get_keywords('category') == 'hazard'
+
+        # Rasters share the open file and kept grids
+        filename = os.path.join(TESTDATA, 'Population_2010_clip.tif')
+        R1 = read_layer(filename, cache=True)
+        R2 = read_layer(filename, cache=True)
+        assert LAYER_CACHE.misses == 3
+        assert R1.get_data(keep=True) is R2.get_data(keep=True)
+
+        # Caching is opt-in
+        R3 = read_layer(filename)
+        assert LAYER_CACHE.misses == 3
+        assert LAYER_CACHE.hits == 4
+        assert R3.get_data(keep=True) is not R1.get_data(keep=True)
+        assert nan_allclose(R3.get_data(), R1.get_data())
+
+        # Tile caches count towards the budget
+        assert get_layer_size(R1) >= R1.block_cache.max_bytes
+
+        # Layers beyond the budget are dropped
+        LAYER_CACHE.resize(0)
+        assert len(LAYER_CACHE) == 0
+        LAYER_CACHE.resize(DEFAULT_LAYER_CACHE_SIZE)
+
+        # Block caches accept any objects with given sizes
+        cache = BlockCache(10)
+        cache.put('a', V1, nbytes=6)
+        cache.put('b', V2, nbytes=6)
+        assert cache.get('a') is None
+        assert cache.get('b') is V2
+        assert cache.nbytes == 6
+
     def test_reading_and_writing_of_vector_polygon_data(self):
         """Vector polygon data can be read and written correctly
         """
@@ -1248,6 +1435,215 @@ class Test_IO(unittest.TestCase):
 
     test_reading_and_writing_of_real_rasters.slow = True
 
+    def test_raster_block_cache(self):
+        """Windows of raster data are read through a cache of tiles
+        """
+
+        # Cache keeps the most recently used blocks within its budget
+        cache = BlockCache(max_bytes=3 * 800)
+        for i in range(3):
+            cache.put(i, numpy.zeros(100))
+        assert cache.get(0) is not None
+        cache.put(3, numpy.zeros(100))
+        assert 1 not in cache
+        assert 0 in cache and 3 in cache
+        assert cache.nbytes == 2400
+        cache.put(4, numpy.zeros(1000))
+        assert 4 not in cache
+        cache.resize(800)
+        assert len(cache) == 1 and 3 in cache
+
+        # Write grid to file
+        A = numpy.arange(600 * 700, dtype='d').reshape((600, 700))
+        A[10, 20] = -9999
+        geotransform = (100.0, 0.01, 0.0, 10.0, 0.0, -0.01)
+        filename = unique_filename(suffix='.tif')
+        write_raster_data(A, DEFAULT_PROJECTION, geotransform, filename)
+
+        R = read_layer(filename)
+        assert not R.is_loaded()
+        tile_columns, tile_rows = R.get_tile_size()
+        assert 256 <= tile_rows <= 600 and 256 <= tile_columns <= 700
+
+        # Windows match the full grid and reuse cached tiles
+        B = R.get_data(nan=True)
+        assert numpy.isnan(B[10, 20])
+        for window in [(0, 0, 700, 600), (5, 10, 30, 40),
+                       (250, 200, 400, 300), (699, 599, 1, 1)]:
+            xoff, yoff, columns, rows = window
+            W = R.get_data(nan=False, window=window)
+            assert numpy.array_equal(W, A[yoff:yoff + rows,
+                                          xoff:xoff + columns])
+        assert len(R.block_cache) > 0
+        assert R.block_cache.nbytes <= R.block_cache.max_bytes
+
+        # Windows larger than the budget are read directly
+        R.set_cache_size(8 * 100 * 100)
+        assert R.block_cache.nbytes <= 8 * 100 * 100
+        W = R.get_data(nan=False, window=(0, 0, 300, 200))
+        assert numpy.array_equal(W, A[:200, :300])
+
+        # Memory mapped backing
+        R.use_memmap()
+        assert len(R.block_cache) == 0
+        assert nan_allclose(R.get_data(), B)
+        W = R.get_data(nan=0.0, window=(15, 5, 10, 10))
+        assert W[5, 5] == 0.0
+        assert numpy.array_equal(W[:5], A[5:10, 15:25])
+        assert len(R.block_cache) == 0
+
+    def test_raster_data_is_kept(self):
+        """Processed raster data is kept and single precision preserved
+        """
+
+        # Write single precision grid with nodata values
+        A = numpy.arange(20 * 30, dtype=numpy.float32).reshape((20, 30))
+        A[2, 3] = -9999
+        filename = unique_filename(suffix='.tif')
+        fid = gdal.GetDriverByName('GTiff').Create(filename, 30, 20, 1,
+                                                   gdal.GDT_Float32)
+        fid.SetProjection(DEFAULT_PROJECTION)
+        fid.SetGeoTransform((100.0, 0.1, 0.0, 10.0, 0.0, -0.1))
+        fid.GetRasterBand(1).WriteArray(A)
+        fid.GetRasterBand(1).SetNoDataValue(-9999)
+        fid = None
+
+        R = read_layer(filename)
+        B = R.get_data()
+        assert B.dtype == numpy.float64
+        assert numpy.isnan(B[2, 3])
+        assert numpy.allclose(B[3], A[3])
+
+        # Grids are new writable arrays by default
+        assert B.flags.writeable
+        B[0, 0] = 1.0
+        assert R.get_data()[0, 0] == 0.0
+        assert R.get_data() is not R.get_data()
+
+        # Grid is processed once and returned read only on request
+        K = R.get_data(keep=True)
+        assert R.get_data(keep=True) is K
+        assert R.get_data(nan=True, scaling=False, keep=True) is K
+        assert not K.flags.writeable
+        self.assertRaises(ValueError, K.__setitem__, (0, 0), 1.0)
+
+        C = R.get_data(copy=True, keep=True)
+        assert C is not K and C.flags.writeable
+        C[0, 0] = 1.0
+        assert R.get_data(keep=True)[0, 0] == 0.0
+
+        # Other arguments give other arrays
+        D = R.get_data(nan=0.0, scaling=2.0, keep=True)
+        assert D is not K
+        assert D[2, 3] == 0.0
+        assert D[0, 1] == 2.0
+
+        # Single precision is kept on request
+        F = R.get_data(dtype=None)
+        assert F.dtype == numpy.float32
+        assert numpy.isnan(F[2, 3])
+        W = R.get_data(dtype=numpy.float32, window=(0, 0, 5, 5))
+        assert W.dtype == numpy.float32
+
+        # Kept grids count towards the cache budget
+        assert R.block_cache.nbytes >= K.nbytes + D.nbytes
+        R.set_cache_size(K.nbytes - 1)
+        assert R.block_cache.nbytes <= K.nbytes - 1
+        assert R.get_data(keep=True) is not K
+        R.set_cache_size(2 ** 20)
+
+        # Cache is cleared explicitly
+        K = R.get_data(keep=True)
+        R.clear_cache()
+        assert R.get_data(keep=True) is not K
+        assert nan_allclose(R.get_data(keep=True), K)
+
+        # Data held in memory is only shared when kept
+        R = Raster(data=numpy.ones((4, 5)), projection=DEFAULT_PROJECTION,
+                   geotransform=(100.0, 0.1, 0.0, 10.0, 0.0, -0.1))
+        B = R.get_data()
+        assert not numpy.may_share_memory(B, R.data)
+        B = R.get_data(keep=True)
+        assert numpy.may_share_memory(B, R.data)
+        assert R.data.flags.writeable
+        R.data[0, 0] = 5.0
+        R.clear_cache()
+        assert R.get_data(keep=True)[0, 0] == 5.0
+
+    def test_raster_write_options(self):
+        """Rasters can be written compressed, tiled and in other types
+        """
+
+        A = numpy.arange(300 * 500, dtype='d').reshape((300, 500)) / 100
+        A[5, 7] = numpy.nan
+        geotransform = (100.0, 0.01, 0.0, 10.0, 0.0, -0.01)
+        R = Raster(data=A, projection=DEFAULT_PROJECTION,
+                   geotransform=geotransform)
+
+        # Reference file as before
+        filename = unique_filename(suffix='.tif')
+        R.write_to_file(filename)
+        size = os.path.getsize(filename)
+
+        for dtype, compression in [(numpy.float64, 'DEFLATE'),
+                                   (numpy.float32, 'LZW'),
+                                   (numpy.int16, None)]:
+            out_filename = unique_filename(suffix='.tif')
+            R.write_to_file(out_filename, dtype=dtype,
+                            compression=compression, tiled=True)
+
+            R2 = read_layer(out_filename)
+            assert R2.get_block_size() == (256, 256)
+            fid = gdal.Open(out_filename)
+            band = fid.GetRasterBand(1)
+            type_name = gdal.GetDataTypeName(band.DataType)
+            assert type_name == numpy.dtype(dtype).name.capitalize()
+            if compression is not None:
+                metadata = fid.GetMetadata('IMAGE_STRUCTURE')
+                assert metadata['COMPRESSION'] == compression
+                assert os.path.getsize(out_filename) < size
+
+            B = R2.get_data()
+            assert numpy.isnan(B[5, 7])
+            if dtype == numpy.int16:
+                assert R2.get_nodata_value() == -9999
+                assert numpy.allclose(B[10], numpy.round(A[10]))
+            else:
+                assert nan_allclose(B, A, rtol=1.0e-6)
+
+            # Rasters read from file are written strip by strip
+            copy_filename = unique_filename(suffix='.tif')
+            R2.write_to_file(copy_filename, dtype=dtype, tiled=True,
+                             block_size=64)
+            R3 = read_layer(copy_filename)
+            assert R3.get_block_size() == (64, 64)
+            assert nan_allclose(R3.get_data(), B)
+
+        # Values must fit in the data type and no file is left behind
+        R_large = Raster(data=A * 1000, projection=DEFAULT_PROJECTION,
+                         geotransform=geotransform)
+        out_filename = unique_filename(suffix='.tif')
+        self.assertRaises(WriteLayerError, R_large.write_to_file,
+                          out_filename, dtype=numpy.int16)
+        assert not os.path.exists(out_filename)
+
+        # Nodata values that do not fit in the data type are replaced
+        B = A.copy()
+        B[5, 7] = -1.0e10
+        R_nodata = Raster(data=B, projection=DEFAULT_PROJECTION,
+                          geotransform=geotransform)
+        R_nodata.nodata_value = -1.0e10
+        out_filename = unique_filename(suffix='.tif')
+        R_nodata.write_to_file(out_filename, dtype=numpy.int16)
+        R2 = read_layer(out_filename)
+        assert R2.get_nodata_value() == -9999
+        assert numpy.isnan(R2.get_data()[5, 7])
+
+        self.assertRaises(VerificationError, R.write_to_file,
+                          unique_filename(suffix='.tif'), dtype=numpy.int32)
+        self.assertRaises(VerificationError, R.write_to_file,
+                          unique_filename(suffix='.tif'), compression='ZIP')
+
     def test_no_projection(self):
         """Raster layers with no projection causes Exception to be raised
         """
@@ -2320,6 +2716,36 @@ class Test_IO(unittest.TestCase):
                    name='Test points_along_line')
         V.write_to_file(out_filename)
 
+    def test_densify_lines(self):
+        """Lines are densified keeping their vertices
+        """
+
+        lines = [[[168, -2], [170, -2], [170, -1.5]],
+                 [[0, 0]],
+                 numpy.array([[1, 1], [1, 2.5]])]
+        points, line_index = densify_lines(lines, 1)
+
+        expected_points = [[168, -2], [169, -2], [170, -2], [170, -1.5],
+                           [0, 0],
+                           [1, 1], [1, 1.75], [1, 2.5]]
+        msg = ('Calculated points were %s, expected '
+               '%s' % (points, expected_points))
+        assert numpy.allclose(points, expected_points), msg
+        assert numpy.all(line_index == [0, 0, 0, 0, 1, 2, 2, 2])
+
+        # Realistic lines keep all vertices and get no long segments
+        filename = '%s/%s' % (TESTDATA, 'indonesia_highway_sample.shp')
+        geometry = read_layer(filename).get_geometry()
+        for line in geometry[:10]:
+            points, _ = densify_lines([line], 0.01)
+            d = numpy.diff(points, axis=0)
+            assert numpy.all(numpy.sqrt((d * d).sum(axis=1)) <= 0.01 + 1e-12)
+            for vertex in line:
+                assert numpy.any(numpy.all(points == vertex, axis=1))
+
+        points, line_index = densify_lines([], 1)
+        assert points.shape == (0, 2)
+
     def test_geotransform2bbox(self):
         """Bounding box can be extracted from geotransform
         """
@@ -11,11 +11,14 @@ __copyright__ += 'Disaster Reduction'
 import os
 import logging
 import unittest
+import numpy
 
 from safe.common.testing import UNITDATA, get_qgis_app
 from safe.common.utilities import temp_dir, unique_filename
 from safe.storage.utilities import read_keywords
 from safe.storage.vector import Vector, qgis_imported
+from safe.storage.vector import convert_polygons_to_centroids
+from safe.storage.geometry import Polygon, GeometryBuffer
 
 if qgis_imported:   # Import QgsVectorLayer if qgis is available
     QGIS_APP, CANVAS, IFACE, PARENT = get_qgis_app()
@@ -74,6 +77,155 @@ class VectorTest(unittest.TestCase):
         self.assertTrue(os.path.exists(test_file))
     test_sqlite_writing.slow = True
 
+    def test_columnar_attributes(self):
+        """Test that attributes can be held column by column."""
+        geometry = numpy.array([[106.1, -6.2], [106.2, -6.1],
+                                [106.3, -6.3], [106.4, -6.2]])
+        depth = numpy.array([0.0, 0.5, 1.0, 1.5])
+        columns = {'ID': numpy.arange(4),
+                   'DEPTH': depth,
+                   'NAME': ['a', 'b', 'c', 'd']}
+        layer = Vector(data=columns, geometry=geometry)
+        self.assertTrue(layer.is_columnar)
+        self.assertEqual(sorted(layer.get_attribute_names()),
+                         ['DEPTH', 'ID', 'NAME'])
+
+        # Same as layer with one dictionary per feature
+        reference = Vector(data=layer.get_data(copy=True), geometry=geometry)
+        self.assertFalse(reference.is_columnar)
+        self.assertEqual(layer, reference)
+        self.assertEqual(layer.get_data('DEPTH'), [0.0, 0.5, 1.0, 1.5])
+        self.assertEqual(layer.get_data('NAME', 2), 'c')
+
+        # Columns are read and added without copying
+        self.assertTrue(layer.get_column('DEPTH') is depth)
+        self.assertTrue(numpy.all(reference.get_column('DEPTH') == depth))
+        for v in [layer, reference]:
+            v.set_column('FLOODED', depth > 0.7)
+        self.assertEqual(layer, reference)
+        self.assertEqual(layer.get_data()[3]['FLOODED'], True)
+
+        # Features are views of the columns
+        layer.get_data()[0]['NAME'] = 'z'
+        self.assertEqual(layer.get_column('NAME')[0], 'z')
+
+        # Copies are independent but share columns until changed
+        copy = layer.copy()
+        self.assertTrue(copy.is_columnar)
+        column = copy.get_columns().get_column('DEPTH', writable=False)
+        self.assertTrue(column is depth)
+        copy.get_data()[1]['DEPTH'] = 10.0
+        self.assertEqual(layer.get_data('DEPTH', 1), 0.5)
+        column = layer.get_columns().get_column('DEPTH', writable=False)
+        self.assertTrue(column is depth)
+        layer.get_data()[2]['ID'] = 20
+        self.assertEqual(copy.get_data('ID', 2), 2)
+        copy.get_column('DEPTH')[0] = 5.0
+        self.assertEqual(layer.get_data('DEPTH', 0), 0.0)
+
+        # Copies of attribute dictionaries only share immutable values
+        records = reference.get_data(copy=True)
+        records[0]['NAME'] = 'y'
+        self.assertEqual(reference.get_data('NAME', 0), 'a')
+        reference.get_data()[0]['LIST'] = [1, 2]
+        records = reference.get_data(copy=True)
+        records[0]['LIST'].append(3)
+        self.assertEqual(reference.get_data('LIST', 0), [1, 2])
+        copy.get_data()[0]['LIST'] = [1, 2]
+        records = copy.get_data(copy=True)
+        records[0]['LIST'].append(3)
+        self.assertEqual(copy.get_data('LIST', 0), [1, 2])
+
+        # Columnar layers are written like any other
+        test_file = unique_filename(suffix='.shp',
+                                    dir=temp_dir(sub_dir='test'))
+        layer.write_to_file(test_file)
+        result = Vector(data=test_file)
+        self.assertEqual(result.get_data('NAME'), ['z', 'b', 'c', 'd'])
+        self.assertTrue(numpy.allclose(result.get_data('DEPTH'), depth))
+
+    def test_geometry_buffer(self):
+        """Test that geometry can be held in one coordinate buffer."""
+        square = numpy.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]])
+        hole = numpy.array([[0.2, 0.2], [0.4, 0.2], [0.4, 0.4], [0.2, 0.2]])
+        triangle = numpy.array([[106.0, -6.0], [106.3, -6.0],
+                                [106.0, -5.7], [106.0, -6.0]])
+        polygons = [Polygon(square, [hole]), Polygon(triangle)]
+        buf = GeometryBuffer.from_polygons(polygons)
+        self.assertEqual(len(buf), 2)
+        self.assertEqual(buf.coordinates.shape, (13, 2))
+        self.assertEqual(buf.ring_offsets.tolist(), [0, 5, 9, 13])
+        self.assertEqual(buf.feature_offsets.tolist(), [0, 2, 3])
+
+        # Bounding boxes use the outer rings
+        self.assertTrue(numpy.allclose(buf.get_bounding_boxes(),
+                                       [[0, 1, 0, 1],
+                                        [106.0, 106.3, -6.0, -5.7]]))
+
+        layer = Vector(geometry=buf)
+        self.assertTrue(layer.is_polygon_data)
+        self.assertEqual(len(layer), 2)
+        self.assertTrue(numpy.allclose(layer.extent,
+                                       [0, 106.3, -6.0, 1]))
+
+        # Features are views into the buffer
+        geometry = layer.get_geometry(as_geometry_objects=True)
+        self.assertTrue(numpy.allclose(geometry[0].inner_rings[0], hole))
+        self.assertTrue(geometry[1].outer_ring.base is buf.coordinates)
+        self.assertTrue(layer.get_geometry()[1] is geometry[1].outer_ring)
+
+        # Same as layer with a list of polygons
+        reference = Vector(geometry=polygons)
+        self.assertEqual(layer, reference)
+        self.assertTrue(numpy.allclose(layer.get_bounding_boxes(),
+                                       reference.get_bounding_boxes()))
+
+        # Centroids are calculated for all polygons at once
+        centroids = convert_polygons_to_centroids(layer)
+        expected = convert_polygons_to_centroids(reference)
+        self.assertTrue(numpy.allclose(centroids.get_geometry(),
+                                       expected.get_geometry()))
+
+        # Empty buffers have no centroids
+        empty = GeometryBuffer.from_polygons([])
+        self.assertEqual(empty.get_centroids().shape, (0, 2))
+        self.assertEqual(empty.get_bounding_boxes().shape, (0, 4))
+
+        # Copies keep the buffer
+        copy = layer.copy()
+        self.assertTrue(isinstance(copy.geometry, GeometryBuffer))
+        self.assertFalse(copy.geometry.coordinates is buf.coordinates)
+        self.assertEqual(copy, layer)
+        copy.get_geometry()[0][0] = 5.0
+        self.assertEqual(layer.get_geometry()[0][0].tolist(), [0, 0])
+
+        # Bounding boxes follow vertices changed in place
+        self.assertTrue(numpy.allclose(copy.get_bounding_boxes()[0],
+                                       [0, 5, 0, 5]))
+        self.assertTrue(numpy.allclose(layer.get_bounding_boxes()[0],
+                                       [0, 1, 0, 1]))
+
+        # Copied geometry can be modified
+        geometry = copy.get_geometry(copy=True)
+        geometry[0][0] = 5.0
+        self.assertEqual(layer.get_geometry()[0][0].tolist(), [0, 0])
+        self.assertEqual(layer.get_topN('ID', 1).get_data('ID'), [1])
+
+        # Lines
+        lines = [numpy.array([[0, 0], [1, 1], [2, 0]]),
+                 numpy.array([[3, 3], [4, 4]])]
+        layer = Vector(geometry=GeometryBuffer.from_lines(lines))
+        self.assertTrue(layer.is_line_data)
+        self.assertEqual(layer.extent, [0, 4, 0, 4])
+        reference = Vector(geometry=lines, geometry_type='line')
+        self.assertEqual(layer, reference)
+
+        # Buffered layers are written like any other
+        test_file = unique_filename(suffix='.shp',
+                                    dir=temp_dir(sub_dir='test'))
+        layer.write_to_file(test_file)
+        self.assertEqual(Vector(data=test_file), reference)
+
     def test_qgis_vector_layer_loading(self):
         """Test that reading from QgsVectorLayer works."""
         keywords = read_keywords(KEYWORD_PATH, EXPOSURE_SUBLAYER_NAME)
@@ -5,6 +5,7 @@
 import os
 import re
 import copy
+import struct
 import numpy
 import math
 from ast import literal_eval
@@ -29,6 +30,7 @@ LAYER_TYPES = ['.shp', '.asc', '.tif', '.tiff', '.geotif', '.geotiff']
 
 # Map between extensions and ORG drivers
 DRIVER_MAP = {'.sqlite': 'SQLITE',
+              '.gpkg': 'GPKG',
               '.shp': 'ESRI Shapefile',
               '.gml': 'GML',
               '.tif': 'GTiff',
@@ -1087,6 +1089,58 @@ def points_along_line(line, delta):
     return C
 
 
+def densify_lines(lines, delta):
+    """Insert points along lines so that no segment is longer than delta
+
+    :param lines: List of numeric arrays of points (longitude, latitude).
+    :type lines: list
+
+    :param delta: Maximal distance between consecutive points.
+    :type delta: float
+
+    :returns: Tuple (points, line_index) where points is an Mx2 array
+        with the points of all lines in turn and line_index is an array
+        of the M indices of the line each point belongs to.
+    :rtype: tuple
+
+    Note:
+        Unlike points_along_line all original vertices are kept and each
+        segment is divided into pieces of equal length. All lines are
+        densified at once without looping over segments.
+    """
+
+    verify(delta > 0, 'Parameter delta must be positive. I got %s' % delta)
+
+    lines = [numpy.array(line, dtype='d').reshape((-1, 2)) for line in lines]
+    sizes = numpy.array([len(line) for line in lines], dtype='i')
+    if sizes.sum() == 0:
+        return numpy.zeros((0, 2)), numpy.zeros(0, dtype='i')
+
+    vertices = numpy.concatenate(lines)
+    line_index = numpy.repeat(numpy.arange(len(lines)), sizes)
+
+    # Number of points inserted after each vertex starting a segment
+    extra = numpy.zeros(len(vertices), dtype='i')
+    same = line_index[1:] == line_index[:-1]
+    d = vertices[1:] - vertices[:-1]
+    length = numpy.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2)
+    pieces = numpy.ceil(length / delta).astype('i')
+    extra[:-1] = numpy.where(same, numpy.maximum(pieces, 1) - 1, 0)
+
+    # Position of each new point along the segment from its vertex
+    counts = extra + 1
+    vertex = numpy.repeat(numpy.arange(len(vertices)), counts)
+    k = (numpy.arange(len(vertex)) -
+         numpy.repeat(numpy.cumsum(counts) - counts, counts))
+    following = numpy.minimum(vertex + 1, len(vertices) - 1)
+    t = k / (extra[vertex] + 1.0)
+
+    points = (vertices[vertex] +
+              t[:, numpy.newaxis] * (vertices[following] - vertices[vertex]))
+
+    return points, line_index[vertex]
+
+
 def combine_polygon_and_point_layers(layers):
     """Combine polygon and point layers
 
@@ -1152,6 +1206,187 @@ def get_polygon_data(G):
                    inner_rings=inner_rings)
 
 
+def decode_wkb(blobs):
+    """Decode list of well known binary geometries into flat arrays
+
+    :param blobs: List of 2D geometries of type point, line string or
+        polygon in little endian (NDR) well known binary format as
+        returned by OGR ExportToWkb(ogr.wkbNDR).
+    :type blobs: list
+
+    :returns: Tuple (geometry_types, coordinates, ring_offsets,
+        feature_offsets) where geometry_types is an array with the OGR
+        type of each geometry and coordinates is an Mx2 array with the
+        vertices of all rings. Ring k consists of the vertices
+        ring_offsets[k]:ring_offsets[k + 1] and geometry i of the rings
+        feature_offsets[i]:feature_offsets[i + 1]. A point is one ring
+        with one vertex. See GeometryBuffer in geometry.py.
+    :rtype: tuple
+
+    :raises: InaSAFEError if a geometry is not of one of the three types.
+
+    Note:
+        Only the headers are parsed feature by feature. Vertices are
+        copied out of the concatenated blobs in one numpy operation.
+    """
+
+    buf = bytearray().join(blobs)
+    unpack = struct.unpack_from
+
+    geometry_types = numpy.zeros(len(blobs), dtype='i')
+    feature_sizes = numpy.zeros(len(blobs), dtype='i')
+    ring_starts = []
+    ring_sizes = []
+
+    # Byte offsets of the vertices of each ring
+    # Each blob starts with byte order (1 byte) and type (uint32)
+    pos = 0
+    for i, blob in enumerate(blobs):
+        g_type = unpack('<I', buf, pos + 1)[0]
+        geometry_types[i] = g_type
+        if g_type == ogr.wkbPoint:
+            ring_starts.append(pos + 5)
+            ring_sizes.append(1)
+            feature_sizes[i] = 1
+        elif g_type == ogr.wkbLineString:
+            ring_starts.append(pos + 9)
+            ring_sizes.append(unpack('<I', buf, pos + 5)[0])
+            feature_sizes[i] = 1
+        elif g_type == ogr.wkbPolygon:
+            number_of_rings = unpack('<I', buf, pos + 5)[0]
+            start = pos + 9
+            for _ in xrange(number_of_rings):
+                n = unpack('<I', buf, start)[0]
+                ring_starts.append(start + 4)
+                ring_sizes.append(n)
+                start += 4 + 16 * n
+            feature_sizes[i] = number_of_rings
+        else:
+            msg = ('Only 2D point, line and polygon geometries can be '
+                   'decoded. I got geometry type %s' % g_type)
+            raise InaSAFEError(msg)
+        pos += len(blob)
+
+    ring_starts = numpy.array(ring_starts, dtype=numpy.int)
+    ring_sizes = numpy.array(ring_sizes, dtype=numpy.int)
+
+    ring_offsets = numpy.zeros(len(ring_sizes) + 1, dtype=numpy.int)
+    ring_offsets[1:] = numpy.cumsum(ring_sizes)
+    feature_offsets = numpy.zeros(len(blobs) + 1, dtype=numpy.int)
+    feature_offsets[1:] = numpy.cumsum(feature_sizes)
+
+    # Gather the doubles of all rings. Rings are not aligned to 8 bytes
+    # in the buffer so rings are grouped by their alignment.
+    coordinates = numpy.zeros(2 * ring_offsets[-1])
+    for r in range(8):
+        selected = ring_starts % 8 == r
+        if not numpy.any(selected) or len(buf) < r + 8:
+            continue
+        doubles = numpy.frombuffer(buf, dtype='<f8', offset=r,
+                                   count=(len(buf) - r) // 8)
+        counts = 2 * ring_sizes[selected]
+        k = (numpy.arange(counts.sum()) -
+             numpy.repeat(numpy.cumsum(counts) - counts, counts))
+        source = numpy.repeat((ring_starts[selected] - r) // 8, counts) + k
+        target = numpy.repeat(2 * ring_offsets[:-1][selected], counts) + k
+        coordinates[target] = doubles[source]
+
+    return (geometry_types, coordinates.reshape((-1, 2)),
+            ring_offsets, feature_offsets)
+
+
+def encode_wkb(coordinates, ring_offsets, feature_offsets, geometry_type):
+    """Encode geometries held in flat arrays as well known binary
+
+    :param coordinates: Mx2 array of the vertices of all rings
+    :type coordinates: numpy.ndarray
+
+    :param ring_offsets: Array of R + 1 offsets of rings into coordinates
+    :type ring_offsets: numpy.ndarray
+
+    :param feature_offsets: Array of N + 1 offsets of geometries into rings
+    :type feature_offsets: numpy.ndarray
+
+    :param geometry_type: OGR type ogr.wkbPoint, ogr.wkbLineString or
+        ogr.wkbPolygon of all geometries
+    :type geometry_type: int
+
+    :returns: List of N little endian (NDR) well known binary strings
+        accepted by ogr.CreateGeometryFromWkb. This is the inverse of
+        decode_wkb.
+    :rtype: list
+
+    :raises: InaSAFEError if the geometry type is not supported.
+    """
+
+    # Vertices as one string of doubles sliced for each ring
+    coordinates = numpy.ascontiguousarray(coordinates, dtype='<f8')
+    raw = bytes(bytearray(coordinates))
+    pack = struct.pack
+
+    rings = [raw[16 * ring_offsets[k]:16 * ring_offsets[k + 1]]
+             for k in xrange(len(ring_offsets) - 1)]
+
+    blobs = []
+    if geometry_type == ogr.wkbPoint:
+        for k in feature_offsets[:-1]:
+            blobs.append(pack('<BI', 1, ogr.wkbPoint) + rings[k])
+    elif geometry_type == ogr.wkbLineString:
+        for k in feature_offsets[:-1]:
+            blobs.append(pack('<BII', 1, ogr.wkbLineString,
+                              len(rings[k]) // 16) + rings[k])
+    elif geometry_type == ogr.wkbPolygon:
+        for i in xrange(len(feature_offsets) - 1):
+            parts = [pack('<BII', 1, ogr.wkbPolygon,
+                          feature_offsets[i + 1] - feature_offsets[i])]
+            for ring in rings[feature_offsets[i]:feature_offsets[i + 1]]:
+                parts.append(pack('<I', len(ring) // 16))
+                parts.append(ring)
+            blobs.append(bytes().join(parts))
+    else:
+        msg = ('Only point, line and polygon geometries can be encoded. '
+               'I got geometry type %s' % geometry_type)
+        raise InaSAFEError(msg)
+
+    return blobs
+
+
+def get_ogr_field_type(values):
+    """Get OGR field type able to store all values of one attribute
+
+    :param values: Values of one attribute for all features
+    :type values: list, numpy.ndarray
+
+    :returns: ogr.OFTInteger if all values are integers or booleans,
+        ogr.OFTReal if they are numbers and some are floats and
+        ogr.OFTString otherwise. Values of None are ignored and if
+        all values are None the type is ogr.OFTString.
+    :rtype: int
+
+    :raises: VerificationError if a value has a type not in TYPE_MAP.
+    """
+
+    if isinstance(values, numpy.ndarray) and values.dtype.kind in 'bif':
+        if values.dtype.kind == 'f':
+            return ogr.OFTReal
+        return ogr.OFTInteger
+
+    ogr_types = set()
+    for py_type in set([type(value) for value in values
+                        if value is not None]):
+        msg = ('Unknown type for storing vector data: %s'
+               % str(py_type)[1:-1])
+        verify(py_type in TYPE_MAP, msg)
+        ogr_types.add(TYPE_MAP[py_type])
+
+    if len(ogr_types) == 0 or ogr.OFTString in ogr_types:
+        return ogr.OFTString
+    elif ogr.OFTReal in ogr_types:
+        return ogr.OFTReal
+    else:
+        return ogr.OFTInteger
+
+
 def safe_to_qgis_layer(layer):
     """Helper function to make a QgsMapLayer from a safe read_layer layer.
 
@@ -37,17 +37,18 @@ from safe.common.exceptions import GetDataError, InaSAFEError
 
 from layer import Layer
 from projection import Projection
-from geometry import Polygon
-from utilities import DRIVER_MAP, TYPE_MAP
+from geometry import Polygon, GeometryBuffer
+from attributes import AttributeTable
+from utilities import DRIVER_MAP
 from utilities import read_keywords
 from utilities import write_keywords
 from utilities import get_geometry_type
 from utilities import is_sequence
-from utilities import array_to_line
 from utilities import calculate_polygon_centroid
 from utilities import points_along_line
 from utilities import geometry_type_to_string
-from utilities import get_ring_data, get_polygon_data
+from utilities import decode_wkb, encode_wkb
+from utilities import get_ogr_field_type
 from utilities import rings_equal
 from utilities import safe_to_qgis_layer
 from safe.common.utilities import unique_filename
@@ -55,6 +56,10 @@ from safe.common.utilities import unique_filename
 LOGGER = logging.getLogger('InaSAFE')
 _pseudo_inf = float(99999999)
 
+# Attribute values which can be shared between copies
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None),
+                    numpy.generic)
+
 
 # noinspection PyExceptionInherit
 class Vector(Layer):
@@ -66,13 +71,17 @@ class Vector(Layer):
                 * A filename of a vector file format known to GDAL.
                 * List of dictionaries of field names and attribute values
                   associated with each point coordinate.
+                * Dictionary of field names and sequences (e.g. numpy
+                  arrays) of attribute values for all features or an
+                  AttributeTable. Attributes are then stored column by
+                  column (see note below).
                 * A QgsVectorLayer associated with geometry and data.
                 * None
             * projection: Geospatial reference in WKT format.
                 Only used if geometry is provided as a numeric array,
                 if None, WGS84 geographic is assumed.
             * geometry: A list of either point coordinates or polygons/lines
-                (see note below).
+                or a GeometryBuffer of polygons/lines (see note below).
             * geometry_type: Desired interpretation of geometry.
                 Valid options are 'point', 'line', 'polygon' or
                 the ogr types: 1, 2, 3.
@@ -92,6 +101,13 @@ class Vector(Layer):
                   table name in case of sqlite etc.) to load. Only applicable
                   to those dataformats supporting more than one layer in the
                   data file.
+            * attribute_filter: Optional OGR SQL WHERE clause such as
+                  "TYPE = 'school'". Only features matching it are read
+                  from file.
+            * bbox: Optional bounding box [West, South, East, North].
+                  Only features intersecting it are read from file.
+            * columnar: If True attributes read from file are held in an
+                  AttributeTable (see note below). Default False.
 
         Returns:
             * InaSAFE vector layer instance
@@ -102,8 +118,10 @@ class Vector(Layer):
 
         Notes:
 
-            If data is a filename, all other arguments are ignored
-            as they will be inferred from the file.
+            If data is a filename, all other arguments except sublayer,
+            attribute_filter, bbox and columnar are ignored as they
+            will be inferred from the file. Lines and polygons read from
+            file are held in a GeometryBuffer.
 
             The geometry type will be inferred from the dimensions of geometry.
             If each entry is one set of coordinates the type will be
@@ -121,6 +139,24 @@ class Vector(Layer):
             list of polygon geometry objects
             (as defined in module geometry.py)
 
+            Lines and polygons can also be given as a GeometryBuffer
+            (as defined in module geometry.py) holding all vertices in one
+            coordinate array with offsets for each ring and feature. This is
+            more compact than a list of arrays and bounding boxes and
+            centroids of all features are computed without looping.
+            Method get_geometry still returns a list with one array or
+            polygon object per feature. These are views into the buffer so
+            vertices changed in place change the layer. Use
+            get_geometry(copy=True) to get independent arrays.
+
+            Attributes given as columns are held in an AttributeTable
+            (as defined in module attributes.py) with one numpy array per
+            attribute. This is much more compact than one dictionary per
+            feature and whole columns can be read and added with
+            get_column and set_column without looping over features.
+            Method get_data still returns a list with a dictionary like
+            view of each feature.
+
     """
 
     def __init__(
@@ -132,7 +168,10 @@ class Vector(Layer):
             name=None,
             keywords=None,
             style_info=None,
-            sublayer=None):
+            sublayer=None,
+            attribute_filter=None,
+            bbox=None,
+            columnar=False):
         """Initialise object with either geometry or filename
 
         NOTE: Doc strings in constructor are not harvested and exposed in
@@ -157,7 +196,8 @@ class Vector(Layer):
             return
 
         if isinstance(data, basestring):
-            self.read_from_file(data)
+            self.read_from_file(data, attribute_filter=attribute_filter,
+                                bbox=bbox, columnar=columnar)
         elif isinstance(data, QgsVectorLayer):
             self.read_from_qgis_native(data)
         else:
@@ -169,9 +209,16 @@ class Vector(Layer):
             verify(geometry is not None, msg)
 
             msg = 'Geometry must be a sequence'
-            verify(is_sequence(geometry), msg)
+            verify(isinstance(geometry, GeometryBuffer) or
+                   is_sequence(geometry), msg)
 
-            if len(geometry) > 0 and isinstance(geometry[0], Polygon):
+            if isinstance(geometry, GeometryBuffer):
+                if geometry.geometry_type == 'line':
+                    self.geometry_type = ogr.wkbLineString
+                else:
+                    self.geometry_type = ogr.wkbPolygon
+                self.geometry = geometry
+            elif len(geometry) > 0 and isinstance(geometry[0], Polygon):
                 self.geometry_type = ogr.wkbPolygon
                 self.geometry = geometry
             else:
@@ -193,12 +240,16 @@ class Vector(Layer):
                 data = []
                 for i in range(len(geometry)):
                     data.append({'ID': i})
+            elif isinstance(data, dict):
+                # Attribute values given column by column
+                data = AttributeTable(data)
 
             # Check data
             self.data = data
             if data is not None:
                 msg = 'Data must be a sequence'
-                verify(is_sequence(data), msg)
+                verify(isinstance(data, AttributeTable) or
+                       is_sequence(data), msg)
 
                 msg = ('The number of entries in geometry and data '
                        'must be the same')
@@ -210,6 +261,10 @@ class Vector(Layer):
                 self.extent = [0, 0, 0, 0]
                 return
 
+            if isinstance(self.geometry, GeometryBuffer):
+                self.extent = self.geometry.get_extent()
+                return
+
             # Compute bounding box for each geometry type
             minx = miny = sys.maxint
             maxx = maxy = -minx
@@ -383,7 +438,8 @@ class Vector(Layer):
         return True
 
     # noinspection PyExceptionInherit
-    def read_from_file(self, filename):
+    def read_from_file(self, filename, attribute_filter=None, bbox=None,
+                       columnar=False, batch_size=2 ** 16):
         """Read and unpack vector data.
 
         It is assumed that the file contains only one layer with the
@@ -409,9 +465,29 @@ class Vector(Layer):
         geoprocessing_tool_reference/
         geoprocessing_considerations_for_shapefile_output.htm
 
+        Features are read in batches. Geometries are exported as well
+        known binary and decoded into one coordinate array per batch
+        (see decode_wkb) and attributes are collected field by field
+        with the field names looked up only once.
+
         :param filename: a fully qualified location to the file
         :type filename: str
 
+        :param attribute_filter: Optional OGR SQL WHERE clause selecting
+            the features to read.
+        :type attribute_filter: str
+
+        :param bbox: Optional bounding box [West, South, East, North]
+            selecting the features to read.
+        :type bbox: list
+
+        :param columnar: If True store attributes in an AttributeTable.
+            Otherwise as a list of dictionaries.
+        :type columnar: bool
+
+        :param batch_size: Number of features decoded at a time.
+        :type batch_size: int
+
         :raises: ReadLayerError
         """
 
@@ -461,6 +537,23 @@ class Vector(Layer):
         else:
             layer = fid.GetLayerByIndex(0)
 
+        # Select features
+        if attribute_filter is not None:
+            if layer.SetAttributeFilter(attribute_filter) != 0:
+                msg = ('Invalid attribute filter "%s" for filename %s'
+                       % (attribute_filter, filename))
+                raise ReadLayerError(msg)
+        else:
+            layer.SetAttributeFilter(None)
+
+        if bbox is not None:
+            msg = ('Bounding box must be a list of 4 numbers '
+                   '[West, South, East, North]. I got %s' % str(bbox))
+            verify(is_sequence(bbox) and len(bbox) == 4, msg)
+            layer.SetSpatialFilterRect(*[float(x) for x in bbox])
+        else:
+            layer.SetSpatialFilter(None)
+
         # Get spatial extent
         self.extent = layer.GetExtent()
 
@@ -470,80 +563,110 @@ class Vector(Layer):
 
         layer.ResetReading()
 
+        # Resolve field names once
+        layer_definition = layer.GetLayerDefn()
+        number_of_fields = layer_definition.GetFieldCount()
+        names = [layer_definition.GetFieldDefn(j).GetName()
+                 for j in range(number_of_fields)]
+        fields = range(number_of_fields)
+
         # Extract coordinates and attributes for all features
-        geometry = []
-        data = []
+        buffers = []
+        blobs = []
+        rows = []
+
         # Use feature iterator
         for feature in layer:
-            # Record coordinates ordered as Longitude, Latitude
             G = feature.GetGeometryRef()
             if G is None:
                 msg = ('Geometry was None in filename %s ' % filename)
                 raise ReadLayerError(msg)
-            else:
-                self.geometry_type = G.GetGeometryType()
-                if self.is_point_data:
-                    geometry.append((G.GetX(), G.GetY()))
-                elif self.is_line_data:
-                    ring = get_ring_data(G)
-                    geometry.append(ring)
-                elif self.is_polygon_data:
-                    polygon = get_polygon_data(G)
-                    geometry.append(polygon)
-                elif self.is_multi_polygon_data:
-                    try:
-                        G = ogr.ForceToPolygon(G)
-                    except:
-                        msg = ('Got geometry type Multipolygon (%s) for '
-                               'filename %s and could not convert it to '
-                               'singlepart. However, you can use QGIS '
-                               'functionality to convert multipart vector '
-                               'data to singlepart (Vector -> Geometry Tools '
-                               '-> Multipart to Singleparts and use the '
-                               'resulting dataset.'
-                               % (ogr.wkbMultiPolygon, filename))
-                        raise ReadLayerError(msg)
-                    else:
-                        # Read polygon data as single part
-                        self.geometry_type = ogr.wkbPolygon
-                        polygon = get_polygon_data(G)
-                        geometry.append(polygon)
-                else:
-                    msg = ('Only point, line and polygon geometries are '
-                           'supported. '
-                           'Geometry type in filename %s '
-                           'was %s.' % (filename,
-                                        self.geometry_type))
+
+            self.geometry_type = G.GetGeometryType()
+            if self.is_multi_polygon_data:
+                try:
+                    G = ogr.ForceToPolygon(G)
+                except:
+                    msg = ('Got geometry type Multipolygon (%s) for '
+                           'filename %s and could not convert it to '
+                           'singlepart. However, you can use QGIS '
+                           'functionality to convert multipart vector '
+                           'data to singlepart (Vector -> Geometry Tools '
+                           '-> Multipart to Singleparts and use the '
+                           'resulting dataset.'
+                           % (ogr.wkbMultiPolygon, filename))
                     raise ReadLayerError(msg)
+                else:
+                    # Read polygon data as single part
+                    self.geometry_type = ogr.wkbPolygon
+            elif not (self.is_point_data or self.is_line_data or
+                      self.is_polygon_data):
+                msg = ('Only point, line and polygon geometries are '
+                       'supported. '
+                       'Geometry type in filename %s '
+                       'was %s.' % (filename,
+                                    self.geometry_type))
+                raise ReadLayerError(msg)
+
+            # Record coordinates ordered as Longitude, Latitude
+            G.FlattenTo2D()
+            blobs.append(G.ExportToWkb(ogr.wkbNDR))
+
+            # Record attributes in field order
+            get = feature.GetField
+            rows.append([get(j) for j in fields])
+
+            if len(blobs) == batch_size:
+                buffers.append(decode_wkb(blobs))
+                blobs = []
+        if len(blobs) > 0:
+            buffers.append(decode_wkb(blobs))
+
+        geometry_types = numpy.unique(numpy.concatenate(
+            [batch[0] for batch in buffers] + [numpy.zeros(0, dtype='i')]))
+        msg = ('Features in filename %s must all be of the same geometry '
+               'type. I got types %s' % (filename, geometry_types))
+        verify(len(geometry_types) <= 1, msg)
 
-            # Record attributes by name
-            number_of_fields = feature.GetFieldCount()
-            fields = {}
-            for j in range(number_of_fields):
-                name = feature.GetFieldDefnRef(j).GetName()
-
-                # FIXME (Ole): Ascertain the type of each field?
-                #              We need to cast each appropriately?
-                #              This is issue #66
-                #              (https://github.com/AIFDR/riab/issues/66)
-                #feature_type = feature.GetFieldDefnRef(j).GetType()
-                fields[name] = feature.GetField(j)
-
-                    # We do this because there is NaN problem on windows
-                    # NaN value must be converted to _pseudo_in to solve the
-                    # problem. But, when InaSAFE read the file, it'll be
-                    # converted back to NaN value, so that NaN in InaSAFE is a
-                    # numpy.nan
-                    # please check https://github.com/AIFDR/inasafe/issues/269
-                    # for more information
-                if fields[name] == _pseudo_inf:
-                    fields[name] = float('nan')
-                #print 'Field', name, feature_type, j, fields[name]
-
-            data.append(fields)
         # Store geometry coordinates as a compact numeric array
-        self.geometry = geometry
-        self.data = data
+        self.geometry = _join_geometry_batches(buffers, self.geometry_type)
+
+        # Store attributes field by field
+        if len(rows) > 0:
+            columns = [list(values) for values in zip(*rows)]
+        else:
+            columns = [[] for _ in names]
+        for values in columns:
+            # We do this because there is NaN problem on windows
+            # NaN value must be converted to _pseudo_in to solve the
+            # problem. But, when InaSAFE read the file, it'll be
+            # converted back to NaN value, so that NaN in InaSAFE is a
+            # numpy.nan
+            # please check https://github.com/AIFDR/inasafe/issues/269
+            # for more information
+            if _pseudo_inf in values:
+                values[:] = [float('nan') if x == _pseudo_inf else x
+                             for x in values]
+
+        if columnar:
+            self.data = AttributeTable(dict(zip(names, columns)),
+                                       names=names)
+            self.data.size = len(rows)
+        elif number_of_fields > 0:
+            self.data = [dict(zip(names, values))
+                         for values in zip(*columns)]
+        else:
+            self.data = [{} for _ in rows]
+
+        # Extent of selected features only
+        if ((attribute_filter is not None or bbox is not None) and
+                len(self.geometry) > 0):
+            if isinstance(self.geometry, GeometryBuffer):
+                self.extent = self.geometry.get_extent()
+            else:
+                A = numpy.array(self.geometry)
+                self.extent = [A[:, 0].min(), A[:, 0].max(),
+                               A[:, 1].min(), A[:, 1].max()]
 
     def read_from_qgis_native(self, qgis_layer):
         """Read and unpack vector data from qgis layer QgsVectorLayer.
@@ -600,16 +723,24 @@ class Vector(Layer):
         qgis_layer = safe_to_qgis_layer(self)
         return qgis_layer
 
-    def write_to_file(self, filename, sublayer=None):
+    def write_to_file(self, filename, sublayer=None, batch_size=2 ** 14,
+                      spatial_index=True):
         """Save vector data to file
 
-        :param filename: filename with extension .shp or .gml
+        :param filename: filename with extension .shp, .sqlite or .gpkg
         :type filename: str
 
         :param sublayer: Optional parameter for writing a sublayer. Ignored
-            unless we are writing to an sqlite file.
+            unless we are writing to an sqlite or GeoPackage file.
         :type sublayer: str
 
+        :param batch_size: Number of features written in each transaction.
+        :type batch_size: int
+
+        :param spatial_index: If True (default) GeoPackage files are
+            written with a spatial index.
+        :type spatial_index: bool
+
         :raises: WriteLayerError
 
         Note:
@@ -619,16 +750,21 @@ class Vector(Layer):
             has changed its handling of this issue:
             http://www.gdal.org/ogr/drv_shapefile.html
 
-            **For this reason we recommend writing to spatialite.**
+            **For this reason we recommend writing to spatialite or
+            GeoPackage.**
 
+            The type of each attribute is determined from the values of all
+            features (see get_ogr_field_type). Features are created in
+            batches, each inside one transaction for formats supporting
+            them.
         """
 
         # Check file format
         base_name, extension = os.path.splitext(filename)
 
         msg = ('Invalid file type for file %s. Only extensions '
-               'sqlite, shp or gml allowed.' % filename)
-        verify(extension in ['.sqlite', '.shp', '.gml'], msg)
+               'sqlite, gpkg, shp or gml allowed.' % filename)
+        verify(extension in ['.sqlite', '.gpkg', '.shp', '.gml'], msg)
         driver = DRIVER_MAP[extension]
 
         # FIXME (Ole): Tempory flagging of GML issue (ticket #18)
@@ -638,20 +774,35 @@ class Vector(Layer):
                    'https://github.com/AIFDR/riab/issues/18')
             raise WriteLayerError(msg)
 
+        msg = 'Batch size must be positive. I got %s' % batch_size
+        verify(batch_size > 0, msg)
+
         # Derive layer_name from filename (excluding preceding dirs)
         if sublayer is None or extension == '.shp':
             layer_name = os.path.split(base_name)[-1]
         else:
             layer_name = sublayer
 
-        # Get vector data
-        if self.is_polygon_data:
-            geometry = self.get_geometry(as_geometry_objects=True)
+        # Get vector data as well known binary
+        if self.is_point_data:
+            N = len(self)
+            points = numpy.zeros((N, 2))
+            if N > 0:
+                points[:] = numpy.array(self.get_geometry(), dtype='d')[:, :2]
+            offsets = numpy.arange(N + 1)
+            blobs = encode_wkb(points, offsets, offsets, ogr.wkbPoint)
+        elif self.is_line_data or self.is_polygon_data:
+            buf = self.get_geometry_buffer()
+            if self.is_line_data:
+                wkb_type = ogr.wkbLineString
+            else:
+                wkb_type = ogr.wkbPolygon
+            N = len(buf)
+            blobs = encode_wkb(buf.coordinates, buf.ring_offsets,
+                               buf.feature_offsets, wkb_type)
         else:
-            geometry = self.get_geometry()
-        data = self.get_data()
-
-        N = len(geometry)
+            msg = 'Geometry type %s not implemented' % self.geometry_type
+            raise WriteLayerError(msg)
 
         # Clear any previous file of this name (ogr does not overwrite)
         try:
@@ -670,138 +821,102 @@ class Vector(Layer):
             msg = 'Creation of output file %s failed' % filename
             raise WriteLayerError(msg)
 
+        options = []
+        if extension == '.gpkg':
+            if spatial_index:
+                options.append('SPATIAL_INDEX=YES')
+            else:
+                options.append('SPATIAL_INDEX=NO')
+
         lyr = ds.CreateLayer(layer_name,
                              self.projection.spatial_reference,
-                             self.geometry_type)
+                             self.geometry_type,
+                             options)
         if lyr is None:
             msg = 'Could not create layer %s' % layer_name
             raise WriteLayerError(msg)
 
-        # Define attributes if any
-        store_attributes = False
+        # Get attribute values field by field
         fields = []
-        if data is not None:
-            if len(data) > 0:
-                try:
-                    fields = data[0].keys()
-                except:
-                    msg = ('Input parameter "attributes" was specified '
-                           'but it does not contain list of dictionaries '
-                           'with field information as expected. The first '
-                           'element is %s' % data[0])
-                    raise WriteLayerError(msg)
-                else:
-                    # Establish OGR types for each element
-                    ogr_types = {}
-                    for name in fields:
-                        att = data[0][name]
-                        py_type = type(att)
-                        msg = ('Unknown type for storing vector '
-                               'data: %s, %s' % (name, str(py_type)[1:-1]))
-                        verify(py_type in TYPE_MAP, msg)
-                        ogr_types[name] = TYPE_MAP[py_type]
+        columns = []
+        if self.is_columnar:
+            fields = self.data.names
+            columns = [self.data.get_column(name, writable=False)
+                       for name in fields]
+        elif self.data is not None and len(self.data) > 0:
+            data = self.get_data()
+            try:
+                fields = data[0].keys()
+            except:
+                msg = ('Input parameter "attributes" was specified '
+                       'but it does not contain list of dictionaries '
+                       'with field information as expected. The first '
+                       'element is %s' % data[0])
+                raise WriteLayerError(msg)
+            columns = [[x[name] for x in data] for name in fields]
+
+        # Create attribute fields in layer with one type for all features
+        values = []
+        for name, column in zip(fields, columns):
+            fd = ogr.FieldDefn(name, get_ogr_field_type(column))
+            # FIXME (Ole): Trying to address issue #16
+            #              But it doesn't work and
+            #              somehow changes the values of MMI in test
+            #width = max(128, len(name))
+            #print name, width
+            #fd.SetWidth(width)
+
+            # Silent handling of warnings like
+            # Warning 6: Normalized/laundered field name:
+            #'CONTENTS_LOSS_AUD' to 'CONTENTS_L'
+            gdal.PushErrorHandler('CPLQuietErrorHandler')
+            if lyr.CreateField(fd) != 0:
+                msg = 'Could not create field %s' % name
+                raise WriteLayerError(msg)
 
-            else:
-                #msg = ('Input parameter "data" was specified '
-                #       'but appears to be empty')
-                #raise InaSAFEError(msg)
-                pass
-
-            # Create attribute fields in layer
-            store_attributes = True
-            for name in fields:
-                fd = ogr.FieldDefn(name, ogr_types[name])
-                # FIXME (Ole): Trying to address issue #16
-                #              But it doesn't work and
-                #              somehow changes the values of MMI in test
-                #width = max(128, len(name))
-                #print name, width
-                #fd.SetWidth(width)
-
-                # Silent handling of warnings like
-                # Warning 6: Normalized/laundered field name:
-                #'CONTENTS_LOSS_AUD' to 'CONTENTS_L'
-                gdal.PushErrorHandler('CPLQuietErrorHandler')
-                if lyr.CreateField(fd) != 0:
-                    msg = 'Could not create field %s' % name
-                    raise WriteLayerError(msg)
+            # Restore error handler
+            gdal.PopErrorHandler()
 
-                # Restore error handler
-                gdal.PopErrorHandler()
+            values.append(_field_values(column))
 
-        # Store geometry
-        geom = ogr.Geometry(self.geometry_type)
+        # Store features in batches
         layer_def = lyr.GetLayerDefn()
-        for i in range(N):
-            # Create new feature instance
-            feature = ogr.Feature(layer_def)
+        for start in range(0, N, batch_size):
+            lyr.StartTransaction()
+            for i in xrange(start, min(start + batch_size, N)):
+                # Create new feature instance
+                feature = ogr.Feature(layer_def)
+
+                # Store geometry and check
+                feature.SetGeometryDirectly(
+                    ogr.CreateGeometryFromWkb(blobs[i]))
+
+                G = feature.GetGeometryRef()
+                if G is None:
+                    lyr.RollbackTransaction()
+                    msg = ('Could not create GeometryRef for file %s'
+                           % filename)
+                    raise WriteLayerError(msg)
 
-            # Store geometry and check
-            if self.is_point_data:
-                x = float(geometry[i][0])
-                y = float(geometry[i][1])
-                geom.SetPoint_2D(0, x, y)
-            elif self.is_line_data:
-                geom = array_to_line(
-                    geometry[i], geometry_type=ogr.wkbLineString)
-            elif self.is_polygon_data:
-                # Create polygon geometry
-                geom = ogr.Geometry(ogr.wkbPolygon)
-
-                # Add outer ring
-                linear_ring = array_to_line(
-                    geometry[i].outer_ring, geometry_type=ogr.wkbLinearRing)
-                geom.AddGeometry(linear_ring)
-
-                # Add inner rings if any
-                for A in geometry[i].inner_rings:
-                    geom.AddGeometry(array_to_line(
-                        A, geometry_type=ogr.wkbLinearRing))
-            else:
-                msg = 'Geometry type %s not implemented' % self.geometry_type
-                raise WriteLayerError(msg)
+                # Store attributes
+                for j, column in enumerate(values):
+                    feature.SetField(j, column[i])
 
-            feature.SetGeometry(geom)
+                # Save this feature
+                if lyr.CreateFeature(feature) != 0:
+                    lyr.RollbackTransaction()
+                    msg = ('Failed to create feature %i in file %s'
+                           % (i, filename))
+                    raise WriteLayerError(msg)
 
-            G = feature.GetGeometryRef()
-            if G is None:
-                msg = 'Could not create GeometryRef for file %s' % filename
-                raise WriteLayerError(msg)
+                feature.Destroy()
 
-            # Store attributes
-            if store_attributes:
-                for j, name in enumerate(fields):
-                    actual_field_name = layer_def.GetFieldDefn(j).GetNameRef()
-
-                    val = data[i][name]
-
-                    if type(val) == numpy.ndarray:
-                        # A singleton of type <type 'numpy.ndarray'> works
-                        # for gdal version 1.6 but fails for version 1.8
-                        # in SetField with error: NotImplementedError:
-                        # Wrong number of arguments for overloaded function
-                        val = float(val)
-                    elif val is None:
-                        val = ''
-
-                    # We do this because there is NaN problem on windows
-                    # NaN value must be converted to _pseudo_in to solve the
-                    # problem. But, when InaSAFE read the file, it'll be
-                    # converted back to NaN value, so that NaN in InaSAFE is a
-                    # numpy.nan
-                    # please check https://github.com/AIFDR/inasafe/issues/269
-                    # for more information
-                    if val != val:
-                        val = _pseudo_inf
-
-                    feature.SetField(actual_field_name, val)
-
-            # Save this feature
-            if lyr.CreateFeature(feature) != 0:
-                msg = 'Failed to create feature %i in file %s' % (i, filename)
+            if lyr.CommitTransaction() != 0:
+                msg = 'Could not write features to file %s' % filename
                 raise WriteLayerError(msg)
 
-            feature.Destroy()
+        # Close file
+        ds = None
 
         # Write keywords if any
         write_keywords(self.keywords, base_name + '.keywords')
@@ -812,14 +927,26 @@ class Vector(Layer):
         """Return copy of vector layer
 
         This copy will be equal to self in the sense defined by __eq__
+
+        Note:
+            Attributes held in an AttributeTable are shared with the copy
+            until changed (see AttributeTable.copy). Geometry held in a
+            GeometryBuffer is copied as three arrays.
         """
 
-        if self.is_polygon_data:
+        if isinstance(self.geometry, GeometryBuffer):
+            geometry = self.geometry.copy()
+        elif self.is_polygon_data:
             geometry = self.get_geometry(copy=True, as_geometry_objects=True)
         else:
             geometry = self.get_geometry(copy=True)
 
-        return Vector(data=self.get_data(copy=True),
+        if self.is_columnar:
+            data = self.data.copy(deep=False)
+        else:
+            data = self.get_data(copy=True)
+
+        return Vector(data=data,
                       geometry=geometry,
                       projection=self.get_projection(),
                       keywords=self.get_keywords())
@@ -830,8 +957,65 @@ class Vector(Layer):
         These are the ones that can be used with get_data
         """
 
+        if self.is_columnar:
+            return list(self.data.names)
         return self.data[0].keys()
 
+    def get_columns(self):
+        """Get attributes of all features as an AttributeTable
+
+        :returns: The attribute table of this layer if attributes are held
+            column by column. Otherwise a new table is created from the
+            attribute dictionaries of all features.
+        :rtype: AttributeTable
+        """
+
+        if self.is_columnar:
+            return self.data
+        return AttributeTable.from_records(self.get_data())
+
+    def get_column(self, attribute):
+        """Get values of one attribute for all features
+
+        :param attribute: Attribute name
+        :type attribute: str
+
+        :raises: VerificationError if attribute does not exist
+
+        :returns: Array of values. If attributes are held column by column
+            this is the stored array. It is only copied if it is shared
+            with a copy of this layer (see AttributeTable.get_column).
+        :rtype: numpy.ndarray
+        """
+
+        if self.is_columnar:
+            return self.data.get_column(attribute)
+
+        values = self.get_data(attribute)
+        return AttributeTable({attribute: values}).get_column(attribute)
+
+    def set_column(self, attribute, values):
+        """Add or replace values of one attribute for all features
+
+        :param attribute: Attribute name
+        :type attribute: str
+
+        :param values: Sequence with one value for each feature
+        :type values: list, numpy.ndarray
+        """
+
+        msg = ('Attribute %s must have one value for each of the %i '
+               'features. I got %i' % (attribute, len(self), len(values)))
+        verify(len(values) == len(self), msg)
+
+        if self.is_columnar:
+            self.data.set_column(attribute, values)
+        else:
+            for i, value in enumerate(values):
+                if isinstance(value, numpy.generic):
+                    value = value.item()
+                self.data[i][attribute] = value
+
     def get_data(self, attribute=None, index=None, copy=False):
         """Get vector attributes
 
@@ -866,22 +1050,37 @@ class Vector(Layer):
             If optional argument copy is True and all attributes are requested,
             a copy will be returned. Otherwise a pointer to the data is
             returned.
+
+            If attributes are held column by column (see is_columnar) the
+            entries are dictionary like views of each feature. Assigning
+            to them updates the columns. A copy is a list of dictionaries.
         """
 
         if hasattr(self, 'data'):
             if attribute is None:
-                if copy:
-                    return copy_module.deepcopy(self.data)
+                if self.is_columnar:
+                    if copy:
+                        # Records are new dictionaries already
+                        return _copy_values(self.data.to_records())
+                    else:
+                        return self.data.get_rows()
+                elif copy:
+                    return _copy_records(self.data)
                 else:
                     return self.data
             else:
+                names = self.get_attribute_names()
                 msg = ('Specified attribute %s does not exist in '
                        'vector layer %s. Valid names are %s'
-                       '' % (attribute, self, self.data[0].keys()))
-                verify(attribute in self.data[0], msg)
+                       '' % (attribute, self, names))
+                verify(attribute in names, msg)
 
                 if index is None:
                     # Return all values for specified attribute
+                    if self.is_columnar:
+                        column = self.data.get_column(attribute,
+                                                      writable=False)
+                        return column.tolist()
                     return [x[attribute] for x in self.data]
                 else:
                     # Return value for specified attribute and index
@@ -894,6 +1093,8 @@ class Vector(Layer):
                            '' % (self, 0, len(self) - 1))
                     verify(0 <= index < len(self), msg)
 
+                    if self.is_columnar:
+                        return self.data.get_value(index, attribute)
                     return self.data[index][attribute]
         else:
             msg = 'Vector data instance does not have any attributes'
@@ -937,10 +1138,13 @@ class Vector(Layer):
         :rtype: list
         """
 
-        if copy:
-            geometry = copy_module.deepcopy(self.geometry)
-        else:
-            geometry = self.geometry
+        geometry = self.geometry
+        if isinstance(geometry, GeometryBuffer):
+            if copy:
+                geometry = geometry.copy()
+            geometry = geometry.get_features()
+        elif copy:
+            geometry = _copy_geometry(geometry)
 
         if self.is_polygon_data:
             if not as_geometry_objects:
@@ -953,6 +1157,39 @@ class Vector(Layer):
 
         return geometry
 
+    def get_geometry_buffer(self):
+        """Get line or polygon geometry as a GeometryBuffer
+
+        :returns: The stored buffer if geometry is held as one.
+            Otherwise a new buffer with a copy of the geometry.
+        :rtype: GeometryBuffer
+
+        :raises: InaSAFEError if layer does not have line or polygon data
+        """
+
+        if isinstance(self.geometry, GeometryBuffer):
+            return self.geometry
+
+        if self.is_line_data:
+            return GeometryBuffer.from_lines(self.get_geometry())
+        elif self.is_polygon_data:
+            return GeometryBuffer.from_polygons(
+                self.get_geometry(as_geometry_objects=True))
+        else:
+            msg = ('Geometry buffers are only available for line and '
+                   'polygon data. I got %s' % self.get_geometry_name())
+            raise InaSAFEError(msg)
+
+    def get_bounding_boxes(self):
+        """Get bounding box of each line or polygon feature
+
+        :returns: Nx4 array with rows [minx, maxx, miny, maxy]. For
+            polygons only the outer ring is used.
+        :rtype: numpy.ndarray
+        """
+
+        return self.get_geometry_buffer().get_bounding_boxes()
+
     def get_bounding_box(self):
         """Get bounding box coordinates for vector layer.
 
@@ -1010,7 +1247,8 @@ class Vector(Layer):
         values = self.get_data(attribute)
 
         # Sort and select using Schwarzian transform
-        A = zip(values, self.data, self.geometry)
+        A = zip(values, self.get_data(),
+                self.get_geometry(as_geometry_objects=self.is_polygon_data))
         A.sort()
 
         # Pick top N and unpack
@@ -1022,6 +1260,15 @@ class Vector(Layer):
                       geometry=geometry,
                       keywords=self.get_keywords())
 
+    @property
+    def is_columnar(self):
+        """ Check whether attributes are held column by column
+
+        :return: Test result
+        :rtype: bool
+        """
+        return isinstance(getattr(self, 'data', None), AttributeTable)
+
     @property
     def is_point_data(self):
         """ Check whether this is a point
@@ -1072,6 +1319,154 @@ class Vector(Layer):
 #----------------------------------
 # Helper functions for class Vector
 #----------------------------------
+def _join_geometry_batches(batches, geometry_type):
+    """Join geometries decoded in batches by decode_wkb
+
+    :param batches: List of tuples returned by decode_wkb
+    :type batches: list
+
+    :param geometry_type: OGR geometry type of all features
+    :type geometry_type: int
+
+    :returns: List of (x, y) tuples for points and a GeometryBuffer for
+        lines and polygons. An empty list if there are no features.
+    """
+
+    if len(batches) == 0:
+        return []
+
+    coordinates = numpy.concatenate([b[1] for b in batches])
+    if geometry_type in [ogr.wkbPoint, ogr.wkbPoint25D]:
+        return zip(coordinates[:, 0].tolist(), coordinates[:, 1].tolist())
+
+    # Shift offsets of each batch by the preceding rings and vertices
+    ring_offsets = [numpy.zeros(1, dtype=numpy.int)]
+    feature_offsets = [numpy.zeros(1, dtype=numpy.int)]
+    for _, _, rings, features in batches:
+        ring_offsets.append(rings[1:] + ring_offsets[-1][-1])
+        feature_offsets.append(features[1:] + feature_offsets[-1][-1])
+
+    if geometry_type in [ogr.wkbLineString, ogr.wkbLineString25D]:
+        kind = 'line'
+    else:
+        kind = 'polygon'
+    return GeometryBuffer(coordinates,
+                          numpy.concatenate(ring_offsets),
+                          numpy.concatenate(feature_offsets),
+                          geometry_type=kind)
+
+
+def _field_values(column):
+    """Convert values of one attribute to values accepted by OGR SetField
+
+    :param column: Values of one attribute for all features
+    :type column: list, numpy.ndarray
+
+    :returns: List of values where None is replaced by an empty string,
+        arrays by floats and NaN by _pseudo_inf.
+    :rtype: list
+    """
+
+    if isinstance(column, numpy.ndarray) and column.dtype.kind == 'f':
+        # We do this because there is NaN problem on windows
+        # NaN value must be converted to _pseudo_in to solve the
+        # problem. But, when InaSAFE read the file, it'll be
+        # converted back to NaN value, so that NaN in InaSAFE is a
+        # numpy.nan
+        # please check https://github.com/AIFDR/inasafe/issues/269
+        # for more information
+        return numpy.where(numpy.isnan(column), _pseudo_inf,
+                           column).tolist()
+    elif isinstance(column, numpy.ndarray) and column.dtype.kind in 'bi':
+        return [int(x) for x in column.tolist()]
+
+    values = []
+    for val in column:
+        if type(val) == numpy.ndarray:
+            # A singleton of type <type 'numpy.ndarray'> works
+            # for gdal version 1.6 but fails for version 1.8
+            # in SetField with error: NotImplementedError:
+            # Wrong number of arguments for overloaded function
+            val = float(val)
+        elif val is None:
+            val = ''
+
+        # NaN is stored as _pseudo_inf (see above)
+        if val != val:
+            val = _pseudo_inf
+        values.append(val)
+    return values
+
+
+def _copy_records(records):
+    """Copy list of attribute dictionaries
+
+    :param records: List with one dictionary of attributes per feature
+    :type records: list
+
+    :returns: List of new dictionaries. Immutable values such as numbers
+        and strings are shared and only other values are deep copied.
+    :rtype: list
+    """
+
+    return _copy_values([dict(record) for record in records])
+
+
+def _copy_values(records):
+    """Deep copy mutable values of attribute dictionaries in place
+
+    :param records: List with one dictionary of attributes per feature
+    :type records: list
+
+    :returns: The same list. Values other than numbers, strings and None
+        are replaced by deep copies.
+    :rtype: list
+    """
+
+    for record in records:
+        for key in record:
+            if not isinstance(record[key], _IMMUTABLE_TYPES):
+                record[key] = copy_module.deepcopy(record[key])
+    return records
+
+
+def _copy_geometry(geometry):
+    """Copy list of feature geometries
+
+    :param geometry: List of arrays, coordinate pairs or Polygon instances
+    :type geometry: list
+
+    :returns: List of new geometries. Arrays are copied with numpy and
+        polygons ring by ring without their prepared versions (see
+        Polygon.prepare). Other entries are deep copied.
+    :rtype: list
+    """
+
+    if len(geometry) > 0 and not isinstance(geometry[0], (Polygon,
+                                                          numpy.ndarray)):
+        # E.g. points given as lists of coordinates
+        return copy_module.deepcopy(geometry)
+
+    result = []
+    for feature in geometry:
+        if isinstance(feature, Polygon):
+            feature = Polygon(_copy_ring(feature.outer_ring),
+                              [_copy_ring(x) for x in feature.inner_rings])
+        else:
+            feature = _copy_ring(feature)
+        result.append(feature)
+    return result
+
+
+def _copy_ring(ring):
+    """Copy array with numpy and other sequences with deepcopy
+    """
+
+    if isinstance(ring, numpy.ndarray):
+        return ring.copy()
+    return copy_module.deepcopy(ring)
+
+
 def convert_line_to_points(V, delta):
     """Convert line vector data to point vector data
 
@@ -1126,17 +1521,25 @@ def convert_polygons_to_centroids(V):
     msg = 'Input data %s must be polygon vector data' % V
     verify(V.is_polygon_data, msg)
 
-    geometry = V.get_geometry()
-    N = len(V)
+    if isinstance(V.geometry, GeometryBuffer):
+        # Calculate points for all polygons at once
+        centroids = V.geometry.get_centroids()
+    else:
+        geometry = V.get_geometry()
+        N = len(V)
 
-    # Calculate points for each polygon
-    centroids = []
-    for i in range(N):
-        c = calculate_polygon_centroid(geometry[i])
-        centroids.append(c)
+        # Calculate points for each polygon
+        centroids = []
+        for i in range(N):
+            c = calculate_polygon_centroid(geometry[i])
+            centroids.append(c)
 
     # Create new point vector layer with same attributes and return
-    V = Vector(data=V.get_data(),
+    if V.is_columnar:
+        data = V.get_columns()
+    else:
+        data = V.get_data()
+    V = Vector(data=data,
                projection=V.get_projection(),
                geometry=centroids,
                name='%s_centroid_data' % V.get_name(),